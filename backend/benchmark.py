@@ -0,0 +1,392 @@
+"""Load test and benchmark for the hot API paths.
+
+Seeds a dedicated database on a local mongod with realistic volumes, drives the endpoints
+in-process through an ASGI client and reports throughput and p50/p95/p99 latency per scenario.
+Results are compared with a recorded baseline and the run fails when a scenario regresses
+by more than the threshold, when any request fails, or when there is no baseline to compare with. The payload scenarios fetch the same lists in full and with a
+`fields=` projection, each with and without compression, and report the bytes on the wire.
+
+    python benchmark.py                       # seed (if needed), run, compare with the baseline
+    python benchmark.py --update-baseline     # record the current numbers as the new baseline
+    python benchmark.py --messages 100000 --notifications 100000 --requests 200   # quick run
+
+The baseline is machine specific: record it on the box the comparisons will run on.
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import sys
+import time
+import uuid
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+
+BENCHMARK_DIR = Path(__file__).parent
+DEFAULT_BASELINE = BENCHMARK_DIR / 'benchmark_baseline.json'
+SEED_BATCH_SIZE = 10000
+DEPARTMENTS = ["cutting", "stitching", "finishing", "qc", "packaging"]
+TASK_LIST_FIELDS = "title,status,priority,due_date,assigned_to"
+GROUP_HISTORY_FIELDS = "sender_name,content,sent_at"
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Benchmark the factory management API")
+    parser.add_argument("--mongo-url", default=os.environ.get('MONGO_URL', 'mongodb://localhost:27017'))
+    parser.add_argument("--db-name", default="factory_benchmark")
+    parser.add_argument("--workers", type=int, default=2000)
+    parser.add_argument("--orders", type=int, default=2000)
+    parser.add_argument("--tasks", type=int, default=1000)
+    parser.add_argument("--materials", type=int, default=500)
+    parser.add_argument("--groups", type=int, default=50)
+    parser.add_argument("--group-size", type=int, default=200)
+    parser.add_argument("--messages", type=int, default=1000000)
+    parser.add_argument("--group-messages", type=int, default=1000000)
+    parser.add_argument("--attachment-every", type=int, default=1000,
+                        help="one group message in this many carries an image attachment")
+    parser.add_argument("--attachment-kb", type=int, default=20)
+    parser.add_argument("--notifications", type=int, default=1000000)
+    parser.add_argument("--requests", type=int, default=500, help="requests per scenario")
+    parser.add_argument("--concurrency", type=int, default=20)
+    parser.add_argument("--reseed", action="store_true", help="drop and reseed the benchmark database")
+    parser.add_argument("--baseline", type=Path, default=DEFAULT_BASELINE)
+    parser.add_argument("--threshold", type=float, default=0.2,
+                        help="allowed fractional regression in p95 latency or throughput")
+    parser.add_argument("--update-baseline", action="store_true")
+    return parser.parse_args()
+
+
+def iso(dt):
+    return dt.isoformat()
+
+
+async def insert_in_batches(collection, docs_iter, total):
+    batch = []
+    for doc in docs_iter:
+        batch.append(doc)
+        if len(batch) >= SEED_BATCH_SIZE:
+            await collection.insert_many(batch, ordered=False)
+            batch = []
+    if batch:
+        await collection.insert_many(batch, ordered=False)
+    print(f"  seeded {total} {collection.name}")
+
+
+async def seed(db, args):
+    now = datetime.now(timezone.utc)
+    rng = random.Random(42)
+
+    workers = [{
+        "id": str(uuid.uuid4()),
+        "name": f"Worker {i}",
+        "department": DEPARTMENTS[i % len(DEPARTMENTS)],
+        "phone": f"+91{9000000000 + i}",
+        "skills": rng.sample(["overlock", "flatlock", "cutting", "pressing", "inspection", "packing"], 2),
+        "active": True,
+        "joined_date": iso(now - timedelta(days=rng.randint(0, 2000))),
+    } for i in range(args.workers)]
+    await insert_in_batches(db.workers, iter(workers), len(workers))
+    worker_ids = [worker['id'] for worker in workers]
+
+    await insert_in_batches(db.orders, ({
+        "id": str(uuid.uuid4()),
+        "customer_name": f"Customer {i % 150}",
+        "style_number": f"ST-{i % 400:04d}",
+        "garment_type": rng.choice(["shirt", "trouser", "jacket", "dress"]),
+        "color": rng.choice(["black", "navy", "white", "olive"]),
+        "sizes": [{"size": size, "quantity": rng.randint(50, 500)} for size in ("S", "M", "L", "XL")],
+        "total_quantity": rng.randint(200, 2000),
+        "delivery_date": (now + timedelta(days=rng.randint(-30, 90))).date().isoformat(),
+        "status": rng.choice(["pending", "in_production", "quality_check", "completed", "shipped"]),
+        "notes": "",
+        "created_at": iso(now - timedelta(days=rng.randint(0, 365))),
+        "updated_at": iso(now),
+    } for i in range(args.orders)), args.orders)
+
+    await insert_in_batches(db.materials, ({
+        "id": str(uuid.uuid4()),
+        "name": f"Material {i}",
+        "category": rng.choice(["fabric", "thread", "button", "zipper", "label"]),
+        "unit": rng.choice(["meters", "pieces", "kg"]),
+        "quantity": float(rng.randint(0, 5000)),
+        "reorder_level": float(rng.randint(100, 1000)),
+        "supplier_id": None,
+        "unit_price": round(rng.uniform(0.5, 50), 2),
+        "last_updated": iso(now),
+    } for i in range(args.materials)), args.materials)
+
+    # main() has imported server by now, with the benchmark's connection settings
+    from server import PRIORITY_RANK
+
+    def seed_task(i):
+        priority = rng.choice(["low", "medium", "high", "urgent"])
+        return {
+            "id": str(uuid.uuid4()),
+            "title": f"Task {i}",
+            "description": "Re-stitch rejected bundle and send back to QC. " * 4,
+            "assigned_to": rng.choice(worker_ids),
+            "department": DEPARTMENTS[i % len(DEPARTMENTS)],
+            "priority": priority,
+            "priority_rank": PRIORITY_RANK[priority],
+            "status": rng.choice(["pending", "in_progress", "completed"]),
+            "due_date": (now + timedelta(days=rng.randint(-10, 30))).date().isoformat(),
+            "tags": rng.sample(["rework", "urgent", "line-1", "line-2", "audit"], 2),
+            "notify_users": rng.sample(worker_ids, 5),
+            "notify_groups": [],
+            "created_at": iso(now - timedelta(days=rng.randint(0, 60))),
+        }
+
+    await insert_in_batches(db.tasks, (seed_task(i) for i in range(args.tasks)), args.tasks)
+
+    attachment_url = "data:image/jpeg;base64," + "A" * (args.attachment_kb * 1024)
+
+    groups = []
+    for i in range(args.groups):
+        members = rng.sample(worker_ids, min(args.group_size, len(worker_ids)))
+        groups.append({
+            "id": str(uuid.uuid4()),
+            "name": f"Line {i}",
+            "description": "",
+            "department": DEPARTMENTS[i % len(DEPARTMENTS)],
+            "members": [{"user_id": member, "user_name": member, "role": "member"} for member in members],
+            "created_by": members[0],
+            "last_message": None,
+            "last_message_at": None,
+            "created_at": iso(now - timedelta(days=400)),
+        })
+    await insert_in_batches(db.group_chats, iter(groups), len(groups))
+
+    conversations = []
+    for i in range(max(args.messages // 200, 1)):
+        first, second = sorted(rng.sample(worker_ids, 2))
+        conversations.append({
+            "id": str(uuid.uuid4()),
+            "participant1_id": first,
+            "participant1_name": first,
+            "participant2_id": second,
+            "participant2_name": second,
+            "participants": [first, second],
+            "participant_key": f"{first}:{second}",
+            "created_at": iso(now - timedelta(days=400)),
+        })
+    # Sampled pairs can repeat; keep one conversation per pair like the unique key would
+    conversations = list({conv['participant_key']: conv for conv in conversations}.values())
+    await insert_in_batches(db.conversations, iter(conversations), len(conversations))
+
+    def spread(i, total):
+        return iso(now - timedelta(minutes=(total - i)))
+
+    await insert_in_batches(db.messages, ({
+        "id": str(uuid.uuid4()),
+        "conversation_id": conversations[i % len(conversations)]['id'],
+        "sender_id": conversations[i % len(conversations)]['participant1_id'],
+        "sender_name": "sender",
+        "content": f"Message {i} about bundle {rng.randint(1, 5000)}",
+        "message_type": "text",
+        "task_id": None,
+        "attachments": [],
+        "read_by_recipient": rng.random() < 0.8,
+        "sent_at": spread(i, args.messages),
+    } for i in range(args.messages)), args.messages)
+
+    await insert_in_batches(db.group_messages, ({
+        "id": str(uuid.uuid4()),
+        "group_id": groups[i % len(groups)]['id'],
+        "sender_id": groups[i % len(groups)]['created_by'],
+        "sender_name": "sender",
+        "content": f"Line update {i}",
+        "message_type": "text",
+        "task_id": None,
+        "attachments": [{"file_name": "photo.jpg", "file_url": attachment_url, "file_type": "image"}]
+        if i % args.attachment_every == 0 else [],
+        "read_by": [],
+        "sent_at": spread(i, args.group_messages),
+    } for i in range(args.group_messages)), args.group_messages)
+
+    await insert_in_batches(db.task_notifications, ({
+        "id": str(uuid.uuid4()),
+        "task_id": str(uuid.uuid4()),
+        "notification_type": "task_created",
+        "recipient_id": worker_ids[i % len(worker_ids)],
+        "recipient_name": "recipient",
+        "title": f"New Task Assigned: Task {i}",
+        "content": "You have been assigned a new medium priority task.",
+        "task_data": {"title": f"Task {i}", "priority": "medium"},
+        "attachments": [],
+        "read": rng.random() < 0.7,
+        "action_taken": None,
+        "created_at": spread(i, args.notifications),
+        "read_at": None,
+    } for i in range(args.notifications)), args.notifications)
+
+    await db.benchmark_meta.replace_one({"_id": "seed"}, {"_id": "seed", **vars_for_meta(args)}, upsert=True)
+    return worker_ids, [group['id'] for group in groups]
+
+
+def vars_for_meta(args):
+    return {key: getattr(args, key) for key in
+            ("workers", "orders", "tasks", "materials", "groups", "group_size", "messages", "group_messages",
+             "attachment_every", "attachment_kb", "notifications")}
+
+
+async def load_seed_ids(db):
+    worker_ids = await db.workers.distinct("id")
+    group_ids = await db.group_chats.distinct("id")
+    return worker_ids, group_ids
+
+
+def percentile(sorted_values, fraction):
+    index = min(int(round(fraction * (len(sorted_values) - 1))), len(sorted_values) - 1)
+    return sorted_values[index]
+
+
+async def run_scenario(name, make_request, total, concurrency):
+    latencies = []
+    wire_bytes = 0
+    errors = 0
+    queue = iter(range(total))
+
+    async def worker():
+        nonlocal errors, wire_bytes
+        for i in queue:
+            start = time.perf_counter()
+            response = await make_request(i)
+            latencies.append(time.perf_counter() - start)
+            wire_bytes += response.num_bytes_downloaded
+            if response.status_code >= 400:
+                errors += 1
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - started
+
+    latencies.sort()
+    return {
+        "requests": total,
+        "errors": errors,
+        "throughput_rps": round(total / elapsed, 2),
+        "p50_ms": round(percentile(latencies, 0.50) * 1000, 3),
+        "p95_ms": round(percentile(latencies, 0.95) * 1000, 3),
+        "p99_ms": round(percentile(latencies, 0.99) * 1000, 3),
+        "avg_bytes": round(wire_bytes / total),
+    }
+
+
+def failed_scenarios(results):
+    """Scenarios with error responses: their latencies time errors, not the work being measured"""
+    return [f"{name}: {result['errors']} of {result['requests']} requests failed"
+            for name, result in results.items() if result['errors']]
+
+
+def compare(results, baseline, threshold):
+    regressions = []
+    for name, result in results.items():
+        reference = baseline.get(name)
+        if not reference:
+            continue
+        if result['p95_ms'] > reference['p95_ms'] * (1 + threshold):
+            regressions.append(f"{name}: p95 {result['p95_ms']}ms vs baseline {reference['p95_ms']}ms")
+        if result['throughput_rps'] < reference['throughput_rps'] * (1 - threshold):
+            regressions.append(
+                f"{name}: throughput {result['throughput_rps']}/s vs baseline {reference['throughput_rps']}/s"
+            )
+    return regressions
+
+
+async def main(args):
+    # server.py reads its connection settings at import time
+    os.environ['MONGO_URL'] = args.mongo_url
+    os.environ['DB_NAME'] = args.db_name
+    sys.path.insert(0, str(BENCHMARK_DIR))
+    import httpx
+    import server
+
+    db = server.db
+    meta = await db.benchmark_meta.find_one({"_id": "seed"})
+    if args.reseed or not meta or {k: v for k, v in meta.items() if k != "_id"} != vars_for_meta(args):
+        print(f"Seeding {args.db_name}...")
+        await server.client.drop_database(args.db_name)
+        worker_ids, group_ids = await seed(db, args)
+    else:
+        worker_ids, group_ids = await load_seed_ids(db)
+    await server.create_indexes()
+
+    rng = random.Random(7)
+    transport = httpx.ASGITransport(app=server.app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://benchmark") as http:
+        scenarios = {
+            "create_task_fan_out": lambda i: http.post("/api/tasks", json={
+                "title": f"Benchmark task {i}",
+                "description": "Re-stitch rejected bundle",
+                "assigned_to": rng.choice(worker_ids),
+                "department": rng.choice(DEPARTMENTS),
+                "priority": rng.choice(["low", "medium", "high", "urgent"]),
+                "notify_users": rng.sample(worker_ids, 5),
+                "notify_groups": rng.sample(group_ids, min(2, len(group_ids))),
+            }),
+            "get_user_notifications": lambda i: http.get(
+                "/api/notifications", params={"user_id": rng.choice(worker_ids), "unread_only": True}
+            ),
+            "get_group_messages": lambda i: http.get(f"/api/groups/{rng.choice(group_ids)}/messages"),
+            "get_dashboard_analytics": lambda i: http.get("/api/analytics/dashboard"),
+        }
+        # Payload variants: <endpoint>_<full|fields>_<identity|compressed>
+        identity = {"Accept-Encoding": "identity"}
+        for projection, task_params, history_params in (
+            ("full", {}, {"limit": 200}),
+            ("fields", {"fields": TASK_LIST_FIELDS}, {"limit": 200, "fields": GROUP_HISTORY_FIELDS}),
+        ):
+            for encoding, headers in (("identity", identity), ("compressed", {})):
+                scenarios[f"get_tasks_{projection}_{encoding}"] = (
+                    lambda i, params=task_params, headers=headers: http.get("/api/tasks", params=params, headers=headers)
+                )
+                scenarios[f"group_history_{projection}_{encoding}"] = (
+                    lambda i, params=history_params, headers=headers: http.get(
+                        f"/api/groups/{rng.choice(group_ids)}/messages", params=params, headers=headers
+                    )
+                )
+        results = {}
+        for name, make_request in scenarios.items():
+            results[name] = await run_scenario(name, make_request, args.requests, args.concurrency)
+            result = results[name]
+            print(f"{name:32} {result['throughput_rps']:>9}/s  p50 {result['p50_ms']:>8}ms  "
+                  f"p95 {result['p95_ms']:>8}ms  p99 {result['p99_ms']:>8}ms  {result['avg_bytes']:>9}B  "
+                  f"errors {result['errors']}")
+
+    for endpoint in ("get_tasks", "group_history"):
+        full = results[f"{endpoint}_full_identity"]
+        for variant in ("full_compressed", "fields_identity", "fields_compressed"):
+            result = results[f"{endpoint}_{variant}"]
+            saved = 1 - result['avg_bytes'] / max(full['avg_bytes'], 1)
+            print(f"{endpoint} {variant:18} {saved:>6.1%} fewer bytes, "
+                  f"p50 {result['p50_ms'] - full['p50_ms']:+.3f}ms vs full_identity")
+
+    await server.activity_writer.flush()
+    return check_results(results, args)
+
+
+def check_results(results, args):
+    """Exit status of the run: failed requests, a missing baseline or a regression fail it"""
+    failures = failed_scenarios(results)
+    for failure in failures:
+        print(f"ERRORS {failure}")
+    if failures:
+        return 1
+
+    if args.update_baseline:
+        args.baseline.write_text(json.dumps(results, indent=2) + "\n")
+        print(f"Baseline written to {args.baseline}")
+        return 0
+    if not args.baseline.exists():
+        print(f"No baseline at {args.baseline}; run with --update-baseline to record one")
+        return 1
+
+    regressions = compare(results, json.loads(args.baseline.read_text()), args.threshold)
+    for regression in regressions:
+        print(f"REGRESSION {regression}")
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(asyncio.run(main(parse_args())))
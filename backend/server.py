@@ -1,25 +1,463 @@
-from fastapi import FastAPI, APIRouter, HTTPException, Request
+from fastapi import FastAPI, APIRouter, HTTPException, Request, Response, Query, Depends
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
+from fastapi.routing import APIRoute
+from fastapi.middleware.gzip import GZipMiddleware
 from fastapi.middleware.trustedhost import TrustedHostMiddleware
 from dotenv import load_dotenv
 from starlette.middleware.cors import CORSMiddleware
+from starlette.routing import Match
 from motor.motor_asyncio import AsyncIOMotorClient
+import numpy as np
+from pymongo import ReturnDocument, UpdateOne, WriteConcern, monitoring
+from pymongo.read_preferences import Nearest, Primary, PrimaryPreferred, Secondary, SecondaryPreferred
+from bson import Timestamp
+from pymongo.errors import BulkWriteError, CollectionInvalid, DuplicateKeyError, OperationFailure
+try:
+    # Optional: brotli-asgi serves br to clients that accept it and falls back to gzip
+    from brotli_asgi import BrotliMiddleware
+except ImportError:
+    BrotliMiddleware = None
+try:
+    # Optional: shared presence state across workers (PRESENCE_STORE=redis)
+    import redis.asyncio as redis_asyncio
+except ImportError:
+    redis_asyncio = None
+import asyncio
+import contextlib
+import functools
+import hashlib
+import heapq
+import json
 import os
 import logging
+import math
+import random
+import signal
+import sys
+import threading
+import time
+from abc import ABC, abstractmethod
+from collections import deque
+from contextvars import ContextVar
 from pathlib import Path
 from pydantic import BaseModel, Field, ConfigDict
-from typing import List, Optional
+from typing import Dict, List, Optional, Tuple
 import uuid
-from datetime import datetime, timezone
+from datetime import datetime, timedelta, timezone
 from enum import Enum
 
 
 ROOT_DIR = Path(__file__).parent
 load_dotenv(ROOT_DIR / '.env')
 
+# ==================== METRICS ====================
+# In-process Prometheus-style metrics, rendered in the text exposition format by /metrics.
+# Mongo timings are recorded from pymongo's command monitoring, which runs on Motor's executor
+# threads, so every metric is guarded by a lock.
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+SIZE_BUCKETS = (100, 1000, 10000, 100000, 1000000, 10000000)
+MONGO_SLOW_QUERY_MS = float(os.environ.get('MONGO_SLOW_QUERY_MS', 100))
+
+def escape_label_value(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', ' ')
+
+def format_labels(label_names: tuple, labels: tuple, le: Optional[str] = None) -> str:
+    pairs = [f'{name}="{escape_label_value(value)}"' for name, value in zip(label_names, labels)]
+    if le is not None:
+        pairs.append(f'le="{le}"')
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+class Counter:
+    def __init__(self, name: str, help_text: str, label_names: tuple):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = label_names
+        self._values = {}
+        self._lock = threading.Lock()
+    
+    def inc(self, labels: tuple, amount: float = 1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+    
+    def render(self, metric_type: str = "counter") -> List[str]:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} {metric_type}"]
+        with self._lock:
+            for labels, value in self._values.items():
+                lines.append(f"{self.name}{format_labels(self.label_names, labels)} {value}")
+        return lines
+
+class Gauge(Counter):
+    def dec(self, labels: tuple, amount: float = 1):
+        self.inc(labels, -amount)
+    
+    def render(self, metric_type: str = "gauge") -> List[str]:
+        return super().render(metric_type)
+
+class Histogram:
+    def __init__(self, name: str, help_text: str, label_names: tuple, buckets: tuple):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = label_names
+        self.buckets = buckets
+        self._series = {}  # labels -> [per-bucket counts..., sum, count]
+        self._lock = threading.Lock()
+    
+    def observe(self, labels: tuple, value: float):
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                series = self._series[labels] = [0] * len(self.buckets) + [0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[i] += 1
+                    break
+            series[-2] += value
+            series[-1] += 1
+    
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            for labels, series in self._series.items():
+                cumulative = 0
+                for bound, count in zip(self.buckets, series):
+                    cumulative += count
+                    lines.append(f"{self.name}_bucket{format_labels(self.label_names, labels, str(bound))} {cumulative}")
+                lines.append(f"{self.name}_bucket{format_labels(self.label_names, labels, '+Inf')} {series[-1]}")
+                lines.append(f"{self.name}_sum{format_labels(self.label_names, labels)} {series[-2]}")
+                lines.append(f"{self.name}_count{format_labels(self.label_names, labels)} {series[-1]}")
+        return lines
+
+http_requests_total = Counter(
+    "http_requests_total", "HTTP requests by route and status", ("method", "route", "status")
+)
+http_request_duration_seconds = Histogram(
+    "http_request_duration_seconds", "HTTP request latency", ("method", "route"), LATENCY_BUCKETS
+)
+http_requests_in_flight = Gauge(
+    "http_requests_in_flight", "HTTP requests currently being served", ("method", "route")
+)
+http_response_size_bytes = Histogram(
+    "http_response_size_bytes", "HTTP response body size", ("method", "route"), SIZE_BUCKETS
+)
+mongo_command_duration_seconds = Histogram(
+    "mongo_command_duration_seconds", "MongoDB command latency", ("collection", "command"), LATENCY_BUCKETS
+)
+mongo_commands_failed_total = Counter(
+    "mongo_commands_failed_total", "MongoDB commands that returned an error", ("collection", "command")
+)
+admission_rejections_total = Counter(
+    "admission_rejections_total", "Requests rejected by rate or concurrency limits", ("limiter", "reason")
+)
+activity_logs_dropped_total = Counter(
+    "activity_logs_dropped_total", "Activity log events dropped because the write buffer was full", ()
+)
+METRICS = [
+    http_requests_total, http_request_duration_seconds, http_requests_in_flight, http_response_size_bytes,
+    mongo_command_duration_seconds, mongo_commands_failed_total, admission_rejections_total,
+    activity_logs_dropped_total,
+]
+
+def command_filter(command_name: str, command: dict):
+    """The part of a command worth logging when it is slow"""
+    if command_name in ("find", "count", "distinct", "findAndModify"):
+        return command.get('filter', command.get('query'))
+    if command_name == "aggregate":
+        return command.get('pipeline')
+    if command_name == "update" and command.get('updates'):
+        return command['updates'][0].get('q')
+    if command_name == "delete" and command.get('deletes'):
+        return command['deletes'][0].get('q')
+    return None
+
+class MongoCommandMetrics(monitoring.CommandListener):
+    def __init__(self):
+        self._pending = {}
+    
+    def started(self, event):
+        collection = event.command.get(event.command_name)
+        if event.command_name == "getMore":
+            collection = event.command.get('collection')
+        if not isinstance(collection, str):
+            collection = event.database_name
+        # Motor runs pymongo with a copy of the caller's context, so the request's profile is visible here
+        self._pending[(event.connection_id, event.request_id)] = (
+            collection, command_filter(event.command_name, event.command),
+            current_profile.get(), current_span_path.get()
+        )
+    
+    def succeeded(self, event):
+        self._finish(event, failed=False)
+    
+    def failed(self, event):
+        self._finish(event, failed=True)
+    
+    def _finish(self, event, failed: bool):
+        collection, query_filter, profile, span_path = self._pending.pop(
+            (event.connection_id, event.request_id), (None, None, None, None)
+        )
+        if collection is None:
+            return
+        labels = (collection, event.command_name)
+        duration = event.duration_micros / 1e6
+        mongo_command_duration_seconds.observe(labels, duration)
+        if profile is not None:
+            profile.record(
+                span_path + (f"mongo.{collection}.{event.command_name}",), time.perf_counter() - duration, duration
+            )
+        if failed:
+            mongo_commands_failed_total.inc(labels)
+        if duration * 1000 >= MONGO_SLOW_QUERY_MS:
+            logging.warning(
+                f"Slow MongoDB {event.command_name} on {collection} took {duration * 1000:.1f}ms, "
+                f"filter: {str(query_filter)[:500]}"
+            )
+
+mongo_command_metrics = MongoCommandMetrics()
+
+
+# ==================== PROFILING ====================
+# Opt-in per-request span breakdown. A request is profiled when it sends `X-Profile: 1` or is picked
+# by PROFILE_SAMPLE_RATE; otherwise `current_profile` is None and every span is a shared no-op.
+# The header and the /api/debug/profiles routes are only honoured with PROFILE_DEBUG=true, so clients
+# cannot make a production server profile their requests or read other requests' profiles.
+PROFILE_DEBUG = os.environ.get('PROFILE_DEBUG', 'false').lower() == 'true'
+PROFILE_SAMPLE_RATE = float(os.environ.get('PROFILE_SAMPLE_RATE', 0))
+PROFILE_HISTORY_SIZE = int(os.environ.get('PROFILE_HISTORY_SIZE', 200))
+# When set, every finished profile is also written there as <id>.folded (flamegraph.pl / speedscope input)
+PROFILE_DUMP_DIR = os.environ.get('PROFILE_DUMP_DIR')
+
+current_profile: ContextVar[Optional["RequestProfile"]] = ContextVar("current_profile", default=None)
+current_span_path: ContextVar[tuple] = ContextVar("current_span_path", default=())
+
+class RequestProfile:
+    def __init__(self, method: str, path: str):
+        self.id = str(uuid.uuid4())
+        self.method = method
+        self.path = path
+        self.route = path
+        self.started_at = datetime.now(timezone.utc)
+        self.start = time.perf_counter()
+        self.duration = None
+        self.spans = []  # (path, start offset, duration) in seconds
+        self.handler_start = None
+        self.handler_end = None
+    
+    def record(self, path: tuple, start: float, duration: float):
+        self.spans.append((path, start - self.start, duration))
+    
+    def finish(self):
+        self.duration = time.perf_counter() - self.start
+    
+    def summary(self) -> dict:
+        return {
+            "id": self.id,
+            "method": self.method,
+            "path": self.path,
+            "route": self.route,
+            "started_at": self.started_at.isoformat(),
+            "duration_ms": round(self.duration * 1000, 3) if self.duration is not None else None,
+        }
+    
+    def to_dict(self) -> dict:
+        return {
+            **self.summary(),
+            "spans": [
+                {"name": "/".join(path), "start_ms": round(start * 1000, 3), "duration_ms": round(duration * 1000, 3)}
+                for path, start, duration in sorted(self.spans, key=lambda span: span[1])
+            ],
+        }
+    
+    def folded(self) -> str:
+        """Collapsed stacks with self time in microseconds, one line per stack"""
+        totals = {}
+        for path, _, duration in self.spans:
+            totals[path] = totals.get(path, 0) + duration
+        root = (f"{self.method} {self.route}",)
+        self_times = {root: self.duration or 0}
+        for path, total in totals.items():
+            self_times[root + path] = self_times.get(root + path, 0) + total
+            parent = root + path[:-1]
+            self_times[parent] = self_times.get(parent, 0) - total
+        return "\n".join(
+            f"{';'.join(path)} {max(int(seconds * 1e6), 0)}" for path, seconds in self_times.items()
+        ) + "\n"
+
+class ProfileSpan:
+    def __init__(self, profile: RequestProfile, name: str):
+        self.profile = profile
+        self.name = name
+    
+    def __enter__(self):
+        self.path = current_span_path.get() + (self.name,)
+        self.token = current_span_path.set(self.path)
+        self.start = time.perf_counter()
+        return self
+    
+    def __exit__(self, *exc_info):
+        self.profile.record(self.path, self.start, time.perf_counter() - self.start)
+        current_span_path.reset(self.token)
+        return False
+
+class NullSpan:
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, *exc_info):
+        return False
+
+NULL_SPAN = NullSpan()
+
+def profile_span(name: str):
+    profile = current_profile.get()
+    if profile is None:
+        return NULL_SPAN
+    return ProfileSpan(profile, name)
+
+def profiled(name: str):
+    """Decorator recording every call of a function, sync or async, as a profile span"""
+    def decorator(func):
+        if asyncio.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                with profile_span(name):
+                    return await func(*args, **kwargs)
+            return async_wrapper
+        
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with profile_span(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+recent_profiles = deque(maxlen=PROFILE_HISTORY_SIZE)
+
+class ProfiledRoute(APIRoute):
+    """Splits a profiled request into validation, handler and serialization time.
+    FastAPI validates before calling the endpoint and encodes the response after it returns,
+    so the endpoint's start and end timestamps delimit the three phases."""
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        endpoint = self.dependant.call
+        if asyncio.iscoroutinefunction(endpoint):
+            async def timed_endpoint(**values):
+                profile = current_profile.get()
+                if profile is None:
+                    return await endpoint(**values)
+                profile.handler_start = time.perf_counter()
+                try:
+                    with ProfileSpan(profile, "handler"):
+                        return await endpoint(**values)
+                finally:
+                    profile.handler_end = time.perf_counter()
+            self.dependant.call = timed_endpoint
+    
+    def get_route_handler(self):
+        route_handler = super().get_route_handler()
+        route_path = self.path
+        
+        async def profiled_route_handler(request: Request):
+            profile = current_profile.get()
+            if profile is None:
+                return await route_handler(request)
+            profile.route = route_path
+            start = time.perf_counter()
+            response = await route_handler(request)
+            end = time.perf_counter()
+            if profile.handler_start is not None:
+                profile.record(("validation",), start, profile.handler_start - start)
+                profile.record(("serialization",), profile.handler_end, end - profile.handler_end)
+            return response
+        
+        return profiled_route_handler
+
+
 # MongoDB connection
+def env_int(name: str) -> Optional[int]:
+    value = os.environ.get(name)
+    return int(value) if value else None
+
+def parse_write_concern(value: str) -> WriteConcern:
+    return WriteConcern(w=int(value) if value.isdigit() else value)
+
+READ_PREFERENCE_MODES = {
+    "primary": Primary,
+    "primaryPreferred": PrimaryPreferred,
+    "secondary": Secondary,
+    "secondaryPreferred": SecondaryPreferred,
+    "nearest": Nearest,
+}
+
+def parse_read_preference(mode: str, max_staleness_seconds: int):
+    if mode == "primary":
+        return Primary()
+    # The server requires at least 90 seconds; -1 means no staleness bound
+    return READ_PREFERENCE_MODES[mode](max_staleness=max_staleness_seconds)
+
+# Pool and timeout settings; unset variables keep the driver defaults. The pool is per process,
+# so a deployment opens up to (uvicorn workers x MONGO_MAX_POOL_SIZE) connections.
+MONGO_CLIENT_OPTIONS = {
+    option: value for option, value in {
+        "maxPoolSize": env_int('MONGO_MAX_POOL_SIZE'),
+        "minPoolSize": env_int('MONGO_MIN_POOL_SIZE'),
+        "maxIdleTimeMS": env_int('MONGO_MAX_IDLE_TIME_MS'),
+        "maxConnecting": env_int('MONGO_MAX_CONNECTING'),
+        "waitQueueTimeoutMS": env_int('MONGO_WAIT_QUEUE_TIMEOUT_MS'),
+        "connectTimeoutMS": env_int('MONGO_CONNECT_TIMEOUT_MS'),
+        "socketTimeoutMS": env_int('MONGO_SOCKET_TIMEOUT_MS'),
+        "serverSelectionTimeoutMS": env_int('MONGO_SERVER_SELECTION_TIMEOUT_MS'),
+        # e.g. "zstd,snappy,zlib"; zstd needs the zstandard package and snappy python-snappy
+        "compressors": os.environ.get('MONGO_COMPRESSORS'),
+        "appname": os.environ.get('MONGO_APP_NAME', 'factory-management'),
+    }.items() if value is not None
+}
+
 mongo_url = os.environ['MONGO_URL']
-client = AsyncIOMotorClient(mongo_url)
+client = AsyncIOMotorClient(mongo_url, event_listeners=[mongo_command_metrics], **MONGO_CLIENT_OPTIONS)
 db = client[os.environ['DB_NAME']]
+# Multi-document transactions need a replica set or a sharded cluster. "auto" asks the server at startup
+# (see detect_transaction_support); "true" or "false" forces the mode.
+MONGO_TRANSACTIONS_MODE = os.environ.get('MONGO_TRANSACTIONS', 'auto').lower()
+MONGO_TRANSACTIONS = MONGO_TRANSACTIONS_MODE == 'true'
+# Server error codes handled explicitly
+DUPLICATE_KEY = 11000
+NAMESPACE_EXISTS = 48
+
+# Route classes. Reads: see ReadClass. Writes: business records (orders, production, QC, task
+# completions) wait for a majority; high-volume derived data (activity logs) only needs the
+# primary's acknowledgement.
+class ReadClass(str, Enum):
+    PRIMARY = "primary"  # chat history and read-after-write paths
+    LIST = "list"  # large reference and list routes
+    ANALYTICS = "analytics"  # dashboards, reports and exports
+
+READ_DATABASES = {
+    ReadClass.PRIMARY: db,
+    ReadClass.LIST: client.get_database(
+        os.environ['DB_NAME'],
+        read_preference=parse_read_preference(
+            os.environ.get('MONGO_LIST_READ_PREFERENCE', 'secondaryPreferred'),
+            int(os.environ.get('MONGO_LIST_MAX_STALENESS_SECONDS', 90))
+        )
+    ),
+    ReadClass.ANALYTICS: client.get_database(
+        os.environ['DB_NAME'],
+        read_preference=parse_read_preference(
+            os.environ.get('MONGO_ANALYTICS_READ_PREFERENCE', 'secondaryPreferred'),
+            int(os.environ.get('MONGO_ANALYTICS_MAX_STALENESS_SECONDS', 300))
+        )
+    ),
+}
+CRITICAL_WRITE_CONCERN = parse_write_concern(os.environ.get('MONGO_CRITICAL_WRITE_CONCERN', 'majority'))
+BULK_WRITE_CONCERN = parse_write_concern(os.environ.get('MONGO_BULK_WRITE_CONCERN', '1'))
+critical_db = db.with_options(write_concern=CRITICAL_WRITE_CONCERN)
+bulk_db = db.with_options(write_concern=BULK_WRITE_CONCERN)
+
+# Identifies this process when several uvicorn workers share background job leases
+WORKER_ID = f"{os.uname().nodename}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+HEALTH_CHECK_TIMEOUT_SECONDS = float(os.environ.get('HEALTH_CHECK_TIMEOUT_SECONDS', 2))
+shutting_down = False
 
 # Create the main app without a prefix
 app = FastAPI(
@@ -29,7 +467,7 @@ app = FastAPI(
 )
 
 # Create a router with the /api prefix
-api_router = APIRouter(prefix="/api")
+api_router = APIRouter(prefix="/api", route_class=ProfiledRoute)
 
 
 # ==================== ENUMS ====================
@@ -47,6 +485,11 @@ class ProductionStage(str, Enum):
     QUALITY_CHECK = "quality_check"
     PACKAGING = "packaging"
 
+class StageStatus(str, Enum):
+    PENDING = "pending"
+    IN_PROGRESS = "in_progress"
+    COMPLETED = "completed"
+
 class QCStatus(str, Enum):
     PASSED = "passed"
     FAILED = "failed"
@@ -63,6 +506,14 @@ class TaskPriority(str, Enum):
     HIGH = "high"
     URGENT = "urgent"
 
+# Numeric rank stored alongside `priority` so tasks can be sorted by urgency in an index
+PRIORITY_RANK = {
+    TaskPriority.LOW: 1,
+    TaskPriority.MEDIUM: 2,
+    TaskPriority.HIGH: 3,
+    TaskPriority.URGENT: 4,
+}
+
 class MessageType(str, Enum):
     TEXT = "text"
     TASK_NOTIFICATION = "task_notification"
@@ -76,6 +527,20 @@ class NotificationType(str, Enum):
     TASK_OVERDUE = "task_overdue"
     TASK_UPDATED = "task_updated"
 
+class PresenceStatus(str, Enum):
+    ONLINE = "online"
+    AWAY = "away"
+    OFFLINE = "offline"
+
+class SyncOperationType(str, Enum):
+    UPDATE_TASK = "update_task"
+    UPDATE_SUBTASK = "update_subtask"
+    CREATE_TIME_LOG = "create_time_log"
+    CREATE_TASK_COMMENT = "create_task_comment"
+    MARK_MESSAGE_READ = "mark_message_read"
+    MARK_GROUP_MESSAGE_READ = "mark_group_message_read"
+    MARK_NOTIFICATION_READ = "mark_notification_read"
+
 
 # ==================== MODELS ====================
 
@@ -109,6 +574,8 @@ class Order(BaseModel):
     notes: Optional[str] = ""
     created_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
     updated_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
+    transitions: List[dict] = []  # {"from", "to", "at"} for every status change
+    version: int = 1  # Bumped on every update; send it back in If-Match to update conditionally
 
 
 # Production Models
@@ -116,6 +583,8 @@ class ProductionStageCreate(BaseModel):
     order_id: str
     stage: ProductionStage
     assigned_worker_id: Optional[str] = None
+    auto_assign: bool = False  # Assign the least-loaded worker of the stage's department
+    required_skills: List[str] = []  # For auto_assign
     notes: Optional[str] = ""
 
 class ProductionStageRecord(BaseModel):
@@ -125,11 +594,13 @@ class ProductionStageRecord(BaseModel):
     order_id: str
     stage: ProductionStage
     assigned_worker_id: Optional[str] = None
-    status: str = "pending"  # pending, in_progress, completed
+    status: StageStatus = StageStatus.PENDING
     started_at: Optional[datetime] = None
     completed_at: Optional[datetime] = None
     notes: Optional[str] = ""
     created_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
+    transitions: List[dict] = []  # {"from", "to", "at"} for every status change
+    version: int = 1
 
 
 # Material Models
@@ -154,6 +625,7 @@ class Material(BaseModel):
     supplier_id: Optional[str] = None
     unit_price: float
     last_updated: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
+    version: int = 1
 
 
 # Supplier Models
@@ -222,8 +694,10 @@ class QualityCheck(BaseModel):
 class TaskCreate(BaseModel):
     title: str
     description: str
-    assigned_to: str
+    assigned_to: Optional[str] = None  # Required unless auto_assign is set
     department: str
+    auto_assign: bool = False  # Assign the least-loaded active worker in `department` when assigned_to is empty
+    required_skills: List[str] = []  # For auto_assign
     priority: TaskPriority = TaskPriority.MEDIUM
     due_date: Optional[str] = None
     tags: List[str] = []
@@ -264,6 +738,7 @@ class Task(BaseModel):
     created_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
     completed_at: Optional[datetime] = None
     created_by: Optional[str] = None
+    version: int = 1
 
 
 # Conversation Models (1-on-1 Chat)
@@ -281,6 +756,8 @@ class Conversation(BaseModel):
     participant1_name: str
     participant2_id: str
     participant2_name: str
+    participants: List[str] = []  # Both participant ids, sorted
+    participant_key: Optional[str] = None  # Canonical "id1:id2" pair key, unique per conversation
     last_message: Optional[str] = None
     last_message_at: Optional[datetime] = None
     created_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
@@ -327,6 +804,7 @@ class GroupChat(BaseModel):
     description: str
     department: Optional[str] = None
     members: List[dict]
+    member_count: int = 0
     created_by: str
     last_message: Optional[str] = None
     last_message_at: Optional[datetime] = None
@@ -498,19 +976,51 @@ class ActivityLog(BaseModel):
     created_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
 
 
+# Offline Sync Models
+class SyncOperation(BaseModel):
+    op_id: str  # Client-generated, unique per operation; replays reuse it
+    type: SyncOperationType
+    data: dict  # The body and path parameters of the route this operation stands in for
+
+class SyncRequest(BaseModel):
+    client_id: str
+    user_id: str
+    since: Optional[str] = None  # sync_token from the previous response; omitted on first sync
+    operations: List[SyncOperation] = []
+
+
+# Presence Models
+class PresenceHeartbeat(BaseModel):
+    user_id: str
+    user_name: str
+    department: Optional[str] = None
+    status: PresenceStatus = PresenceStatus.ONLINE
+
+class TypingUpdate(BaseModel):
+    channel: str  # "conversation:<id>" or "group:<id>"
+    user_id: str
+    user_name: str
+    typing: bool = True
+
+
 # ==================== HELPER FUNCTIONS ====================
 def serialize_datetime(obj):
     if isinstance(obj, datetime):
         return obj.isoformat()
     return obj
 
+@profiled("serialize_doc")
 def serialize_doc(doc):
     if doc:
         for key, value in doc.items():
             if isinstance(value, datetime):
                 doc[key] = value.isoformat()
+            elif isinstance(value, Enum):
+                # Stored as the value either way; this keeps the in-memory doc (counter keys, rollup ids) the same
+                doc[key] = value.value
     return doc
 
+@profiled("deserialize_doc")
 def deserialize_doc(doc):
     datetime_fields = ['created_at', 'updated_at', 'started_at', 'completed_at', 'checked_at', 'last_updated', 'joined_date', 'logged_at', 'uploaded_at']
     if doc:
@@ -519,9 +1029,282 @@ def deserialize_doc(doc):
                 doc[field] = datetime.fromisoformat(doc[field])
     return doc
 
+def as_utc(value) -> datetime:
+    """A datetime or ISO string as an aware UTC datetime; naive values are taken to be UTC"""
+    moment = datetime.fromisoformat(value) if isinstance(value, str) else value
+    if moment.tzinfo is None:
+        moment = moment.replace(tzinfo=timezone.utc)
+    return moment.astimezone(timezone.utc)
+
+def iso_bound(value: str) -> str:
+    """A date or datetime query parameter as a UTC ISO string comparable with stored timestamps"""
+    try:
+        return as_utc(value).isoformat()
+    except ValueError:
+        raise HTTPException(status_code=400, detail=f"Invalid date: {value}")
+
+
+# Helper function to run multi-document writes atomically
+async def run_in_transaction(callback, session=None):
+    """Run `callback(session)` inside a transaction, retried on transient errors, on `session` if given.
+    Transactions need a replica set; on a standalone mongod the callback runs outside one."""
+    if not MONGO_TRANSACTIONS:
+        return await callback(session)
+    if session is not None:
+        return await session.with_transaction(callback, write_concern=CRITICAL_WRITE_CONCERN)
+    async with await client.start_session() as session:
+        return await session.with_transaction(callback, write_concern=CRITICAL_WRITE_CONCERN)
+
+async def detect_transaction_support():
+    global MONGO_TRANSACTIONS
+    if MONGO_TRANSACTIONS_MODE == 'auto':
+        hello = await client.admin.command("hello")
+        MONGO_TRANSACTIONS = 'setName' in hello or hello.get('msg') == 'isdbgrid'
+    if MONGO_TRANSACTIONS:
+        logging.info(f"MongoDB transactions enabled (MONGO_TRANSACTIONS={MONGO_TRANSACTIONS_MODE})")
+    else:
+        logging.warning(
+            f"MongoDB transactions disabled (MONGO_TRANSACTIONS={MONGO_TRANSACTIONS_MODE}): multi-document "
+            f"writes run without a transaction, which is only safe on a standalone development mongod"
+        )
+
+
+# Read routing. Routes declare their read class with `reader: ReadContext = Depends(read_context(...))`.
+# Writes to secondary-read collections return an `X-Read-After` token (the session's operation time);
+# a client that sends it back gets a causally consistent read that waits for the secondary to catch up.
+# Secondary reads of one request share a causal session either way, so a later read (the list after
+# conditional_get's version) never comes from a secondary that is behind an earlier one.
+class ReadContext:
+    def __init__(self, database, session=None, read_after: Optional[Timestamp] = None):
+        self.db = database
+        self.session = session
+        self.read_after = read_after
+
+def format_read_after(operation_time: Timestamp) -> str:
+    return f"{operation_time.time}.{operation_time.inc}"
+
+def parse_read_after(token: str) -> Optional[Timestamp]:
+    try:
+        time_part, inc_part = token.split(".")
+        return Timestamp(int(time_part), int(inc_part))
+    except ValueError:
+        return None
+
+@functools.cache
+def read_context(read_class: ReadClass):
+    # Cached so a route and its conditional_get() share one dependency, and so one session
+    async def dependency(request: Request):
+        database = READ_DATABASES[read_class]
+        read_after = parse_read_after(request.headers.get('x-read-after', ''))
+        if read_class == ReadClass.PRIMARY:
+            yield ReadContext(database)
+            return
+        async with await client.start_session(causal_consistency=True) as session:
+            if read_after is not None:
+                session.advance_operation_time(read_after)
+            yield ReadContext(database, session, read_after)
+    
+    return dependency
+
+async def causal_write_session():
+    async with await client.start_session(causal_consistency=True) as session:
+        yield session
+
+def set_read_after(response: Response, session):
+    # Standalone servers report no operation time, and their reads never lag anyway
+    if session.operation_time is not None:
+        response.headers['X-Read-After'] = format_read_after(session.operation_time)
+
+
+# Conditional GETs for reference lists. Every write to a cached collection bumps its counter in
+# collection_versions; the list's ETag is that version plus the query string, so a client that sends
+# a matching If-None-Match gets a 304 before the list query runs. Versions are cached per worker for
+# COLLECTION_VERSION_CACHE_SECONDS, which keeps repeat loads off MongoDB entirely but lets another
+# worker's write go unseen for that long. Reads carrying X-Read-After always check the version.
+# The version is read on the request's causal session (a cached one moves the session up to the
+# operation time it was read at), so the list that follows is at least as new as its ETag claims.
+COLLECTION_VERSION_CACHE_SECONDS = float(os.environ.get('COLLECTION_VERSION_CACHE_SECONDS', 1.0))
+REFERENCE_CACHE_CONTROL = os.environ.get('REFERENCE_CACHE_CONTROL', 'private, no-cache')
+# collection -> (version, fetched_at, operation time of the read)
+collection_version_cache: Dict[str, Tuple[int, float, Optional[Timestamp]]] = {}
+
+async def bump_collection_version(collection: str, session=None):
+    # Called after the write itself, so a reader that sees the new version also sees the write
+    await db.collection_versions.update_one(
+        {"_id": collection}, {"$inc": {"version": 1}}, upsert=True, session=session
+    )
+
+async def collection_version(collection: str, reader: ReadContext) -> int:
+    cached = collection_version_cache.get(collection)
+    if reader.read_after is None and cached and time.monotonic() - cached[1] < COLLECTION_VERSION_CACHE_SECONDS:
+        version, _, operation_time = cached
+        if reader.session is not None and operation_time is not None:
+            reader.session.advance_operation_time(operation_time)
+        return version
+    doc = await reader.db.collection_versions.find_one({"_id": collection}, session=reader.session)
+    version = doc['version'] if doc else 0
+    operation_time = reader.session.operation_time if reader.session is not None else None
+    collection_version_cache[collection] = (version, time.monotonic(), operation_time)
+    return version
+
+def etag_matches(if_none_match: str, etag: str) -> bool:
+    # If-None-Match uses weak comparison, so W/ prefixes are ignored
+    candidates = [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]
+    return "*" in candidates or etag in candidates
+
+def conditional_get(collection: str, read_class: ReadClass = ReadClass.LIST, activity=None):
+    """`activity(request, reader)` folds state that changes too often for the shared counter, such as a
+    group's last message, into the ETag; it is read on every request"""
+    async def dependency(request: Request, response: Response,
+                         reader: ReadContext = Depends(read_context(read_class))):
+        version = await collection_version(collection, reader)
+        if activity is not None:
+            version = f"{version}.{await activity(request, reader)}"
+        query_digest = hashlib.sha1(str(sorted(request.query_params.multi_items())).encode()).hexdigest()[:12]
+        headers = {"ETag": f'"{collection}-{version}-{query_digest}"', "Cache-Control": REFERENCE_CACHE_CONTROL}
+        if etag_matches(request.headers.get('if-none-match', ''), headers['ETag']):
+            raise HTTPException(status_code=304, headers=headers)
+        response.headers.update(headers)
+    
+    return dependency
+
+
+# Field projection: `fields=title,status` goes straight into the Mongo projection, so attachment data
+# URLs and member arrays are never read unless asked for. Projected rows are returned as stored,
+# skipping the response model, which would reject them for missing required fields.
+def field_projection(fields: Optional[str], model) -> Optional[dict]:
+    if not fields:
+        return None
+    names = {name.strip() for name in fields.split(",") if name.strip()}
+    unknown = names - set(model.model_fields)
+    if unknown:
+        raise HTTPException(status_code=400, detail=f"Unknown fields: {', '.join(sorted(unknown))}")
+    return {"_id": 0, "id": 1, **{name: 1 for name in names}}
+
+
+# Idempotency keys. A create route that takes `idempotency: IdempotencyKey = Depends(idempotency_key(...))`
+# claims the client's Idempotency-Key before doing any work and stores its response afterwards; a retry
+# with the same key gets the stored response back instead of creating a second record. Keys expire after
+# IDEMPOTENCY_KEY_TTL_HOURS; a claim whose request died mid-way is taken over after
+# IDEMPOTENCY_PENDING_TIMEOUT_SECONDS.
+# The response is only stored once the request is done, so a retry that takes over a claim (its request
+# was slow or died after the insert) could create the record again. The record's id is therefore derived
+# from the key: the retry finds the record already created and returns it, and a unique id index turns
+# away a second insert racing the first.
+IDEMPOTENCY_KEY_TTL_HOURS = int(os.environ.get('IDEMPOTENCY_KEY_TTL_HOURS', 24))
+IDEMPOTENCY_PENDING_TIMEOUT_SECONDS = int(os.environ.get('IDEMPOTENCY_PENDING_TIMEOUT_SECONDS', 60))
+IDEMPOTENCY_ID_NAMESPACE = uuid.UUID("6f1c2a3e-9d4b-4e8a-b7c5-2f0d8e1a9b36")
+
+class IdempotentReplay(Exception):
+    def __init__(self, record: dict):
+        self.record = record
+
+class IdempotencyKey:
+    def __init__(self, record_id: Optional[str], status_code: int = 200):
+        self.record_id = record_id
+        self.status_code = status_code  # The route's success status
+    
+    def new_id(self) -> str:
+        """Id for the record the request creates, the same for every request with this key"""
+        if not self.record_id:
+            return str(uuid.uuid4())
+        return str(uuid.uuid5(IDEMPOTENCY_ID_NAMESPACE, self.record_id))
+    
+    async def created(self, collection) -> Optional[dict]:
+        """The record an earlier request with this key already created, if any"""
+        if not self.record_id:
+            return None
+        return await collection.find_one({"id": self.new_id()}, {"_id": 0})
+    
+    async def save(self, result, response: Optional[Response] = None):
+        if self.record_id:
+            status_code = response.status_code if response is not None and response.status_code else self.status_code
+            await db.idempotency_keys.update_one(
+                {"_id": self.record_id},
+                {"$set": {"status": "completed", "status_code": status_code, "body": jsonable_encoder(result)}}
+            )
+        return result
+
+def idempotency_key(scope: str):
+    async def dependency(request: Request):
+        key = request.headers.get('idempotency-key')
+        if not key:
+            yield IdempotencyKey(None)
+            return
+        if len(key) > 255:
+            raise HTTPException(status_code=400, detail="Idempotency-Key is too long")
+        
+        record_id = f"{scope}:{key}"
+        fingerprint = hashlib.sha256(request.url.path.encode() + await request.body()).hexdigest()
+        now = datetime.now(timezone.utc)
+        try:
+            await db.idempotency_keys.insert_one(
+                {"_id": record_id, "fingerprint": fingerprint, "status": "pending", "created_at": now}
+            )
+        except DuplicateKeyError:
+            record = await db.idempotency_keys.find_one({"_id": record_id})
+            if record and record['fingerprint'] != fingerprint:
+                raise HTTPException(status_code=422, detail="Idempotency-Key was already used for a different request")
+            if record and record['status'] == "completed":
+                raise IdempotentReplay(record)
+            abandoned = await db.idempotency_keys.find_one_and_update(
+                {"_id": record_id, "status": "pending",
+                 "created_at": {"$lt": now - timedelta(seconds=IDEMPOTENCY_PENDING_TIMEOUT_SECONDS)}},
+                {"$set": {"created_at": now}}
+            )
+            if not abandoned:
+                raise HTTPException(status_code=409, detail="A request with this Idempotency-Key is still in progress",
+                                    headers=retry_after_header(1))
+        
+        route = next((route for route in request.app.router.routes
+                      if getattr(route, 'endpoint', None) is request.scope.get('endpoint')), None)
+        try:
+            yield IdempotencyKey(record_id, getattr(route, 'status_code', None) or 200)
+        except Exception:
+            # Nothing was stored, so a retry with the same key runs the request again
+            await db.idempotency_keys.delete_one({"_id": record_id, "status": "pending"})
+            raise
+    
+    return dependency
+
+
+# Optimistic concurrency. Tasks, orders, materials and production stages carry a `version` that every
+# update increments. An update sent with `If-Match: "<version>"` only applies to that version and
+# fails with 412 when someone else updated the record first; without If-Match it applies as before.
+# The new version comes back in the ETag header.
+def if_match_version(request: Request) -> Optional[int]:
+    value = request.headers.get('if-match', '').strip()
+    if not value or value == "*":
+        return None
+    try:
+        return int(value.removeprefix("W/").strip('"'))
+    except ValueError:
+        raise HTTPException(status_code=400, detail="If-Match must be a record version")
+
+async def versioned_update(collection, doc_id: str, update_data: dict, expected_version: Optional[int],
+                           not_found: str, session=None, expected_status: Optional[str] = None,
+                           push: Optional[dict] = None) -> dict:
+    """Apply the update and return the record as it was before it, with `version` set to the new version.
+    With `expected_status` the update only applies while the record is still in that status."""
+    query = {"id": doc_id}
+    if expected_version is not None:
+        query['version'] = expected_version
+    if expected_status is not None:
+        query['status'] = expected_status
+    update = {"$set": update_data, "$inc": {"version": 1}}
+    if push:
+        update['$push'] = push
+    previous = await collection.find_one_and_update(query, update, projection={"_id": 0}, session=session)
+    if previous:
+        return {**previous, "version": previous.get('version', 0) + 1}
+    if len(query) > 1 and await collection.count_documents({"id": doc_id}, limit=1, session=session):
+        raise HTTPException(status_code=412 if expected_version is not None else 409,
+                            detail="Record was modified by another request")
+    raise HTTPException(status_code=404, detail=not_found)
+
 
 # Helper function to log task activities
-async def log_activity(task_id: str, user_id: str, user_name: str, action: str, details: str):
+async def log_activity(task_id: str, user_id: str, user_name: str, action: str, details: str, session=None):
     activity = ActivityLog(
         task_id=task_id,
         user_id=user_id,
@@ -531,11 +1314,16 @@ async def log_activity(task_id: str, user_id: str, user_name: str, action: str,
     )
     doc = activity.model_dump()
     doc = serialize_doc(doc)
-    await db.activity_logs.insert_one(doc)
+    if session:
+        # Part of a transaction, so it cannot be deferred to the buffered writer
+        await db.activity_logs.insert_one(doc, session=session)
+    else:
+        await activity_writer.write(doc)
 
 
 # Helper function to send task notifications
-async def send_task_notification(task_data: dict, notification_type: str, recipients: List[dict]):
+@profiled("send_task_notification")
+async def send_task_notification(task_data: dict, notification_type: str, recipients: List[dict], session=None):
     """Send task notifications to specified recipients"""
     for recipient in recipients:
         try:
@@ -566,37 +1354,1858 @@ async def send_task_notification(task_data: dict, notification_type: str, recipi
             
             doc = notification.model_dump()
             doc = serialize_doc(doc)
-            await db.task_notifications.insert_one(doc)
+            await db.task_notifications.insert_one(doc, session=session)
+            await inbox_add_notification(doc, session=session)
             
         except Exception as e:
+            if session is not None:
+                # Inside a transaction the failure must abort it (and let transient errors retry)
+                raise
             logging.error(f"Failed to send notification to {recipient.get('user_name', 'unknown')}: {str(e)}")
 
 
+def conversation_participant_key(user1_id: str, user2_id: str) -> str:
+    return ":".join(sorted([user1_id, user2_id]))
+
 # Helper function to get conversation between two users
 async def get_or_create_conversation(user1_id: str, user1_name: str, user2_id: str, user2_name: str):
-    """Get existing conversation or create new one"""
-    # Check if conversation exists (either direction)
-    conversation = await db.conversations.find_one({
-        "$or": [
-            {"participant1_id": user1_id, "participant2_id": user2_id},
-            {"participant1_id": user2_id, "participant2_id": user1_id}
-        ]
-    }, {"_id": 0})
-    
-    if conversation:
-        return deserialize_doc(conversation)
-    
-    # Create new conversation
+    """Get existing conversation or create new one with a single atomic upsert"""
+    participant_key = conversation_participant_key(user1_id, user2_id)
     new_conversation = Conversation(
         participant1_id=user1_id,
         participant1_name=user1_name,
         participant2_id=user2_id,
-        participant2_name=user2_name
+        participant2_name=user2_name,
+        participants=sorted([user1_id, user2_id]),
+        participant_key=participant_key
     )
     doc = new_conversation.model_dump()
     doc = serialize_doc(doc)
-    await db.conversations.insert_one(doc)
-    return new_conversation.model_dump()
+    doc.pop('participant_key')  # Set from the upsert filter
+    
+    try:
+        conversation = await db.conversations.find_one_and_update(
+            {"participant_key": participant_key},
+            {"$setOnInsert": doc},
+            upsert=True,
+            projection={"_id": 0},
+            return_document=ReturnDocument.AFTER
+        )
+    except DuplicateKeyError:
+        # Lost an upsert race the server did not retry; the winner's document is there now
+        conversation = await db.conversations.find_one({"participant_key": participant_key}, {"_id": 0})
+    
+    if conversation['id'] == new_conversation.id:
+        await inbox_upsert_conversation(conversation)
+    return deserialize_doc(conversation)
+
+async def merge_duplicate_conversations() -> int:
+    """Fold conversations that share a participant pair into the oldest one, moving their messages
+    across, so the unique participant_key index can be built. Returns how many were merged away."""
+    merged = 0
+    duplicate_pairs = db.conversations.aggregate([
+        {"$group": {"_id": "$participant_key", "count": {"$sum": 1}, "ids": {"$push": "$id"}}},
+        {"$match": {"count": {"$gt": 1}}},
+    ], allowDiskUse=True)
+    async for pair in duplicate_pairs:
+        conversations = await db.conversations.find({"id": {"$in": pair['ids']}}, {"_id": 0}).to_list(None)
+        conversations.sort(key=lambda conv: serialize_datetime(conv.get('created_at')) or "")
+        keeper, duplicate_ids = conversations[0], [conv['id'] for conv in conversations[1:]]
+        latest = max(conversations, key=lambda conv: serialize_datetime(conv.get('last_message_at')) or "")
+        for collection in ("messages", "messages_archive"):
+            await db[collection].update_many(
+                {"conversation_id": {"$in": duplicate_ids}}, {"$set": {"conversation_id": keeper['id']}}
+            )
+        last_message = {"last_message": latest.get('last_message'), "last_message_at": latest.get('last_message_at')}
+        await db.conversations.update_one({"id": keeper['id']}, {"$set": last_message})
+        await db.user_inboxes.update_many(
+            {"conversations.id": {"$in": duplicate_ids}},
+            {"$pull": {"conversations": {"id": {"$in": duplicate_ids}}}, "$inc": {"version": 1}}
+        )
+        await inbox_upsert_conversation({**keeper, **last_message})
+        await db.conversations.delete_many({"id": {"$in": duplicate_ids}})
+        merged += len(duplicate_ids)
+    return merged
+
+
+# ==================== ACTIVITY LOG WRITER ====================
+# "buffered" keeps the audit write off the request path: events are queued in memory and written
+# with insert_many once ACTIVITY_LOG_FLUSH_SIZE events are waiting or every flush interval.
+# "sync" inserts each event before the request returns.
+ACTIVITY_LOG_MODE = os.environ.get('ACTIVITY_LOG_MODE', 'buffered')
+ACTIVITY_LOG_FLUSH_SIZE = int(os.environ.get('ACTIVITY_LOG_FLUSH_SIZE', 500))
+ACTIVITY_LOG_FLUSH_INTERVAL_SECONDS = float(os.environ.get('ACTIVITY_LOG_FLUSH_INTERVAL_SECONDS', 1.0))
+ACTIVITY_LOG_MAX_BUFFER = int(os.environ.get('ACTIVITY_LOG_MAX_BUFFER', 10000))
+
+class ActivityLogWriter:
+    def __init__(self, mode: str, flush_size: int, flush_interval: float, max_buffer: int):
+        self.mode = mode
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self.max_buffer = max_buffer
+        self.buffer: List[dict] = []
+        self.in_flight: List[dict] = []
+        self.dropped = 0
+        self.healthy = True  # False while the last flush failed
+        self._flush_lock = asyncio.Lock()
+        self._pending_flushes = set()
+    
+    async def write(self, doc: dict):
+        if self.mode == "sync":
+            await bulk_db.activity_logs.insert_one(doc)
+            return
+        
+        if len(self.buffer) >= self.max_buffer and self.healthy:
+            # Bounded buffer: the caller waits for a flush instead of the buffer growing without limit
+            await self.flush()
+        if len(self.buffer) >= self.max_buffer:
+            # The database is not taking writes; drop rather than hold requests or grow the buffer
+            self.drop(1)
+            return
+        self.buffer.append(doc)
+        if len(self.buffer) >= self.flush_size:
+            flush = asyncio.create_task(self.flush())
+            self._pending_flushes.add(flush)
+            flush.add_done_callback(self._pending_flushes.discard)
+    
+    def drop(self, count: int):
+        before = self.dropped
+        self.dropped += count
+        activity_logs_dropped_total.inc((), count)
+        if before == 0 or before // 1000 != self.dropped // 1000:
+            logging.warning(f"Activity log buffer is full, {self.dropped} events dropped so far")
+    
+    async def flush(self):
+        async with self._flush_lock:
+            while self.buffer:
+                self.in_flight = self.buffer[:self.flush_size]
+                self.buffer = self.buffer[self.flush_size:]
+                retry = []
+                try:
+                    await bulk_db.activity_logs.insert_many(self.in_flight, ordered=False)
+                except BulkWriteError as e:
+                    # Rows without an error were inserted. A duplicate key means an earlier attempt already
+                    # wrote the row: insert_many gave each event its _id, which is kept for the retry.
+                    retry = [
+                        self.in_flight[error['index']] for error in e.details.get('writeErrors', [])
+                        if error['code'] != DUPLICATE_KEY
+                    ]
+                    if retry:
+                        logging.error(f"Failed to write {len(retry)} of {len(self.in_flight)} activity logs: {str(e)}")
+                except Exception as e:
+                    logging.error(f"Failed to flush {len(self.in_flight)} activity logs: {str(e)}")
+                    retry = self.in_flight
+                finally:
+                    self.in_flight = []
+                self.healthy = not retry
+                if retry:
+                    # Keep the events for the next flush, as far as the buffer has room for them
+                    self.buffer[:0] = retry
+                    overflow = len(self.buffer) - self.max_buffer
+                    if overflow > 0:
+                        del self.buffer[-overflow:]
+                        self.drop(overflow)
+                    break
+    
+    def discard_task(self, task_id: str):
+        self.buffer = [doc for doc in self.buffer if doc['task_id'] != task_id]
+    
+    def pending_for_task(self, task_id: str) -> List[dict]:
+        """Buffered events for a task, so activity reads do not lag behind the buffer"""
+        return [
+            {key: value for key, value in doc.items() if key != '_id'}
+            for doc in self.in_flight + self.buffer if doc['task_id'] == task_id
+        ]
+    
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
+
+activity_writer = ActivityLogWriter(
+    ACTIVITY_LOG_MODE, ACTIVITY_LOG_FLUSH_SIZE, ACTIVITY_LOG_FLUSH_INTERVAL_SECONDS, ACTIVITY_LOG_MAX_BUFFER
+)
+
+
+# ==================== USER INBOX (materialized "My work" view) ====================
+# One document per user in `user_inboxes`, kept current by the write paths so the home screen
+# is a single indexed read. Writes only touch inboxes that already exist; an inbox is built from
+# the source collections the first time it is read. Every write bumps the inbox's version; a rebuild
+# only replaces the version it started from, so writes landing during its reads are not lost.
+INBOX_TASK_LIMIT = 100
+INBOX_REBUILD_ATTEMPTS = 3
+INBOX_NOTIFICATION_LIMIT = 20
+INBOX_CONVERSATION_LIMIT = 30
+
+def inbox_task_summary(task: dict) -> dict:
+    return {
+        "id": task['id'],
+        "title": task['title'],
+        "priority": task['priority'],
+        "status": task['status'],
+        "department": task['department'],
+        "due_date": task.get('due_date'),
+        "created_at": serialize_datetime(task.get('created_at')),
+    }
+
+def inbox_notification_summary(notification: dict) -> dict:
+    return {
+        "id": notification['id'],
+        "task_id": notification['task_id'],
+        "notification_type": notification['notification_type'],
+        "title": notification['title'],
+        "read": notification.get('read', False),
+        "created_at": serialize_datetime(notification.get('created_at')),
+    }
+
+def inbox_conversation_summary(conversation: dict, user_id: str) -> dict:
+    if conversation['participant1_id'] == user_id:
+        other_id, other_name = conversation['participant2_id'], conversation['participant2_name']
+    else:
+        other_id, other_name = conversation['participant1_id'], conversation['participant1_name']
+    return {
+        "id": conversation['id'],
+        "other_participant_id": other_id,
+        "other_participant_name": other_name,
+        "last_message": conversation.get('last_message'),
+        "last_message_at": serialize_datetime(conversation.get('last_message_at')),
+    }
+
+def inbox_group_summary(group: dict) -> dict:
+    return {
+        "id": group['id'],
+        "name": group['name'],
+        "department": group.get('department'),
+        "last_message": group.get('last_message'),
+        "last_message_at": serialize_datetime(group.get('last_message_at')),
+        "fan_out_on_read": fans_out_on_read(group),
+    }
+
+async def build_user_inbox(user_id: str) -> dict:
+    """Rebuild a user's inbox from the source collections, retrying if a write lands during the reads"""
+    for _ in range(INBOX_REBUILD_ATTEMPTS):
+        current = await db.user_inboxes.find_one({"user_id": user_id}, {"_id": 0, "version": 1})
+        if current is None:
+            # Create a placeholder first so writes during the reads have a version to bump
+            await db.user_inboxes.update_one(
+                {"user_id": user_id}, {"$setOnInsert": {"version": 0}}, upsert=True
+            )
+            current = {"version": 0}
+        version = current.get('version')
+        inbox = await read_user_inbox(user_id)
+        inbox['version'] = (version or 0) + 1
+        result = await db.user_inboxes.replace_one({"user_id": user_id, "version": version}, inbox)
+        if result.matched_count:
+            return inbox
+    # Still racing with writes: serve this build and leave the stored inbox for the next read
+    logger.warning("Inbox rebuild for %s kept losing to concurrent writes", user_id)
+    return inbox
+
+async def read_user_inbox(user_id: str) -> dict:
+    """The inbox as the source collections have it now"""
+    group_ids = await user_group_ids(user_id)
+    tasks, unread_count, notifications, conversations, groups = await asyncio.gather(
+        db.tasks.find(
+            {"assigned_to": user_id, "status": {"$ne": TaskStatus.COMPLETED.value}}, {"_id": 0}
+        ).sort("created_at", -1).to_list(INBOX_TASK_LIMIT),
+        db.task_notifications.count_documents({"recipient_id": user_id, "read": False}),
+        db.task_notifications.find(
+            {"recipient_id": user_id}, {"_id": 0, "task_data": 0, "attachments": 0}
+        ).sort("created_at", -1).to_list(INBOX_NOTIFICATION_LIMIT),
+        db.conversations.find(
+            {"participants": user_id}, {"_id": 0}
+        ).sort("last_message_at", -1).to_list(INBOX_CONVERSATION_LIMIT),
+        db.group_chats.find(
+            {"id": {"$in": group_ids}}, {"_id": 0, "members": 0}
+        ).sort("last_message_at", -1).to_list(1000),
+    )
+    return {
+        "user_id": user_id,
+        "tasks": [inbox_task_summary(task) for task in tasks],
+        "unread_notifications": unread_count,
+        "notifications": [inbox_notification_summary(notif) for notif in notifications],
+        "conversations": [inbox_conversation_summary(conv, user_id) for conv in conversations],
+        "groups": [inbox_group_summary(group) for group in groups],
+        "updated_at": datetime.now(timezone.utc).isoformat(),
+    }
+
+async def inbox_add_task(task: dict, session=None):
+    if not task.get('assigned_to'):
+        return
+    await db.user_inboxes.update_one(
+        {"user_id": task['assigned_to'], "tasks.id": {"$ne": task['id']}},
+        {"$push": {"tasks": {
+            "$each": [inbox_task_summary(task)],
+            "$sort": {"created_at": -1},
+            "$slice": INBOX_TASK_LIMIT
+        }}, "$inc": {"version": 1}},
+        session=session
+    )
+
+async def inbox_update_task_status(task: dict, status: str, session=None):
+    """Apply a status change to the inbox; `task` is the task as it was before the change"""
+    if status == TaskStatus.COMPLETED.value:
+        await db.user_inboxes.update_many(
+            {"tasks.id": task['id']}, {"$pull": {"tasks": {"id": task['id']}}, "$inc": {"version": 1}},
+            session=session
+        )
+    elif task.get('status') == TaskStatus.COMPLETED.value:
+        # Reopened: completed tasks were dropped from the inbox, so it goes back in
+        await inbox_add_task({**task, "status": status}, session=session)
+    else:
+        await db.user_inboxes.update_many(
+            {"tasks.id": task['id']}, {"$set": {"tasks.$.status": status}, "$inc": {"version": 1}},
+            session=session
+        )
+
+async def inbox_remove_task(task_id: str, session=None):
+    await db.user_inboxes.update_many(
+        {"tasks.id": task_id}, {"$pull": {"tasks": {"id": task_id}}, "$inc": {"version": 1}}, session=session
+    )
+
+async def inbox_add_notification(notification: dict, session=None):
+    await db.user_inboxes.update_one(
+        {"user_id": notification['recipient_id']},
+        {
+            "$inc": {"unread_notifications": 1, "version": 1},
+            "$push": {"notifications": {
+                "$each": [inbox_notification_summary(notification)],
+                "$sort": {"created_at": -1},
+                "$slice": INBOX_NOTIFICATION_LIMIT
+            }}
+        },
+        session=session
+    )
+
+async def inbox_mark_notification_read(recipient_id: str, notification_id: str):
+    await db.user_inboxes.update_one(
+        {"user_id": recipient_id, "unread_notifications": {"$gt": 0}},
+        {"$inc": {"unread_notifications": -1, "version": 1}}
+    )
+    await db.user_inboxes.update_one(
+        {"user_id": recipient_id, "notifications.id": notification_id},
+        {"$set": {"notifications.$.read": True}, "$inc": {"version": 1}}
+    )
+
+async def inbox_upsert_conversation(conversation: dict):
+    for user_id in (conversation['participant1_id'], conversation['participant2_id']):
+        summary = inbox_conversation_summary(conversation, user_id)
+        # $pull and $push on the same array cannot share one update
+        await db.user_inboxes.update_one(
+            {"user_id": user_id}, {"$pull": {"conversations": {"id": conversation['id']}}, "$inc": {"version": 1}}
+        )
+        await db.user_inboxes.update_one(
+            {"user_id": user_id},
+            {"$push": {"conversations": {
+                "$each": [summary],
+                "$sort": {"last_message_at": -1},
+                "$slice": INBOX_CONVERSATION_LIMIT
+            }}, "$inc": {"version": 1}}
+        )
+
+async def inbox_add_group(group: dict):
+    member_ids = [member['user_id'] for member in group['members']]
+    await db.user_inboxes.update_many(
+        {"user_id": {"$in": member_ids}},
+        {"$push": {"groups": {"$each": [inbox_group_summary(group)], "$sort": {"last_message_at": -1}}},
+         "$inc": {"version": 1}}
+    )
+
+async def inbox_update_group_last_message(group_id: str, last_message: str, last_message_at: str):
+    await db.user_inboxes.update_many(
+        {"groups.id": group_id},
+        {"$set": {"groups.$.last_message": last_message, "groups.$.last_message_at": last_message_at},
+         "$inc": {"version": 1}}
+    )
+    # A positional $set and a $push on the same array cannot share one update; an empty $push re-sorts
+    await db.user_inboxes.update_many(
+        {"groups.id": group_id},
+        {"$push": {"groups": {"$each": [], "$sort": {"last_message_at": -1}}}}
+    )
+
+async def inbox_read_large_groups(inbox: dict):
+    """Fill in the last message of groups too large to be updated in every member's inbox"""
+    group_ids = [group['id'] for group in inbox.get('groups', []) if group.get('fan_out_on_read')]
+    if not group_ids:
+        return
+    latest = {
+        group['id']: group async for group in db.group_chats.find(
+            {"id": {"$in": group_ids}}, {"_id": 0, "id": 1, "last_message": 1, "last_message_at": 1}
+        )
+    }
+    for group in inbox['groups']:
+        if group['id'] in latest:
+            group['last_message'] = latest[group['id']].get('last_message')
+            group['last_message_at'] = serialize_datetime(latest[group['id']].get('last_message_at'))
+    inbox['groups'].sort(key=lambda group: group.get('last_message_at') or "", reverse=True)
+
+
+# ==================== GROUP MEMBERSHIP ====================
+# group_members holds one row per (group_id, user_id), so membership checks and "my groups" are single
+# index lookups instead of scans of the embedded members array (kept on group_chats for responses).
+# Each row carries the member's read cursor, last_read_at: the sent_at of the newest message they have
+# read, absent until they read one. Groups with GROUP_FAN_OUT_ON_READ_MEMBERS or more members are
+# delivered on read: a new message updates only the group, not every member's inbox, and reads move the
+# cursor without growing the message's read_by.
+GROUP_FAN_OUT_ON_READ_MEMBERS = int(os.environ.get('GROUP_FAN_OUT_ON_READ_MEMBERS', 200))
+GROUP_UNREAD_COUNT_LIMIT = 100  # Unread counts are capped, like a "99+" badge
+
+def fans_out_on_read(group: dict) -> bool:
+    return group.get('member_count', len(group.get('members', []))) >= GROUP_FAN_OUT_ON_READ_MEMBERS
+
+def unique_group_members(members: List[dict]) -> List[dict]:
+    """One entry per user_id, in first-seen order; a user listed twice keeps the higher role"""
+    unique: Dict[str, dict] = {}
+    for member in members:
+        if not member.get('user_id'):
+            raise HTTPException(status_code=400, detail="Every member needs a user_id")
+        if member['user_id'] not in unique:
+            unique[member['user_id']] = dict(member)
+        elif member.get('role') == "admin":
+            unique[member['user_id']]['role'] = "admin"
+    return list(unique.values())
+
+def group_member_rows(group: dict) -> List[dict]:
+    return [{
+        "group_id": group['id'],
+        "user_id": member['user_id'],
+        "user_name": member.get('user_name'),
+        "role": member.get('role', 'member'),
+        "joined_at": group['created_at'],
+    } for member in group['members']]
+
+async def is_group_member(group_id: str, user_id: str) -> bool:
+    return await db.group_members.find_one({"group_id": group_id, "user_id": user_id}, {"_id": 1}) is not None
+
+async def user_group_ids(user_id: str) -> List[str]:
+    return await db.group_members.distinct("group_id", {"user_id": user_id})
+
+async def post_group_message(group: dict, doc: dict, last_message: str):
+    """Store a group message and update the group's last message concurrently. The group's own
+    message_count, not the group_chats version, moves the /groups ETag, so a message in one group
+    does not invalidate every user's list."""
+    writes = [
+        db.group_messages.insert_one(doc),
+        db.group_chats.update_one(
+            {"id": group['id']},
+            {"$set": {"last_message": last_message, "last_message_at": doc['sent_at']}, "$inc": {"message_count": 1}}
+        ),
+    ]
+    if not fans_out_on_read(group):
+        writes.append(inbox_update_group_last_message(group['id'], last_message, doc['sent_at']))
+    await asyncio.gather(*writes)
+
+async def group_message_activity(request: Request, reader: ReadContext) -> int:
+    """Messages posted to the groups a /groups request lists, for its ETag"""
+    user_id = request.query_params.get('user_id')
+    query = {"id": {"$in": await user_group_ids(user_id)}} if user_id else {}
+    totals = await reader.db.group_chats.aggregate([
+        {"$match": query},
+        {"$group": {"_id": None, "messages": {"$sum": "$message_count"}}},
+    ], session=reader.session).to_list(1)
+    return totals[0]['messages'] if totals else 0
+
+async def advance_group_read_cursor(group_id: str, user_id: str, message_id: str) -> bool:
+    """Move the member's read cursor up to `message_id`; False when there is no such message"""
+    message = await db.group_messages.find_one({"id": message_id, "group_id": group_id}, {"_id": 0, "sent_at": 1})
+    if not message:
+        return False
+    await db.group_members.update_one(
+        {"group_id": group_id, "user_id": user_id}, {"$max": {"last_read_at": message['sent_at']}}
+    )
+    return True
+
+async def group_unread_counts(user_id: str) -> Dict[str, int]:
+    cursors = {
+        member['group_id']: member.get('last_read_at')
+        async for member in db.group_members.find({"user_id": user_id}, {"_id": 0, "group_id": 1, "last_read_at": 1})
+    }
+    
+    async def unread(group_id: str, last_read_at: Optional[str]) -> int:
+        query = {"group_id": group_id, "sender_id": {"$ne": user_id}}
+        if last_read_at:
+            query['sent_at'] = {"$gt": last_read_at}
+        return await db.group_messages.count_documents(query, limit=GROUP_UNREAD_COUNT_LIMIT)
+    
+    counts = await asyncio.gather(*(unread(group_id, last_read_at) for group_id, last_read_at in cursors.items()))
+    return dict(zip(cursors, counts))
+
+
+# ==================== ARCHIVAL ====================
+# Rows older than the retention window move in batches into `<collection>_archive`, which is
+# created with zstd block compression. History endpoints can read through to the archive.
+ARCHIVE_POLICIES = {
+    # collection: (timestamp field, retention in days; 0 disables archiving)
+    "messages": ("sent_at", int(os.environ.get('ARCHIVE_MESSAGES_AFTER_DAYS', 180))),
+    "group_messages": ("sent_at", int(os.environ.get('ARCHIVE_GROUP_MESSAGES_AFTER_DAYS', 180))),
+    "task_notifications": ("created_at", int(os.environ.get('ARCHIVE_NOTIFICATIONS_AFTER_DAYS', 90))),
+    "activity_logs": ("created_at", int(os.environ.get('ARCHIVE_ACTIVITY_LOGS_AFTER_DAYS', 365))),
+}
+ARCHIVE_BATCH_SIZE = int(os.environ.get('ARCHIVE_BATCH_SIZE', 1000))
+ARCHIVE_INTERVAL_SECONDS = int(os.environ.get('ARCHIVE_INTERVAL_SECONDS', 3600))
+# Archived rows are purged by a TTL index after this many days; 0 keeps them forever
+ARCHIVE_PURGE_AFTER_DAYS = int(os.environ.get('ARCHIVE_PURGE_AFTER_DAYS', 0))
+# Default for the `include_archive` flag on history endpoints. On by default so archiving does not
+# take history away from clients that do not know about the flag.
+ARCHIVE_READ_THROUGH = os.environ.get('ARCHIVE_READ_THROUGH', 'true').lower() == 'true'
+
+async def ensure_archive_collections():
+    existing = set(await db.list_collection_names())
+    for collection, (date_field, _) in ARCHIVE_POLICIES.items():
+        archive_name = f"{collection}_archive"
+        if archive_name not in existing:
+            try:
+                await db.create_collection(
+                    archive_name,
+                    storageEngine={"wiredTiger": {"configString": "block_compressor=zstd"}}
+                )
+            except CollectionInvalid:
+                pass  # Another worker created it since the listing
+            except OperationFailure as e:
+                if e.code != NAMESPACE_EXISTS:
+                    raise
+        await db[collection].create_index(date_field)
+        await db[archive_name].create_index(date_field)
+        if ARCHIVE_PURGE_AFTER_DAYS > 0:
+            await db[archive_name].create_index(
+                "archived_at", expireAfterSeconds=ARCHIVE_PURGE_AFTER_DAYS * 86400
+            )
+
+async def archive_collection(collection: str) -> int:
+    """Move rows past the retention window into the archive collection, one batch at a time"""
+    date_field, retention_days = ARCHIVE_POLICIES[collection]
+    if retention_days <= 0:
+        return 0
+    
+    cutoff = (datetime.now(timezone.utc) - timedelta(days=retention_days)).isoformat()
+    archive = db[f"{collection}_archive"]
+    archived = 0
+    while True:
+        batch = await db[collection].find(
+            {date_field: {"$lt": cutoff}}
+        ).sort(date_field, 1).limit(ARCHIVE_BATCH_SIZE).to_list(ARCHIVE_BATCH_SIZE)
+        if not batch:
+            break
+        
+        archived_at = datetime.now(timezone.utc)  # BSON date so the TTL index can purge it
+        for doc in batch:
+            doc['archived_at'] = archived_at
+        try:
+            await archive.insert_many(batch, ordered=False)
+        except BulkWriteError as e:
+            # Rows copied by an interrupted earlier run are already archived under the same _id
+            if any(error['code'] != DUPLICATE_KEY for error in e.details.get('writeErrors', [])):
+                raise
+        await db[collection].delete_many({"_id": {"$in": [doc['_id'] for doc in batch]}})
+        
+        archived += len(batch)
+        if len(batch) < ARCHIVE_BATCH_SIZE:
+            break
+    return archived
+
+async def archive_old_rows() -> dict:
+    return {collection: await archive_collection(collection) for collection in ARCHIVE_POLICIES}
+
+async def find_with_archive(collection: str, query: dict, sort_field: str, limit: int, include_archive: bool,
+                            projection: Optional[dict] = None) -> List[dict]:
+    """Newest-first history read that continues into the archive when the live rows run out"""
+    docs = await db[collection].find(query, projection or {"_id": 0}).sort(sort_field, -1).to_list(limit)
+    if include_archive and len(docs) < limit:
+        # Everything in the archive is older than the live rows, so appending keeps the order
+        remaining = limit - len(docs)
+        docs += await db[f"{collection}_archive"].find(
+            query, projection or {"_id": 0, "archived_at": 0}
+        ).sort(sort_field, -1).to_list(remaining)
+    return docs
+
+
+# ==================== ORPHAN SWEEPER ====================
+# Collections holding per-task rows, removed together with their task
+TASK_CHILD_COLLECTIONS = [
+    "task_comments", "subtasks", "task_attachments", "time_logs",
+    "activity_logs", "task_notifications", "task_completions",
+]
+ORPHAN_SWEEP_BATCH_SIZE = int(os.environ.get('ORPHAN_SWEEP_BATCH_SIZE', 500))
+ORPHAN_SWEEP_INTERVAL_SECONDS = int(os.environ.get('ORPHAN_SWEEP_INTERVAL_SECONDS', 21600))
+
+async def sweep_orphans() -> dict:
+    """Delete child rows whose task no longer exists, scanning each collection in _id-ordered batches"""
+    removed = {}
+    for collection in TASK_CHILD_COLLECTIONS:
+        removed[collection] = 0
+        last_id = None
+        while True:
+            query = {"_id": {"$gt": last_id}} if last_id else {}
+            batch = await db[collection].find(
+                query, {"_id": 1, "task_id": 1}
+            ).sort("_id", 1).limit(ORPHAN_SWEEP_BATCH_SIZE).to_list(ORPHAN_SWEEP_BATCH_SIZE)
+            if not batch:
+                break
+            last_id = batch[-1]['_id']
+            
+            task_ids = list({doc.get('task_id') for doc in batch})
+            existing = set(await db.tasks.distinct("id", {"id": {"$in": task_ids}}))
+            orphan_ids = [doc['_id'] for doc in batch if doc.get('task_id') not in existing]
+            if orphan_ids:
+                result = await db[collection].delete_many({"_id": {"$in": orphan_ids}})
+                removed[collection] += result.deleted_count
+            
+            if len(batch) < ORPHAN_SWEEP_BATCH_SIZE:
+                break
+    return removed
+
+
+# ==================== BACKGROUND JOBS ====================
+background_jobs: List[asyncio.Task] = []
+
+async def acquire_job_lease(name: str, duration_seconds: int) -> bool:
+    """Claim a job for this process so that only one uvicorn worker runs each periodic job"""
+    now = datetime.now(timezone.utc)
+    try:
+        await db.job_leases.find_one_and_update(
+            {"_id": name, "$or": [{"owner": WORKER_ID}, {"expires_at": {"$lt": now}}]},
+            {"$set": {"owner": WORKER_ID, "expires_at": now + timedelta(seconds=duration_seconds)}},
+            upsert=True
+        )
+        return True
+    except DuplicateKeyError:
+        # The lease exists and is held by another worker
+        return False
+
+async def run_periodically(name: str, interval_seconds: int, job):
+    while True:
+        await asyncio.sleep(interval_seconds)
+        try:
+            # Held for two intervals so the owner keeps it as long as it keeps running
+            if not await acquire_job_lease(name, interval_seconds * 2):
+                continue
+            result = await job()
+            logging.info(f"Background job {name} finished: {result}")
+        except Exception as e:
+            logging.error(f"Background job {name} failed: {str(e)}")
+
+
+# ==================== MIGRATIONS ====================
+# One-off backfills for records written before a field was stored. Each runs once per database, not on
+# every start of every worker: the worker holding its lease runs it and records it in `migrations`, and
+# workers starting alongside skip it. If that worker dies, the next start retries once the lease expires.
+MIGRATION_LEASE_SECONDS = int(os.environ.get('MIGRATION_LEASE_SECONDS', 3600))
+
+async def migrate_conversation_participant_key():
+    # Canonical participant pair on conversations created before it was stored
+    await db.conversations.update_many(
+        {"participant_key": {"$exists": False}},
+        [{"$set": {
+            "participants": {"$cond": [
+                {"$lte": ["$participant1_id", "$participant2_id"]},
+                ["$participant1_id", "$participant2_id"],
+                ["$participant2_id", "$participant1_id"]
+            ]},
+            "participant_key": {"$cond": [
+                {"$lte": ["$participant1_id", "$participant2_id"]},
+                {"$concat": ["$participant1_id", ":", "$participant2_id"]},
+                {"$concat": ["$participant2_id", ":", "$participant1_id"]}
+            ]}
+        }}]
+    )
+    merged = await merge_duplicate_conversations()
+    if merged:
+        logging.warning(f"Merged {merged} duplicate conversations into the oldest conversation of their pair")
+    # Without this index two first messages can still open two conversations, so failing it fails startup
+    await db.conversations.create_index("participant_key", unique=True)
+
+async def migrate_group_members():
+    # Membership rows and member counts for groups created before they were stored
+    await db.group_chats.aggregate([
+        {"$match": {"member_count": {"$exists": False}}},
+        {"$unwind": "$members"},
+        {"$project": {
+            "_id": 0, "group_id": "$id", "user_id": "$members.user_id", "user_name": "$members.user_name",
+            "role": {"$ifNull": ["$members.role", "member"]}, "joined_at": "$created_at",
+        }},
+        {"$merge": {"into": "group_members", "on": ["group_id", "user_id"], "whenMatched": "keepExisting"}},
+    ]).to_list(None)
+    await db.group_chats.update_many(
+        {"member_count": {"$exists": False}}, [{"$set": {"member_count": {"$size": {"$ifNull": ["$members", []]}}}}]
+    )
+
+async def migrate_task_priority_rank():
+    for priority, rank in PRIORITY_RANK.items():
+        await db.tasks.update_many(
+            {"priority": priority.value, "priority_rank": {"$exists": False}},
+            {"$set": {"priority_rank": rank}}
+        )
+
+async def migrate_sync_updated_at():
+    for collection in ("tasks", "subtasks"):
+        await db[collection].update_many(
+            {"updated_at": {"$exists": False}}, [{"$set": {"updated_at": "$created_at"}}]
+        )
+
+async def migrate_quality_check_style_number():
+    await db.quality_checks.aggregate([
+        {"$match": {"style_number": {"$exists": False}}},
+        {"$lookup": {"from": "orders", "localField": "order_id", "foreignField": "id", "as": "order"}},
+        {"$project": {"style_number": {"$ifNull": [{"$first": "$order.style_number"}, None]}}},
+        {"$merge": {"into": "quality_checks", "on": "_id", "whenMatched": "merge", "whenNotMatched": "discard"}},
+    ]).to_list(None)
+
+async def migrate_record_versions():
+    # Optimistic-concurrency versions start at 1
+    for collection in ("tasks", "orders", "materials", "production_stages"):
+        await db[collection].update_many({"version": {"$exists": False}}, {"$set": {"version": 1}})
+
+async def migrate_pipeline_counters():
+    # Pipeline counters start from a full count the first time they are deployed
+    await reconcile_pipeline_counters()
+
+MIGRATIONS = [
+    ("conversation_participant_key", migrate_conversation_participant_key),
+    ("group_members", migrate_group_members),
+    ("task_priority_rank", migrate_task_priority_rank),
+    ("sync_updated_at", migrate_sync_updated_at),
+    ("quality_check_style_number", migrate_quality_check_style_number),
+    ("record_versions", migrate_record_versions),
+    ("pipeline_counters", migrate_pipeline_counters),
+]
+
+async def run_migrations() -> List[str]:
+    """Run the migrations this database has not recorded yet; returns the ones this worker ran"""
+    done = set(await db.migrations.distinct("_id"))
+    ran = []
+    for name, migration in MIGRATIONS:
+        if name in done:
+            continue
+        lease = f"migration:{name}"
+        if not await acquire_job_lease(lease, MIGRATION_LEASE_SECONDS):
+            logging.info(f"Migration {name} is running in another worker, skipping it")
+            continue
+        if await db.migrations.find_one({"_id": name}, {"_id": 1}):
+            continue  # Finished by another worker between the listing and the lease
+        start = time.perf_counter()
+        try:
+            await migration()
+        except Exception:
+            await db.job_leases.delete_one({"_id": lease, "owner": WORKER_ID})
+            logging.exception(f"Migration {name} failed, it is retried at the next start")
+            raise
+        await db.migrations.insert_one({
+            "_id": name, "worker": WORKER_ID, "finished_at": datetime.now(timezone.utc),
+            "seconds": round(time.perf_counter() - start, 3),
+        })
+        logging.info(f"Migration {name} finished in {time.perf_counter() - start:.1f}s")
+        ran.append(name)
+    return ran
+
+
+
+# ==================== ADMISSION CONTROL ====================
+# Rate limits are token buckets keyed by (limit, client address): `rate` tokens per second refill a bucket that
+# holds at most `burst`. They are per worker ("local") unless RATE_LIMIT_STORE=mongo, which keeps
+# fixed-window counters in the rate_limits collection so every worker shares one budget.
+# Concurrency limits cap how many expensive requests a worker runs at once; a request that cannot get
+# a slot within ADMISSION_QUEUE_TIMEOUT_SECONDS is shed with 503 instead of piling onto MongoDB.
+RATE_LIMIT_STORE = os.environ.get('RATE_LIMIT_STORE', 'local')
+# Proxies in front of the app that append to X-Forwarded-For; 0 when clients connect directly
+RATE_LIMIT_TRUSTED_PROXIES = int(os.environ.get('RATE_LIMIT_TRUSTED_PROXIES', 1))
+ADMISSION_QUEUE_TIMEOUT_SECONDS = float(os.environ.get('ADMISSION_QUEUE_TIMEOUT_SECONDS', 2.0))
+
+def parse_rate_limit(name: str, default: str) -> Tuple[float, int]:
+    """RATE_LIMIT_<NAME> is <requests per second>/<burst>, e.g. 2/10"""
+    rate, burst = os.environ.get(f'RATE_LIMIT_{name.upper()}', default).split("/")
+    return float(rate), int(burst)
+
+RATE_LIMITS = {
+    "messages": parse_rate_limit("messages", "2/20"),
+    "time_logs": parse_rate_limit("time_logs", "1/10"),
+    "mark_read": parse_rate_limit("mark_read", "10/100"),
+}
+CONCURRENCY_LIMITS = {
+    "task_fan_out": int(os.environ.get('CONCURRENCY_LIMIT_TASK_FAN_OUT', 8)),
+    "analytics": int(os.environ.get('CONCURRENCY_LIMIT_ANALYTICS', 4)),
+}
+
+class LocalRateLimitStore:
+    MAX_BUCKETS = 100000
+    IDLE_SECONDS = 300
+    
+    def __init__(self):
+        self.buckets: Dict[str, Tuple[float, float]] = {}  # key -> (tokens, updated_at)
+    
+    async def take(self, key: str, rate: float, burst: int) -> float:
+        """Seconds until a token is available, 0 when this request may proceed"""
+        now = time.monotonic()
+        tokens, updated_at = self.buckets.get(key, (burst, now))
+        tokens = min(burst, tokens + (now - updated_at) * rate)
+        if tokens < 1:
+            self.buckets[key] = (tokens, now)
+            return (1 - tokens) / rate
+        if len(self.buckets) >= self.MAX_BUCKETS and key not in self.buckets:
+            # A bucket idle this long has refilled, so dropping it loses nothing
+            self.buckets = {k: v for k, v in self.buckets.items() if now - v[1] < self.IDLE_SECONDS}
+        self.buckets[key] = (tokens - 1, now)
+        return 0.0
+
+class MongoRateLimitStore:
+    """Shared stand-in for a counter store such as Redis INCR + EXPIRE"""
+    
+    async def take(self, key: str, rate: float, burst: int) -> float:
+        # One window admits `burst` requests, which averages out to `rate` per second
+        window_seconds = burst / rate
+        now = time.time()
+        window_start = now - now % window_seconds
+        counter = await bulk_db.rate_limits.find_one_and_update(
+            {"_id": f"{key}:{int(window_start)}"},
+            {"$inc": {"count": 1},
+             "$setOnInsert": {"expires_at": datetime.fromtimestamp(window_start + window_seconds * 2, timezone.utc)}},
+            upsert=True,
+            return_document=ReturnDocument.AFTER
+        )
+        if counter['count'] <= burst:
+            return 0.0
+        return window_start + window_seconds - now
+
+rate_limit_store = MongoRateLimitStore() if RATE_LIMIT_STORE == "mongo" else LocalRateLimitStore()
+
+def request_client(request: Request) -> str:
+    """Who a request counts against: the client address as seen by the outermost trusted proxy. User ids
+    and the leading X-Forwarded-For hops are set by the client, so a bucket keyed on them is escaped by
+    sending a new value; each of the RATE_LIMIT_TRUSTED_PROXIES proxies appends the peer it saw, so the
+    hop that many places from the end is the one no client can forge."""
+    peer = request.client.host if request.client else "unknown"
+    if RATE_LIMIT_TRUSTED_PROXIES == 0:
+        return f"ip:{peer}"
+    hops = [hop.strip() for hop in request.headers.get('x-forwarded-for', '').split(',') if hop.strip()]
+    if len(hops) < RATE_LIMIT_TRUSTED_PROXIES:
+        return f"ip:{peer}"
+    return f"ip:{hops[-RATE_LIMIT_TRUSTED_PROXIES]}"
+
+def retry_after_header(seconds: float) -> Dict[str, str]:
+    return {"Retry-After": str(max(1, math.ceil(seconds)))}
+
+def rate_limit(name: str):
+    """Rate limit a route per client"""
+    rate, burst = RATE_LIMITS[name]
+    
+    async def dependency(request: Request):
+        wait_seconds = await rate_limit_store.take(f"{name}:{request_client(request)}", rate, burst)
+        if wait_seconds > 0:
+            admission_rejections_total.inc((name, "rate_limited"))
+            raise HTTPException(status_code=429, detail="Too many requests", headers=retry_after_header(wait_seconds))
+    
+    return dependency
+
+class ConcurrencyLimiter:
+    def __init__(self, name: str, limit: int, queue_timeout: float):
+        self.name = name
+        self.semaphore = asyncio.Semaphore(limit)
+        self.queue_timeout = queue_timeout
+    
+    async def __aenter__(self):
+        try:
+            await asyncio.wait_for(self.semaphore.acquire(), self.queue_timeout)
+        except asyncio.TimeoutError:
+            admission_rejections_total.inc((self.name, "shed"))
+            raise HTTPException(status_code=503, detail="Server busy, retry shortly",
+                                headers=retry_after_header(self.queue_timeout))
+        return self
+    
+    async def __aexit__(self, *exc_info):
+        self.semaphore.release()
+
+concurrency_limiters = {
+    name: ConcurrencyLimiter(name, limit, ADMISSION_QUEUE_TIMEOUT_SECONDS)
+    for name, limit in CONCURRENCY_LIMITS.items()
+}
+
+def concurrency_limit(name: str):
+    limiter = concurrency_limiters[name]
+    
+    async def dependency():
+        async with limiter:
+            yield
+    
+    return dependency
+
+
+# ==================== CHANGE FEED ====================
+# Domain events for downstream consumers (ERP, BI) are appended to the events collection with a
+# gap-free sequence number from the counters collection; consumers resume from the last seq they saw.
+# Sequence numbers are taken before the insert, so a slow writer can make seq N+1 visible before N:
+# readers stop at such a gap until it is EVENT_GAP_TIMEOUT_SECONDS old, after which the missing seq is
+# treated as abandoned (its writer failed) and skipped.
+# The seq is taken outside the caller's transaction: $inc'ing the one counter document inside it would
+# make every transactional write conflict with every other one. An aborted or retried transaction
+# therefore leaves a gap, which readers wait out like any other before skipping it.
+EVENT_RETENTION_DAYS = int(os.environ.get('EVENT_RETENTION_DAYS', 30))
+EVENT_GAP_TIMEOUT_SECONDS = float(os.environ.get('EVENT_GAP_TIMEOUT_SECONDS', 10))
+EVENT_POLL_INTERVAL_SECONDS = float(os.environ.get('EVENT_POLL_INTERVAL_SECONDS', 1.0))
+EVENT_HEARTBEAT_SECONDS = float(os.environ.get('EVENT_HEARTBEAT_SECONDS', 15))
+
+class EventNotifier:
+    """Wakes this worker's feed readers as soon as it records an event; other workers' events are
+    picked up by polling"""
+    
+    def __init__(self):
+        self._event = asyncio.Event()
+    
+    def notify(self):
+        self._event.set()
+        self._event = asyncio.Event()
+    
+    async def wait(self, timeout: float):
+        try:
+            await asyncio.wait_for(self._event.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+
+event_notifier = EventNotifier()
+
+async def record_event(event_type: str, entity_id: str, data: dict, session=None):
+    counter = await db.counters.find_one_and_update(
+        {"_id": "events"}, {"$inc": {"seq": 1}},
+        upsert=True, return_document=ReturnDocument.AFTER
+    )
+    now = datetime.now(timezone.utc)
+    await db.events.insert_one({
+        "seq": counter['seq'],
+        "type": event_type,
+        "entity_id": entity_id,
+        "data": data,
+        "occurred_at": now.isoformat(),
+        "recorded_at": now,  # BSON date for the retention TTL index
+    }, session=session)
+    event_notifier.notify()
+
+async def record_task_status_event(task: dict, status: str, session=None):
+    event_type = "task.completed" if status == TaskStatus.COMPLETED.value else "task.status_changed"
+    await record_event(event_type, task['id'], {
+        "title": task.get('title'), "assigned_to": task.get('assigned_to'), "from": task.get('status'), "to": status
+    }, session)
+
+async def event_horizon(after: int) -> int:
+    """The last seq readers may consume now: just before the first gap that may still fill"""
+    cutoff = datetime.now(timezone.utc) - timedelta(seconds=EVENT_GAP_TIMEOUT_SECONDS)
+    recent = await db.events.find(
+        {"seq": {"$gt": after}, "recorded_at": {"$gte": cutoff}}, {"_id": 0, "seq": 1}
+    ).sort("seq", 1).to_list(None)
+    # Only settled events bound the search, so one inserted after `recent` was read cannot jump a gap
+    settled_query = {"seq": {"$gt": after}, "recorded_at": {"$lt": cutoff}}
+    if recent:
+        settled_query['seq']['$lt'] = recent[0]['seq']
+    settled = await db.events.find_one(settled_query, {"_id": 0, "seq": 1}, sort=[("seq", -1)])
+    expected = (settled['seq'] if settled else after) + 1
+    for event in recent:
+        if event['seq'] != expected:
+            break
+        expected += 1
+    return expected - 1
+
+async def read_events(after: int, types: Optional[List[str]], limit: int) -> Tuple[List[dict], int]:
+    """Events after `after` in seq order up to the event horizon; returns them and the new cursor"""
+    horizon = await event_horizon(after)
+    if horizon <= after:
+        return [], after
+    query = {"seq": {"$gt": after, "$lte": horizon}}
+    if types:
+        query['type'] = {"$in": types}
+    events = await db.events.find(query, {"_id": 0, "recorded_at": 0}).sort("seq", 1).limit(limit).to_list(limit)
+    if len(events) == limit:
+        return events, events[-1]['seq']
+    # Every matching event up to the horizon is in this page, so the next read starts after the horizon
+    # rather than rescanning the events of other types in between
+    return events, horizon
+
+async def oldest_event_seq() -> Optional[int]:
+    oldest = await db.events.find_one({}, {"_id": 0, "seq": 1}, sort=[("seq", 1)])
+    return oldest['seq'] if oldest else None
+
+class FeedProjection(ABC):
+    """An in-memory view kept current from the change feed. Subclasses load a full snapshot and re-read
+    the entities named in new events (event type -> collection in `event_collections`). A full reload
+    runs when unseen events have expired, when more than `max_events` are pending, or every
+    `reload_seconds`. Only the first load runs on the request path; later reloads run in the background
+    while requests keep reading the current state, so `load_snapshot` must swap its state in at once."""
+    event_collections: Dict[str, str] = {}
+    
+    def __init__(self, refresh_seconds: float, reload_seconds: float, max_events: int):
+        self.refresh_seconds = refresh_seconds
+        self.reload_seconds = reload_seconds
+        self.max_events = max_events
+        self.cursor: Optional[int] = None
+        self.loaded_at = 0.0
+        self.refreshed_at = 0.0
+        self._lock = asyncio.Lock()
+        self._reload_task: Optional[asyncio.Task] = None
+    
+    @abstractmethod
+    async def load_snapshot(self):
+        """Replace the whole view from the source collections"""
+    
+    @abstractmethod
+    async def apply_changes(self, changed: Dict[str, set]):
+        """Re-read the entities in `changed` (collection -> ids named by new events) into the view"""
+    
+    async def load(self):
+        counter = await db.counters.find_one({"_id": "events"})
+        # Events recorded while loading are replayed on the next refresh; re-reading is idempotent
+        cursor = counter['seq'] if counter else 0
+        await self.load_snapshot()
+        self.cursor = cursor
+        self.loaded_at = time.monotonic()
+    
+    async def catch_up(self) -> bool:
+        """Apply the events since the cursor; False when a full reload is needed instead"""
+        oldest = await oldest_event_seq()
+        if oldest is not None and oldest > self.cursor + 1:
+            return False
+        changed = {collection: set() for collection in set(self.event_collections.values())}
+        cursor, seen = self.cursor, 0
+        while True:
+            events, cursor = await read_events(cursor, list(self.event_collections), 1000)
+            for event in events:
+                changed[self.event_collections[event['type']]].add(event['entity_id'])
+            seen += len(events)
+            if seen > self.max_events:
+                return False
+            if len(events) < 1000:
+                break
+        await self.apply_changes(changed)
+        self.cursor = cursor
+        return True
+    
+    @property
+    def reloading(self) -> bool:
+        return self._reload_task is not None and not self._reload_task.done()
+    
+    async def reload_in_background(self):
+        try:
+            await self.load()
+        except Exception:
+            logging.exception(f"{type(self).__name__} reload failed, retrying at the next refresh")
+    
+    async def refresh(self):
+        # While a reload runs, catching up would apply changes its snapshot then overwrites
+        if self.reloading or time.monotonic() - self.refreshed_at < self.refresh_seconds:
+            return
+        async with self._lock:
+            if self.reloading or time.monotonic() - self.refreshed_at < self.refresh_seconds:
+                return
+            if self.cursor is None:
+                await self.load()  # Nothing to serve yet
+            elif time.monotonic() - self.loaded_at > self.reload_seconds or not await self.catch_up():
+                self._reload_task = asyncio.create_task(self.reload_in_background())
+            self.refreshed_at = time.monotonic()
+
+
+
+# ==================== TIME-SERIES ROLLUPS ====================
+# Trend charts read metric_rollups instead of raw rows. Each time log, QC result and task completion
+# $inc's hourly and daily buckets for every dimension it belongs to, so a year of daily data for one
+# department is 365 documents. Bucket ids are deterministic, so every write is a single upsert.
+ROLLUP_GRANULARITIES = ("hour", "day")
+ROLLUP_DIMENSIONS = ("factory", "department", "worker", "stage", "order")
+ROLLUP_METRICS = (
+    "hours_logged", "qc_passed", "qc_failed", "defects", "tasks_completed", "estimated_hours", "actual_hours",
+)
+
+def rollup_bucket(timestamp, granularity: str) -> str:
+    timestamp = as_utc(timestamp).replace(minute=0, second=0, microsecond=0)
+    if granularity == "day":
+        timestamp = timestamp.replace(hour=0)
+    return timestamp.isoformat()
+
+def metric_field(name: str) -> str:
+    # Defect names become field names, which may not contain dots or start with $
+    return name.replace(".", "_").lstrip("$") or "unspecified"
+
+def rollup_buckets(timestamp, dimensions: dict) -> List[Tuple[str, dict]]:
+    """Ids and identifying fields of every (granularity, dimension) bucket a row falls in"""
+    buckets = []
+    for granularity in ROLLUP_GRANULARITIES:
+        bucket = rollup_bucket(timestamp, granularity)
+        for dimension, key in {"factory": "all", **dimensions}.items():
+            if key is not None:
+                buckets.append((f"{granularity}|{dimension}|{key}|{bucket}",
+                                {"granularity": granularity, "dimension": dimension, "key": key, "bucket": bucket}))
+    return buckets
+
+def rollup_increments(timestamp, dimensions: dict, metrics: dict) -> List[UpdateOne]:
+    increments = {f"metrics.{name}": value for name, value in metrics.items() if value}
+    if not increments:
+        return []
+    created_at = datetime.now(timezone.utc)
+    return [
+        UpdateOne({"_id": bucket_id}, {"$inc": increments, "$setOnInsert": {**fields, "created_at": created_at}},
+                  upsert=True)
+        for bucket_id, fields in rollup_buckets(timestamp, dimensions)
+    ]
+
+async def record_rollups(timestamp, dimensions: dict, metrics: dict):
+    writes = rollup_increments(timestamp, dimensions, metrics)
+    if not writes:
+        return
+    try:
+        await bulk_db.metric_rollups.bulk_write(writes, ordered=False)
+    except Exception as e:
+        # Rollups are derived data; a lost increment is fixed by the next rebuild, not worth failing the write
+        logging.error(f"Failed to update rollups: {str(e)}")
+
+def time_log_rollup(timelog: dict, task: dict) -> Tuple[str, dict, dict]:
+    return (timelog['logged_at'],
+            {"department": task.get('department'), "worker": timelog['user_id']},
+            {"hours_logged": timelog['hours']})
+
+def quality_check_rollup(qc: dict) -> Tuple[str, dict, dict]:
+    passed = qc['status'] == QCStatus.PASSED.value
+    metrics = {"qc_passed": 1 if passed else 0, "qc_failed": 0 if passed else 1}
+    for defect in qc.get('defects_found', []):
+        field = f"defects.{metric_field(defect)}"
+        metrics[field] = metrics.get(field, 0) + 1
+    return qc['checked_at'], {"stage": qc['stage'], "order": qc['order_id'], "worker": qc['inspector_id']}, metrics
+
+def task_completion_rollup(task: dict, completed_at, actual_hours: Optional[float] = None) -> Tuple[str, dict, dict]:
+    return (completed_at,
+            {"department": task.get('department'), "worker": task.get('assigned_to')},
+            {"tasks_completed": 1, "estimated_hours": task.get('estimated_hours') or 0, "actual_hours": actual_hours or 0})
+
+async def rebuild_rollups() -> int:
+    """Recompute every bucket from the raw rows; for backfills and repairs, during a quiet period.
+    Buckets are overwritten in place, so charts never see them empty and increments recorded after a
+    bucket is rewritten are kept. Buckets no raw row maps to any more are deleted, unless an increment
+    created them while the rebuild ran."""
+    started = datetime.now(timezone.utc)
+    buckets: Dict[str, dict] = {}
+    
+    def accumulate(timestamp, dimensions, metrics):
+        for bucket_id, fields in rollup_buckets(timestamp, dimensions):
+            totals = buckets.setdefault(bucket_id, {**fields, "metrics": {}})['metrics']
+            for name, value in metrics.items():
+                if not value:
+                    continue
+                target = totals
+                if "." in name:
+                    group, name = name.split(".", 1)
+                    target = totals.setdefault(group, {})
+                target[name] = target.get(name, 0) + value
+    
+    actual_hours = {
+        completion['task_id']: completion.get('actual_hours')
+        async for completion in db.task_completions.find(
+            {"completion_status": TaskStatus.COMPLETED.value}, {"_id": 0, "task_id": 1, "actual_hours": 1}
+        ).sort("completed_at", 1)
+    }
+    tasks = {}
+    async for task in db.tasks.find({}, {"_id": 0, "id": 1, "department": 1, "assigned_to": 1,
+                                         "estimated_hours": 1, "status": 1, "completed_at": 1}):
+        tasks[task['id']] = task
+        if task.get('status') == TaskStatus.COMPLETED.value and task.get('completed_at'):
+            accumulate(*task_completion_rollup(task, task['completed_at'], actual_hours.get(task['id'])))
+    async for timelog in db.time_logs.find({}, {"_id": 0, "task_id": 1, "user_id": 1, "hours": 1, "logged_at": 1}):
+        accumulate(*time_log_rollup(timelog, tasks.get(timelog['task_id'], {})))
+    async for qc in db.quality_checks.find({}, {"_id": 0}):
+        accumulate(*quality_check_rollup(qc))
+    
+    writes = [
+        UpdateOne({"_id": bucket_id}, {"$set": bucket, "$setOnInsert": {"created_at": started}}, upsert=True)
+        for bucket_id, bucket in buckets.items()
+    ]
+    for start in range(0, len(writes), 1000):
+        await bulk_db.metric_rollups.bulk_write(writes[start:start + 1000], ordered=False)
+    stale = [
+        doc['_id'] async for doc in db.metric_rollups.find(
+            {"$or": [{"created_at": {"$lt": started}}, {"created_at": {"$exists": False}}]}, {"_id": 1}
+        ) if doc['_id'] not in buckets
+    ]
+    for start in range(0, len(stale), 1000):
+        await bulk_db.metric_rollups.delete_many({"_id": {"$in": stale[start:start + 1000]}})
+    return len(writes)
+
+
+# ==================== CAPACITY PLANNER ====================
+# Assignment suggestions come from an in-memory load model held by each worker process: the remaining
+# estimated hours of every worker's open tasks plus a fixed allowance per unfinished production stage.
+# It is a FeedProjection, so task, time-log, stage and worker events re-read only what changed.
+CAPACITY_REFRESH_SECONDS = float(os.environ.get('CAPACITY_REFRESH_SECONDS', 1.0))
+CAPACITY_RELOAD_SECONDS = float(os.environ.get('CAPACITY_RELOAD_SECONDS', 3600))
+CAPACITY_MAX_EVENTS = int(os.environ.get('CAPACITY_MAX_EVENTS', 5000))
+CAPACITY_DEFAULT_TASK_HOURS = float(os.environ.get('CAPACITY_DEFAULT_TASK_HOURS', 2.0))
+CAPACITY_STAGE_HOURS = float(os.environ.get('CAPACITY_STAGE_HOURS', 8.0))
+
+CAPACITY_EVENT_COLLECTIONS = {
+    "task.created": "tasks",
+    "task.status_changed": "tasks",
+    "task.completed": "tasks",
+    "task.deleted": "tasks",
+    "task.time_logged": "tasks",
+    "production_stage.created": "production_stages",
+    "production_stage.status_changed": "production_stages",
+    "worker.created": "workers",
+    "worker.updated": "workers",
+    "worker.deleted": "workers",
+}
+OPEN_TASK_STATUSES = [TaskStatus.PENDING.value, TaskStatus.IN_PROGRESS.value]
+
+# Production stages are staffed from the department of the same name
+STAGE_DEPARTMENTS = {stage.value: stage.value for stage in ProductionStage}
+STAGE_DEPARTMENTS[ProductionStage.QUALITY_CHECK.value] = "qc"
+
+def remaining_task_hours(task: dict, logged_hours: float) -> float:
+    estimate = task.get('estimated_hours') or CAPACITY_DEFAULT_TASK_HOURS
+    return max(estimate - logged_hours, 0.0)
+
+async def logged_hours(task_ids: List[str]) -> Dict[str, float]:
+    totals = {}
+    for start in range(0, len(task_ids), 1000):
+        async for row in db.time_logs.aggregate([
+            {"$match": {"task_id": {"$in": task_ids[start:start + 1000]}}},
+            {"$group": {"_id": "$task_id", "hours": {"$sum": "$hours"}}},
+        ]):
+            totals[row['_id']] = row['hours']
+    return totals
+
+class WorkerLoad:
+    __slots__ = ("task_hours", "open_tasks", "active_stages")
+    
+    def __init__(self):
+        self.task_hours = 0.0
+        self.open_tasks = 0
+        self.active_stages = 0
+    
+    @property
+    def hours(self) -> float:
+        return self.task_hours + self.active_stages * CAPACITY_STAGE_HOURS
+
+class CapacityModel(FeedProjection):
+    event_collections = CAPACITY_EVENT_COLLECTIONS
+    
+    def __init__(self):
+        super().__init__(CAPACITY_REFRESH_SECONDS, CAPACITY_RELOAD_SECONDS, CAPACITY_MAX_EVENTS)
+        self.workers: Dict[str, dict] = {}  # active workers by id, skills lower-cased
+        self.loads: Dict[str, WorkerLoad] = {}  # by worker id, whether or not the worker is active
+        self.tasks: Dict[str, Tuple[str, float]] = {}  # open task id -> (assignee, remaining hours)
+        self.stages: Dict[str, str] = {}  # unfinished, assigned stage id -> worker id
+    
+    def load_of(self, worker_id: str) -> WorkerLoad:
+        return self.loads.setdefault(worker_id, WorkerLoad())
+    
+    def set_worker(self, worker: Optional[dict], worker_id: str):
+        if worker and worker.get('active', True):
+            self.workers[worker_id] = {**worker, "skill_set": {skill.lower() for skill in worker.get('skills', [])}}
+        else:
+            self.workers.pop(worker_id, None)
+    
+    def set_task(self, task_id: str, assignee: Optional[str], hours: float):
+        self.drop_task(task_id)
+        if not assignee:
+            return
+        self.tasks[task_id] = (assignee, hours)
+        load = self.load_of(assignee)
+        load.task_hours += hours
+        load.open_tasks += 1
+    
+    def drop_task(self, task_id: str):
+        previous = self.tasks.pop(task_id, None)
+        if previous:
+            load = self.load_of(previous[0])
+            load.task_hours -= previous[1]
+            load.open_tasks -= 1
+    
+    def set_stage(self, stage_id: str, worker_id: Optional[str]):
+        self.drop_stage(stage_id)
+        if worker_id:
+            self.stages[stage_id] = worker_id
+            self.load_of(worker_id).active_stages += 1
+    
+    def drop_stage(self, stage_id: str):
+        previous = self.stages.pop(stage_id, None)
+        if previous:
+            self.load_of(previous).active_stages -= 1
+    
+    def note_task(self, task: dict, logged: float = 0.0):
+        if task.get('status') in OPEN_TASK_STATUSES:
+            self.set_task(task['id'], task.get('assigned_to'), remaining_task_hours(task, logged))
+        else:
+            self.drop_task(task['id'])
+    
+    def note_stage(self, stage: dict):
+        if stage.get('status') != StageStatus.COMPLETED.value:
+            self.set_stage(stage['id'], stage.get('assigned_worker_id'))
+        else:
+            self.drop_stage(stage['id'])
+    
+    @contextlib.contextmanager
+    def reserve_task(self, task: dict):
+        """Count a new task while it is inserted, so concurrent picks in this process see it; the load
+        stays only if the insert succeeds"""
+        self.note_task(task)
+        try:
+            yield
+        except BaseException:
+            self.drop_task(task['id'])
+            raise
+    
+    @contextlib.contextmanager
+    def reserve_stage(self, stage: dict):
+        self.note_stage(stage)
+        try:
+            yield
+        except BaseException:
+            self.drop_stage(stage['id'])
+            raise
+    
+    async def load_snapshot(self):
+        workers = await db.workers.find({"active": True}, {"_id": 0, "id": 1, "name": 1, "department": 1, "skills": 1}).to_list(None)
+        tasks = await db.tasks.find(
+            {"status": {"$in": OPEN_TASK_STATUSES}},
+            {"_id": 0, "id": 1, "assigned_to": 1, "estimated_hours": 1, "status": 1}
+        ).to_list(None)
+        logged = await logged_hours([task['id'] for task in tasks])
+        stages = await db.production_stages.find(
+            {"status": {"$ne": StageStatus.COMPLETED.value}, "assigned_worker_id": {"$ne": None}},
+            {"_id": 0, "id": 1, "assigned_worker_id": 1, "status": 1}
+        ).to_list(None)
+        
+        self.workers, self.loads, self.tasks, self.stages = {}, {}, {}, {}
+        for worker in workers:
+            self.set_worker(worker, worker['id'])
+        for task in tasks:
+            self.note_task(task, logged.get(task['id'], 0.0))
+        for stage in stages:
+            self.note_stage(stage)
+    
+    async def apply_changes(self, changed: Dict[str, set]):
+        if changed['workers']:
+            ids = list(changed['workers'])
+            found = {worker['id']: worker async for worker in db.workers.find(
+                {"id": {"$in": ids}}, {"_id": 0, "id": 1, "name": 1, "department": 1, "skills": 1, "active": 1}
+            )}
+            for worker_id in ids:
+                self.set_worker(found.get(worker_id), worker_id)
+        if changed['tasks']:
+            ids = list(changed['tasks'])
+            found = {task['id']: task async for task in db.tasks.find(
+                {"id": {"$in": ids}}, {"_id": 0, "id": 1, "assigned_to": 1, "estimated_hours": 1, "status": 1}
+            )}
+            logged = await logged_hours([task_id for task_id, task in found.items() if task.get('status') in OPEN_TASK_STATUSES])
+            for task_id in ids:
+                if task_id in found:
+                    self.note_task(found[task_id], logged.get(task_id, 0.0))
+                else:
+                    self.drop_task(task_id)
+        if changed['production_stages']:
+            ids = list(changed['production_stages'])
+            found = {stage['id']: stage async for stage in db.production_stages.find(
+                {"id": {"$in": ids}}, {"_id": 0, "id": 1, "assigned_worker_id": 1, "status": 1}
+            )}
+            for stage_id in ids:
+                if stage_id in found:
+                    self.note_stage(found[stage_id])
+                else:
+                    self.drop_stage(stage_id)
+    
+    def summary(self, worker: dict) -> dict:
+        load = self.loads.get(worker['id']) or WorkerLoad()
+        return {
+            "worker_id": worker['id'],
+            "name": worker.get('name'),
+            "department": worker.get('department'),
+            "skills": worker.get('skills', []),
+            "load_hours": round(load.hours, 2),
+            "open_tasks": load.open_tasks,
+            "active_stages": load.active_stages,
+        }
+    
+    def candidates(self, department: Optional[str], skills: List[str], limit: int) -> List[dict]:
+        """Active workers of `department` having every skill in `skills`, least loaded first"""
+        required = {skill.lower() for skill in skills}
+        qualified = [
+            worker for worker in self.workers.values()
+            if (not department or worker.get('department') == department) and required <= worker['skill_set']
+        ]
+        least_loaded = heapq.nsmallest(limit, qualified, key=lambda worker: (
+            self.loads[worker['id']].hours if worker['id'] in self.loads else 0.0, worker['id']
+        ))
+        return [self.summary(worker) for worker in least_loaded]
+    
+    async def pick(self, department: str, skills: List[str]) -> dict:
+        """The least-loaded qualified worker; the caller reserves the new item with reserve_task/reserve_stage
+        before its next await, so concurrent picks in this process see each other's assignments. Picks in
+        other processes only see it once they catch up on its event (CAPACITY_REFRESH_SECONDS), so
+        simultaneous auto-assignments on two workers can land on the same person; the next picks then
+        see the extra load and even it out."""
+        await self.refresh()
+        candidates = self.candidates(department, skills, 1)
+        if not candidates:
+            raise HTTPException(status_code=409, detail=f"No active worker in {department} with the required skills")
+        return candidates[0]
+
+capacity_model = CapacityModel()
+
+
+# ==================== DELIVERY FORECAST ====================
+# Every open order's completion time is estimated from historical stage cycle times: stages already
+# completed count nothing, the stage in progress counts its typical duration less the time it has been
+# running, and the stages not yet started count their full typical duration. The forecast keeps one row
+# of stage states per open order (a FeedProjection, so only orders whose stages changed are re-read)
+# and scores all rows in one numpy pass, cached until a row changes or FORECAST_CACHE_SECONDS elapse.
+FORECAST_HISTORY_DAYS = int(os.environ.get('FORECAST_HISTORY_DAYS', 180))
+FORECAST_MIN_SAMPLES = int(os.environ.get('FORECAST_MIN_SAMPLES', 5))
+FORECAST_DEFAULT_STAGE_HOURS = float(os.environ.get('FORECAST_DEFAULT_STAGE_HOURS', 24.0))
+FORECAST_REFRESH_SECONDS = float(os.environ.get('FORECAST_REFRESH_SECONDS', 1.0))
+FORECAST_CACHE_SECONDS = float(os.environ.get('FORECAST_CACHE_SECONDS', 60))
+FORECAST_RELOAD_SECONDS = float(os.environ.get('FORECAST_RELOAD_SECONDS', 3600))
+FORECAST_MAX_EVENTS = 5000
+# A stage running past its typical duration is still expected to need this share of it
+FORECAST_MIN_REMAINING_FRACTION = 0.1
+
+FORECAST_EVENT_COLLECTIONS = {
+    "order.created": "orders",
+    "order.status_changed": "orders",
+    "order.deleted": "orders",
+    "production_stage.created": "production_stages",
+    "production_stage.status_changed": "production_stages",
+}
+OPEN_ORDER_STATUSES = [OrderStatus.PENDING.value, OrderStatus.IN_PRODUCTION.value, OrderStatus.QUALITY_CHECK.value]
+STAGE_SEQUENCE = [stage.value for stage in ProductionStage]
+STAGE_INDEX = {stage: index for index, stage in enumerate(STAGE_SEQUENCE)}
+STAGE_STATES = {StageStatus.PENDING.value: 0, StageStatus.IN_PROGRESS.value: 1, StageStatus.COMPLETED.value: 2}
+
+def epoch_seconds(value) -> float:
+    """A stored ISO timestamp or date as epoch seconds (UTC when no offset is given), NaN if unparseable"""
+    if isinstance(value, datetime):
+        moment = value
+    else:
+        try:
+            moment = datetime.fromisoformat(value)
+        except (TypeError, ValueError):
+            return math.nan
+    if moment.tzinfo is None:
+        moment = moment.replace(tzinfo=timezone.utc)
+    return moment.timestamp()
+
+class DeliveryForecast(FeedProjection):
+    event_collections = FORECAST_EVENT_COLLECTIONS
+    
+    def __init__(self):
+        super().__init__(FORECAST_REFRESH_SECONDS, FORECAST_RELOAD_SECONDS, FORECAST_MAX_EVENTS)
+        # open order id -> (order summary, delivery epoch, stage states, stage start epochs)
+        self.rows: Dict[str, Tuple[dict, float, List[int], List[float]]] = {}
+        self.stage_hours = {}  # stage -> {"p50", "p80", "samples"}
+        self.ranked: Optional[List[dict]] = None
+        self.scored_at = 0.0
+    
+    async def stage_cycle_hours(self) -> dict:
+        cutoff = (datetime.now(timezone.utc) - timedelta(days=FORECAST_HISTORY_DAYS)).isoformat()
+        durations = {stage: [] for stage in STAGE_SEQUENCE}
+        async for stage in db.production_stages.find(
+            {"status": StageStatus.COMPLETED.value, "completed_at": {"$gte": cutoff}, "started_at": {"$ne": None}},
+            {"_id": 0, "stage": 1, "started_at": 1, "completed_at": 1}
+        ):
+            hours = (epoch_seconds(stage['completed_at']) - epoch_seconds(stage['started_at'])) / 3600
+            if hours >= 0 and stage['stage'] in durations:
+                durations[stage['stage']].append(hours)
+        stats = {}
+        for stage, samples in durations.items():
+            if len(samples) >= FORECAST_MIN_SAMPLES:
+                p50, p80 = np.percentile(samples, [50, 80])
+            else:
+                p50 = p80 = FORECAST_DEFAULT_STAGE_HOURS
+            stats[stage] = {"p50": float(p50), "p80": float(p80), "samples": len(samples)}
+        return stats
+    
+    async def load_orders(self, query: dict) -> Dict[str, tuple]:
+        orders = await db.orders.find(
+            {**query, "status": {"$in": OPEN_ORDER_STATUSES}},
+            {"_id": 0, "id": 1, "style_number": 1, "customer_name": 1, "delivery_date": 1, "status": 1}
+        ).to_list(None)
+        rows = {
+            order['id']: (order, epoch_seconds(order['delivery_date']),
+                          [0] * len(STAGE_SEQUENCE), [math.nan] * len(STAGE_SEQUENCE))
+            for order in orders
+        }
+        if rows:
+            async for stage in db.production_stages.find(
+                {"order_id": {"$in": list(rows)}},
+                {"_id": 0, "order_id": 1, "stage": 1, "status": 1, "started_at": 1}
+            ):
+                if stage.get('stage') not in STAGE_INDEX:
+                    continue  # A stage name outside ProductionStage has no cycle time to count
+                _, _, states, started = rows[stage['order_id']]
+                index = STAGE_INDEX[stage['stage']]
+                state = STAGE_STATES.get(stage.get('status'), 0)
+                # Rework can leave several records for one stage; the most advanced one counts
+                if state >= states[index]:
+                    states[index] = state
+                    started[index] = epoch_seconds(stage.get('started_at'))
+        return rows
+    
+    async def load_snapshot(self):
+        stage_hours = await self.stage_cycle_hours()
+        rows = await self.load_orders({})
+        self.stage_hours, self.rows, self.ranked = stage_hours, rows, None
+    
+    async def apply_changes(self, changed: Dict[str, set]):
+        order_ids = set(changed['orders'])
+        if changed['production_stages']:
+            async for stage in db.production_stages.find(
+                {"id": {"$in": list(changed['production_stages'])}}, {"_id": 0, "order_id": 1}
+            ):
+                order_ids.add(stage['order_id'])
+        if not order_ids:
+            return
+        rows = await self.load_orders({"id": {"$in": list(order_ids)}})
+        for order_id in order_ids:
+            if order_id in rows:
+                self.rows[order_id] = rows[order_id]
+            else:
+                self.rows.pop(order_id, None)
+        self.ranked = None
+    
+    def score(self) -> List[dict]:
+        """Forecast every open order at once; ranked by slack, least first"""
+        if not self.rows:
+            return []
+        now = time.time()
+        summaries = [row[0] for row in self.rows.values()]
+        delivery = np.array([row[1] for row in self.rows.values()])
+        states = np.array([row[2] for row in self.rows.values()])
+        started = np.array([row[3] for row in self.rows.values()])
+        elapsed = np.nan_to_num((now - started) / 3600)
+        
+        remaining = {}
+        for quantile in ("p50", "p80"):
+            typical = np.array([self.stage_hours[stage][quantile] for stage in STAGE_SEQUENCE])
+            in_progress = np.maximum(typical - elapsed, typical * FORECAST_MIN_REMAINING_FRACTION)
+            remaining[quantile] = np.where(states == 2, 0.0, np.where(states == 1, in_progress, typical)).sum(axis=1)
+        completion = now + remaining['p50'] * 3600
+        completion_p80 = now + remaining['p80'] * 3600
+        slack_hours = (delivery - completion) / 3600
+        risk = np.where(slack_hours < 0, "late", np.where(delivery < completion_p80, "at_risk", "on_track"))
+        # Unfinished stage furthest along, for display
+        current = np.where(states.min(axis=1) == 2, len(STAGE_SEQUENCE) - 1, np.argmin(states == 2, axis=1))
+        
+        ranked = []
+        for i in np.argsort(slack_hours, kind="stable"):  # NaN (unparseable delivery dates) sort last
+            order = summaries[i]
+            ranked.append({
+                "order_id": order['id'],
+                "style_number": order.get('style_number'),
+                "customer_name": order.get('customer_name'),
+                "status": order.get('status'),
+                "delivery_date": order.get('delivery_date'),
+                "current_stage": STAGE_SEQUENCE[current[i]],
+                "remaining_hours": round(float(remaining['p50'][i]), 1),
+                "forecast_completion": datetime.fromtimestamp(completion[i], timezone.utc).isoformat(),
+                "forecast_completion_p80": datetime.fromtimestamp(completion_p80[i], timezone.utc).isoformat(),
+                "slack_hours": None if math.isnan(slack_hours[i]) else round(float(slack_hours[i]), 1),
+                "risk": str(risk[i]) if not math.isnan(slack_hours[i]) else None,
+            })
+        return ranked
+    
+    async def forecast(self) -> List[dict]:
+        await self.refresh()
+        if self.ranked is None or time.monotonic() - self.scored_at > FORECAST_CACHE_SECONDS:
+            self.ranked = self.score()
+            self.scored_at = time.monotonic()
+        return self.ranked
+
+delivery_forecast = DeliveryForecast()
+
+
+# ==================== ORDER PIPELINE ====================
+# Order and production-stage statuses only move along these edges, and every move is appended to the
+# record's `transitions`. The pipeline_counters documents hold the number of orders per status and of
+# stages per (stage, status). They are $inc'd in the same transaction as the status change, so pipeline
+# and Kanban views read two small documents instead of counting. reconcile_pipeline_counters corrects
+# them from the records, for deployments without transactions and as a periodic check.
+ORDER_TRANSITIONS = {
+    OrderStatus.PENDING.value: {OrderStatus.IN_PRODUCTION.value},
+    OrderStatus.IN_PRODUCTION.value: {OrderStatus.QUALITY_CHECK.value},
+    OrderStatus.QUALITY_CHECK.value: {OrderStatus.IN_PRODUCTION.value, OrderStatus.COMPLETED.value},  # back for rework
+    OrderStatus.COMPLETED.value: {OrderStatus.SHIPPED.value},
+    OrderStatus.SHIPPED.value: set(),
+}
+STAGE_TRANSITIONS = {
+    StageStatus.PENDING.value: {StageStatus.IN_PROGRESS.value},
+    StageStatus.IN_PROGRESS.value: {StageStatus.PENDING.value, StageStatus.COMPLETED.value},
+    StageStatus.COMPLETED.value: {StageStatus.IN_PROGRESS.value},  # reopened for rework
+}
+PIPELINE_RECONCILE_INTERVAL_SECONDS = int(os.environ.get('PIPELINE_RECONCILE_INTERVAL_SECONDS', 3600))
+PIPELINE_RECONCILE_ATTEMPTS = 3
+
+def check_transition(transitions: Dict[str, set], current: Optional[str], target: str, label: str):
+    # Records whose status predates the state machine may move anywhere
+    if current in transitions and target not in transitions[current]:
+        raise HTTPException(status_code=409, detail=f"Cannot move {label} from {current} to {target}")
+
+def transition_entry(current: Optional[str], target: str, at: str) -> dict:
+    return {"transitions": {"from": current, "to": target, "at": at}}
+
+async def bump_pipeline_counts(kind: str, increments: Dict[str, int], session=None):
+    increments = {f"counts.{key}": value for key, value in increments.items() if key and value}
+    if increments:
+        await db.pipeline_counters.update_one({"_id": kind}, {"$inc": increments}, upsert=True, session=session)
+
+def stage_count_key(stage: str, status: Optional[str]) -> Optional[str]:
+    return f"{stage}.{status}" if status else None
+
+async def count_pipeline(kind: str) -> dict:
+    if kind == "orders":
+        return {
+            row['_id']: row['count'] async for row in db.orders.aggregate([
+                {"$group": {"_id": "$status", "count": {"$sum": 1}}}
+            ]) if row['_id']
+        }
+    stages: Dict[str, Dict[str, int]] = {}
+    async for row in db.production_stages.aggregate([
+        {"$group": {"_id": {"stage": "$stage", "status": "$status"}, "count": {"$sum": 1}}}
+    ]):
+        if row['_id'].get('stage') and row['_id'].get('status'):
+            stages.setdefault(row['_id']['stage'], {})[row['_id']['status']] = row['count']
+    return stages
+
+def flatten_counts(counts: dict, prefix: str = "") -> Dict[str, int]:
+    flat = {}
+    for key, value in counts.items():
+        if isinstance(value, dict):
+            flat.update(flatten_counts(value, f"{prefix}{key}."))
+        else:
+            flat[f"{prefix}{key}"] = value
+    return flat
+
+async def reconcile_pipeline_counters() -> dict:
+    """Recount orders per status and stages per (stage, status) and $inc the counters by the difference.
+    The counters are read before and after counting, and a kind whose counters moved meanwhile is
+    recounted (up to PIPELINE_RECONCILE_ATTEMPTS times, then left for the next pass). Transitions that
+    land after the count keep their own increments, as the correction is applied with $inc."""
+    result = {"corrected": [], "skipped": []}
+    for kind in ("orders", "production_stages"):
+        for _ in range(PIPELINE_RECONCILE_ATTEMPTS):
+            before = await db.pipeline_counters.find_one({"_id": kind})
+            counts = await count_pipeline(kind)
+            after = await db.pipeline_counters.find_one({"_id": kind})
+            if before == after:
+                break
+        else:
+            logger.warning("Pipeline counters for %s kept changing while being recounted; skipping", kind)
+            result['skipped'].append(kind)
+            result[kind] = counts
+            continue
+        
+        recorded = flatten_counts((before or {}).get('counts', {}))
+        actual = flatten_counts(counts)
+        deltas = {key: actual.get(key, 0) - recorded.get(key, 0) for key in set(recorded) | set(actual)}
+        if any(deltas.values()):
+            await bump_pipeline_counts(kind, deltas)
+            result['corrected'].append(kind)
+        result[kind] = counts
+    return result
+
+async def pipeline_counts(reader: ReadContext) -> dict:
+    docs = {
+        doc['_id']: doc.get('counts', {})
+        async for doc in reader.db.pipeline_counters.find({}, session=reader.session)
+    }
+    orders = {status.value: 0 for status in OrderStatus}
+    orders.update(docs.get("orders", {}))
+    stages = {stage.value: {status.value: 0 for status in StageStatus} for stage in ProductionStage}
+    for stage, counts in docs.get("production_stages", {}).items():
+        stages.setdefault(stage, {}).update(counts)
+    return {"orders": orders, "production_stages": stages}
+
+
+# ==================== PRESENCE ====================
+# Presence and typing state is ephemeral and never touches MongoDB. It lives in TTL hashes (namespace ->
+# user id -> entry): per process by default, or in Redis with PRESENCE_STORE=redis so that every worker
+# sees the same state. Clients heartbeat every few seconds; an entry that is not refreshed expires.
+# Stream subscribers get a channel's snapshot at most once per PRESENCE_BROADCAST_INTERVAL_SECONDS, and
+# only when it changed, however many heartbeats and keystrokes arrived in between.
+PRESENCE_STORE = os.environ.get('PRESENCE_STORE', 'local')
+PRESENCE_REDIS_URL = os.environ.get('PRESENCE_REDIS_URL', 'redis://localhost:6379/0')
+PRESENCE_TTL_SECONDS = float(os.environ.get('PRESENCE_TTL_SECONDS', 60))
+TYPING_TTL_SECONDS = float(os.environ.get('TYPING_TTL_SECONDS', 6))
+PRESENCE_BROADCAST_INTERVAL_SECONDS = float(os.environ.get('PRESENCE_BROADCAST_INTERVAL_SECONDS', 1.0))
+PRESENCE_CHANNEL_KINDS = ("conversation", "group", "department")
+TYPING_CHANNEL_KINDS = ("conversation", "group")
+
+class LocalPresenceStore:
+    def __init__(self):
+        self.hashes: Dict[str, Dict[str, Tuple[float, dict]]] = {}  # namespace -> field -> (expires_at, value)
+    
+    async def put(self, namespace: str, field: str, value: dict, ttl: float):
+        self.hashes.setdefault(namespace, {})[field] = (time.time() + ttl, value)
+    
+    async def remove(self, namespace: str, field: str):
+        fields = self.hashes.get(namespace)
+        if fields is not None:
+            fields.pop(field, None)
+            if not fields:
+                del self.hashes[namespace]
+    
+    async def read(self, namespace: str, fields: Optional[List[str]] = None) -> Dict[str, dict]:
+        now = time.time()
+        entries = self.hashes.get(namespace, {})
+        if fields is not None:
+            entries = {field: entries[field] for field in fields if field in entries}
+        return {field: value for field, (expires_at, value) in entries.items() if expires_at > now}
+    
+    def sweep(self):
+        now = time.time()
+        for namespace in list(self.hashes):
+            live = {field: entry for field, entry in self.hashes[namespace].items() if entry[0] > now}
+            if live:
+                self.hashes[namespace] = live
+            else:
+                del self.hashes[namespace]
+
+class RedisPresenceStore:
+    """Shared by all workers: one Redis hash per namespace, each field holding JSON with its own expiry"""
+    
+    def __init__(self, url: str):
+        self.redis = redis_asyncio.from_url(url, decode_responses=True)
+    
+    async def put(self, namespace: str, field: str, value: dict, ttl: float):
+        async with self.redis.pipeline(transaction=False) as pipe:
+            pipe.hset(namespace, field, json.dumps({"expires_at": time.time() + ttl, "value": value}))
+            # Fields of one namespace share a TTL, so the hash can go when its newest field does
+            pipe.expire(namespace, math.ceil(ttl))
+            await pipe.execute()
+    
+    async def remove(self, namespace: str, field: str):
+        await self.redis.hdel(namespace, field)
+    
+    async def read(self, namespace: str, fields: Optional[List[str]] = None) -> Dict[str, dict]:
+        if fields is None:
+            raw = await self.redis.hgetall(namespace)
+        else:
+            raw = dict(zip(fields, await self.redis.hmget(namespace, fields))) if fields else {}
+        now = time.time()
+        entries = {field: json.loads(value) for field, value in raw.items() if value}
+        return {field: entry['value'] for field, entry in entries.items() if entry['expires_at'] > now}
+    
+    def sweep(self):
+        pass  # Redis expires whole hashes; expired fields are filtered on read
+
+def make_presence_store():
+    if PRESENCE_STORE == "redis":
+        if redis_asyncio is not None:
+            return RedisPresenceStore(PRESENCE_REDIS_URL)
+        logging.warning("PRESENCE_STORE=redis but the redis package is not installed; presence stays per worker")
+    return LocalPresenceStore()
+
+presence_store = make_presence_store()
+
+def server_worker_count() -> int:
+    """Worker processes serving this app: uvicorn's --workers (spawned workers inherit the parent's
+    command line), else WEB_CONCURRENCY, which uvicorn and gunicorn also read"""
+    args = sys.argv[1:]
+    for index, arg in enumerate(args):
+        value = None
+        if arg in ("--workers", "-w") and index + 1 < len(args):
+            value = args[index + 1]
+        elif arg.startswith("--workers="):
+            value = arg.split("=", 1)[1]
+        if value is not None and value.isdigit():
+            return int(value)
+    value = os.environ.get('WEB_CONCURRENCY', '1')
+    return int(value) if value.isdigit() else 1
+
+def check_presence_store():
+    """Presence kept per process is wrong as soon as a second worker serves requests: a user's heartbeat
+    and the stream reading it land on different workers"""
+    workers = server_worker_count()
+    if workers > 1 and isinstance(presence_store, LocalPresenceStore):
+        logging.error(
+            f"Presence and typing state is kept per worker, but {workers} workers are serving requests: users "
+            f"show as offline to streams on other workers. Set PRESENCE_STORE=redis (needs the redis package)"
+        )
+
+def parse_channel(channel: str, kinds: Tuple[str, ...]) -> str:
+    kind, _, key = channel.partition(":")
+    if kind not in kinds or not key:
+        raise HTTPException(status_code=400, detail=f"Channel must look like <{'|'.join(kinds)}>:<id>, got {channel}")
+    return channel
+
+def presence_summary(entry: dict) -> dict:
+    # seen_at is left out so a heartbeat that changes nothing does not trigger a broadcast
+    return {"user_id": entry['user_id'], "user_name": entry.get('user_name'), "status": entry['status']}
+
+async def online_in_department(department: str) -> List[dict]:
+    entries = await presence_store.read(f"presence:department:{department}")
+    return sorted((presence_summary(entry) for entry in entries.values()), key=lambda entry: entry['user_id'])
+
+async def channel_snapshot(channel: str) -> dict:
+    kind, _, key = channel.partition(":")
+    if kind == "department":
+        return {"channel": channel, "online": await online_in_department(key)}
+    typing = await presence_store.read(f"typing:{channel}")
+    return {"channel": channel, "typing": sorted(typing.values(), key=lambda entry: entry['user_id'])}
+
+class PresenceSubscription:
+    """A stream's undelivered snapshots, at most one per channel: a newer snapshot replaces the pending
+    one, so a slow client skips stale states but always gets every channel's latest"""
+    
+    def __init__(self, channels: List[str]):
+        self.channels = channels
+        self.pending: Dict[str, dict] = {}  # channel -> latest snapshot, in the order channels changed
+        self.ready = asyncio.Event()
+    
+    def offer(self, channel: str, snapshot: dict):
+        self.pending.pop(channel, None)
+        self.pending[channel] = snapshot
+        self.ready.set()
+    
+    async def take(self, timeout: float) -> List[dict]:
+        """The pending snapshots, waiting up to `timeout` for one (raises asyncio.TimeoutError)"""
+        await asyncio.wait_for(self.ready.wait(), timeout)
+        self.ready.clear()
+        snapshots = list(self.pending.values())
+        self.pending.clear()
+        return snapshots
+
+class PresenceHub:
+    """Pushes channel snapshots to stream subscribers, at most once per interval and only on change"""
+    
+    def __init__(self):
+        self.subscribers: Dict[str, set] = {}  # channel -> subscriptions
+        self.last_sent: Dict[str, str] = {}
+    
+    def subscribe(self, channels: List[str]) -> PresenceSubscription:
+        subscription = PresenceSubscription(channels)
+        for channel in channels:
+            self.subscribers.setdefault(channel, set()).add(subscription)
+        return subscription
+    
+    def unsubscribe(self, subscription: PresenceSubscription):
+        for channel in subscription.channels:
+            subscriptions = self.subscribers.get(channel)
+            if subscriptions is not None:
+                subscriptions.discard(subscription)
+                if not subscriptions:
+                    del self.subscribers[channel]
+                    self.last_sent.pop(channel, None)
+    
+    async def broadcast(self):
+        for channel in list(self.subscribers):
+            snapshot = await channel_snapshot(channel)
+            encoded = json.dumps(snapshot, sort_keys=True)
+            if encoded == self.last_sent.get(channel):
+                continue
+            self.last_sent[channel] = encoded
+            for subscription in list(self.subscribers.get(channel, ())):
+                subscription.offer(channel, snapshot)
+    
+    async def run(self):
+        while True:
+            await asyncio.sleep(PRESENCE_BROADCAST_INTERVAL_SECONDS)
+            try:
+                presence_store.sweep()
+                await self.broadcast()
+            except Exception as e:
+                logging.error(f"Presence broadcast failed: {str(e)}")
+
+presence_hub = PresenceHub()
 
 
 # ==================== ROUTES ====================
@@ -608,98 +3217,208 @@ async def root():
 
 # ==================== ORDER ROUTES ====================
 @api_router.post("/orders", response_model=Order)
-async def create_order(order_input: OrderCreate):
-    order = Order(**order_input.model_dump())
+async def create_order(order_input: OrderCreate, response: Response, session=Depends(causal_write_session),
+                       idempotency: IdempotencyKey = Depends(idempotency_key("create_order"))):
+    existing = await idempotency.created(db.orders)
+    if existing:
+        return await idempotency.save(Order(**deserialize_doc(existing)), response)
+    order = Order(**order_input.model_dump(), id=idempotency.new_id())
     doc = order.model_dump()
     doc = serialize_doc(doc)
-    await db.orders.insert_one(doc)
-    return order
+    
+    async def insert(session):
+        await critical_db.orders.insert_one(doc, session=session)
+        await bump_pipeline_counts("orders", {order.status.value: 1}, session)
+        await record_event("order.created", order.id, {
+            "style_number": order.style_number, "customer_name": order.customer_name,
+            "total_quantity": order.total_quantity, "delivery_date": order.delivery_date, "status": order.status.value
+        }, session)
+    
+    await run_in_transaction(insert, session)
+    set_read_after(response, session)
+    return await idempotency.save(order, response)
 
 @api_router.get("/orders", response_model=List[Order])
-async def get_orders(status: Optional[str] = None):
+async def get_orders(status: Optional[str] = None, fields: Optional[str] = None,
+                     reader: ReadContext = Depends(read_context(ReadClass.LIST))):
     query = {}
     if status:
         query['status'] = status
-    orders = await db.orders.find(query, {"_id": 0}).to_list(1000)
+    projection = field_projection(fields, Order)
+    orders = await reader.db.orders.find(query, projection or {"_id": 0}, session=reader.session).to_list(1000)
+    if projection:
+        return JSONResponse(orders)
     orders = [deserialize_doc(order) for order in orders]
     return orders
 
 @api_router.get("/orders/{order_id}", response_model=Order)
-async def get_order(order_id: str):
-    order = await db.orders.find_one({"id": order_id}, {"_id": 0})
+async def get_order(order_id: str, fields: Optional[str] = None):
+    projection = field_projection(fields, Order)
+    order = await db.orders.find_one({"id": order_id}, projection or {"_id": 0})
     if not order:
         raise HTTPException(status_code=404, detail="Order not found")
+    if projection:
+        return JSONResponse(order)
     return deserialize_doc(order)
 
 @api_router.put("/orders/{order_id}")
-async def update_order(order_id: str, status: Optional[str] = None, notes: Optional[str] = None):
-    update_data = {"updated_at": datetime.now(timezone.utc).isoformat()}
-    if status:
-        update_data['status'] = status
+async def update_order(order_id: str, response: Response, session=Depends(causal_write_session),
+                       status: Optional[OrderStatus] = None, notes: Optional[str] = None,
+                       expected_version: Optional[int] = Depends(if_match_version)):
+    now = datetime.now(timezone.utc).isoformat()
+    update_data = {"updated_at": now}
     if notes is not None:
         update_data['notes'] = notes
     
-    result = await db.orders.update_one({"id": order_id}, {"$set": update_data})
-    if result.matched_count == 0:
-        raise HTTPException(status_code=404, detail="Order not found")
+    async def update(session):
+        current = None
+        if status:
+            order = await critical_db.orders.find_one({"id": order_id}, {"_id": 0, "status": 1}, session=session)
+            if not order:
+                raise HTTPException(status_code=404, detail="Order not found")
+            current = order.get('status')
+        if not status or status.value == current:
+            return await versioned_update(
+                critical_db.orders, order_id, update_data, expected_version, "Order not found", session
+            )
+        
+        check_transition(ORDER_TRANSITIONS, current, status.value, "order")
+        previous = await versioned_update(
+            critical_db.orders, order_id, {**update_data, "status": status.value}, expected_version,
+            "Order not found", session, expected_status=current, push=transition_entry(current, status.value, now)
+        )
+        await bump_pipeline_counts("orders", {current: -1, status.value: 1}, session)
+        await record_event("order.status_changed", order_id, {
+            "style_number": previous.get('style_number'), "from": current, "to": status.value
+        }, session)
+        return previous
+    
+    previous = await run_in_transaction(update, session)
+    response.headers['ETag'] = f'"{previous["version"]}"'
+    set_read_after(response, session)
     return {"message": "Order updated successfully"}
 
 @api_router.delete("/orders/{order_id}")
-async def delete_order(order_id: str):
-    result = await db.orders.delete_one({"id": order_id})
-    if result.deleted_count == 0:
-        raise HTTPException(status_code=404, detail="Order not found")
+async def delete_order(order_id: str, response: Response, session=Depends(causal_write_session)):
+    async def delete(session):
+        order = await critical_db.orders.find_one_and_delete({"id": order_id}, {"_id": 0, "status": 1}, session=session)
+        if not order:
+            raise HTTPException(status_code=404, detail="Order not found")
+        await bump_pipeline_counts("orders", {order.get('status'): -1}, session)
+        await record_event("order.deleted", order_id, {}, session)
+    
+    await run_in_transaction(delete, session)
+    set_read_after(response, session)
     return {"message": "Order deleted successfully"}
 
 
 # ==================== PRODUCTION ROUTES ====================
 @api_router.post("/production", response_model=ProductionStageRecord)
-async def create_production_stage(stage_input: ProductionStageCreate):
-    stage_record = ProductionStageRecord(**stage_input.model_dump())
+async def create_production_stage(stage_input: ProductionStageCreate, response: Response, session=Depends(causal_write_session)):
+    stage_data = stage_input.model_dump()
+    if stage_input.auto_assign and not stage_input.assigned_worker_id:
+        worker = await capacity_model.pick(STAGE_DEPARTMENTS[stage_input.stage.value], stage_input.required_skills)
+        stage_data['assigned_worker_id'] = worker['worker_id']
+    stage_record = ProductionStageRecord(**stage_data)
     doc = stage_record.model_dump()
     doc = serialize_doc(doc)
-    await db.production_stages.insert_one(doc)
+    
+    async def insert(session):
+        await critical_db.production_stages.insert_one(doc, session=session)
+        await bump_pipeline_counts("production_stages", {stage_count_key(doc['stage'], doc['status']): 1}, session)
+        await record_event("production_stage.created", stage_record.id, {
+            "order_id": stage_record.order_id, "stage": stage_record.stage.value,
+            "assigned_worker_id": stage_record.assigned_worker_id
+        }, session)
+    
+    with capacity_model.reserve_stage(doc):
+        await run_in_transaction(insert, session)
+    set_read_after(response, session)
     return stage_record
 
 @api_router.get("/production", response_model=List[ProductionStageRecord])
-async def get_production_stages(order_id: Optional[str] = None):
+async def get_production_stages(order_id: Optional[str] = None,
+                                reader: ReadContext = Depends(read_context(ReadClass.LIST))):
     query = {}
     if order_id:
         query['order_id'] = order_id
-    stages = await db.production_stages.find(query, {"_id": 0}).to_list(1000)
+    stages = await reader.db.production_stages.find(query, {"_id": 0}, session=reader.session).to_list(1000)
     stages = [deserialize_doc(stage) for stage in stages]
     return stages
 
 @api_router.put("/production/{stage_id}")
-async def update_production_stage(stage_id: str, status: Optional[str] = None, 
+async def update_production_stage(stage_id: str, response: Response, session=Depends(causal_write_session),
+                                 status: Optional[StageStatus] = None,
                                  started_at: Optional[str] = None,
-                                 completed_at: Optional[str] = None):
+                                 completed_at: Optional[str] = None,
+                                 expected_version: Optional[int] = Depends(if_match_version)):
+    now = datetime.now(timezone.utc).isoformat()
     update_data = {}
-    if status:
-        update_data['status'] = status
     if started_at:
         update_data['started_at'] = started_at
     if completed_at:
         update_data['completed_at'] = completed_at
     
-    result = await db.production_stages.update_one({"id": stage_id}, {"$set": update_data})
-    if result.matched_count == 0:
-        raise HTTPException(status_code=404, detail="Production stage not found")
+    async def update(session):
+        current = None
+        if status:
+            stage = await critical_db.production_stages.find_one(
+                {"id": stage_id}, {"_id": 0, "status": 1, "started_at": 1}, session=session
+            )
+            if not stage:
+                raise HTTPException(status_code=404, detail="Production stage not found")
+            current = stage.get('status')
+        if not status or status.value == current:
+            return await versioned_update(
+                critical_db.production_stages, stage_id, update_data, expected_version, "Production stage not found", session
+            )
+        
+        check_transition(STAGE_TRANSITIONS, current, status.value, "production stage")
+        transition_data = {**update_data, "status": status.value}
+        if status == StageStatus.IN_PROGRESS:
+            # A reopened or paused stage keeps its first start, so its cycle time covers the rework
+            if not stage.get('started_at'):
+                transition_data.setdefault('started_at', now)
+            transition_data.setdefault('completed_at', None)
+        elif status == StageStatus.COMPLETED:
+            transition_data.setdefault('completed_at', now)
+        previous = await versioned_update(
+            critical_db.production_stages, stage_id, transition_data, expected_version,
+            "Production stage not found", session, expected_status=current,
+            push=transition_entry(current, status.value, now)
+        )
+        await bump_pipeline_counts("production_stages", {
+            stage_count_key(previous['stage'], current): -1, stage_count_key(previous['stage'], status.value): 1
+        }, session)
+        await record_event("production_stage.status_changed", stage_id, {
+            "order_id": previous['order_id'], "stage": previous['stage'], "from": current, "to": status.value
+        }, session)
+        return previous
+    
+    previous = await run_in_transaction(update, session)
+    response.headers['ETag'] = f'"{previous["version"]}"'
+    set_read_after(response, session)
     return {"message": "Production stage updated successfully"}
 
 
 # ==================== MATERIAL ROUTES ====================
 @api_router.post("/materials", response_model=Material)
-async def create_material(material_input: MaterialCreate):
+async def create_material(material_input: MaterialCreate, response: Response, session=Depends(causal_write_session)):
     material = Material(**material_input.model_dump())
     doc = material.model_dump()
     doc = serialize_doc(doc)
-    await db.materials.insert_one(doc)
+    await db.materials.insert_one(doc, session=session)
+    await record_event("material.created", material.id, {
+        "name": material.name, "category": material.category, "unit": material.unit, "quantity": material.quantity
+    }, session)
+    await bump_collection_version("materials", session)
+    set_read_after(response, session)
     return material
 
-@api_router.get("/materials", response_model=List[Material])
-async def get_materials(low_stock: Optional[bool] = None):
-    materials = await db.materials.find({}, {"_id": 0}).to_list(1000)
+@api_router.get("/materials", response_model=List[Material], dependencies=[Depends(conditional_get("materials"))])
+async def get_materials(low_stock: Optional[bool] = None,
+                        reader: ReadContext = Depends(read_context(ReadClass.LIST))):
+    materials = await reader.db.materials.find({}, {"_id": 0}, session=reader.session).to_list(1000)
     materials = [deserialize_doc(mat) for mat in materials]
     
     if low_stock:
@@ -715,92 +3434,142 @@ async def get_material(material_id: str):
     return deserialize_doc(material)
 
 @api_router.put("/materials/{material_id}")
-async def update_material(material_id: str, quantity: Optional[float] = None, 
-                         unit_price: Optional[float] = None):
+async def update_material(material_id: str, response: Response, session=Depends(causal_write_session),
+                         quantity: Optional[float] = None,
+                         unit_price: Optional[float] = None,
+                         expected_version: Optional[int] = Depends(if_match_version)):
     update_data = {"last_updated": datetime.now(timezone.utc).isoformat()}
     if quantity is not None:
         update_data['quantity'] = quantity
     if unit_price is not None:
         update_data['unit_price'] = unit_price
     
-    result = await db.materials.update_one({"id": material_id}, {"$set": update_data})
-    if result.matched_count == 0:
-        raise HTTPException(status_code=404, detail="Material not found")
+    previous = await versioned_update(
+        db.materials, material_id, update_data, expected_version, "Material not found", session
+    )
+    if quantity is not None and quantity != previous.get('quantity'):
+        await record_event("material.quantity_changed", material_id, {
+            "name": previous['name'], "unit": previous['unit'], "from": previous.get('quantity'), "to": quantity,
+            "change": quantity - previous.get('quantity', 0)
+        }, session)
+    response.headers['ETag'] = f'"{previous["version"]}"'
+    await bump_collection_version("materials", session)
+    set_read_after(response, session)
     return {"message": "Material updated successfully"}
 
 @api_router.delete("/materials/{material_id}")
-async def delete_material(material_id: str):
-    result = await db.materials.delete_one({"id": material_id})
+async def delete_material(material_id: str, response: Response, session=Depends(causal_write_session)):
+    result = await db.materials.delete_one({"id": material_id}, session=session)
     if result.deleted_count == 0:
         raise HTTPException(status_code=404, detail="Material not found")
+    await record_event("material.deleted", material_id, {}, session)
+    await bump_collection_version("materials", session)
+    set_read_after(response, session)
     return {"message": "Material deleted successfully"}
 
 
 # ==================== SUPPLIER ROUTES ====================
 @api_router.post("/suppliers", response_model=Supplier)
-async def create_supplier(supplier_input: SupplierCreate):
+async def create_supplier(supplier_input: SupplierCreate, response: Response, session=Depends(causal_write_session)):
     supplier = Supplier(**supplier_input.model_dump())
     doc = supplier.model_dump()
     doc = serialize_doc(doc)
-    await db.suppliers.insert_one(doc)
+    await db.suppliers.insert_one(doc, session=session)
+    await bump_collection_version("suppliers", session)
+    set_read_after(response, session)
     return supplier
 
-@api_router.get("/suppliers", response_model=List[Supplier])
-async def get_suppliers():
-    suppliers = await db.suppliers.find({}, {"_id": 0}).to_list(1000)
+@api_router.get("/suppliers", response_model=List[Supplier], dependencies=[Depends(conditional_get("suppliers"))])
+async def get_suppliers(reader: ReadContext = Depends(read_context(ReadClass.LIST))):
+    suppliers = await reader.db.suppliers.find({}, {"_id": 0}, session=reader.session).to_list(1000)
     suppliers = [deserialize_doc(sup) for sup in suppliers]
     return suppliers
 
 @api_router.delete("/suppliers/{supplier_id}")
-async def delete_supplier(supplier_id: str):
-    result = await db.suppliers.delete_one({"id": supplier_id})
+async def delete_supplier(supplier_id: str, response: Response, session=Depends(causal_write_session)):
+    result = await db.suppliers.delete_one({"id": supplier_id}, session=session)
     if result.deleted_count == 0:
         raise HTTPException(status_code=404, detail="Supplier not found")
+    await bump_collection_version("suppliers", session)
+    set_read_after(response, session)
     return {"message": "Supplier deleted successfully"}
 
 
 # ==================== WORKER ROUTES ====================
 @api_router.post("/workers", response_model=Worker)
-async def create_worker(worker_input: WorkerCreate):
+async def create_worker(worker_input: WorkerCreate, response: Response, session=Depends(causal_write_session)):
     worker = Worker(**worker_input.model_dump())
     doc = worker.model_dump()
     doc = serialize_doc(doc)
-    await db.workers.insert_one(doc)
+    await db.workers.insert_one(doc, session=session)
+    await bump_collection_version("workers", session)
+    await record_event("worker.created", worker.id, {"department": worker.department}, session)
+    set_read_after(response, session)
     return worker
 
-@api_router.get("/workers", response_model=List[Worker])
-async def get_workers(department: Optional[str] = None, active: Optional[bool] = None):
+@api_router.get("/workers", response_model=List[Worker], dependencies=[Depends(conditional_get("workers"))])
+async def get_workers(department: Optional[str] = None, active: Optional[bool] = None,
+                      reader: ReadContext = Depends(read_context(ReadClass.LIST))):
     query = {}
     if department:
         query['department'] = department
     if active is not None:
         query['active'] = active
-    workers = await db.workers.find(query, {"_id": 0}).to_list(1000)
+    workers = await reader.db.workers.find(query, {"_id": 0}, session=reader.session).to_list(1000)
     workers = [deserialize_doc(worker) for worker in workers]
     return workers
 
 @api_router.put("/workers/{worker_id}")
-async def update_worker(worker_id: str, active: Optional[bool] = None):
+async def update_worker(worker_id: str, response: Response, session=Depends(causal_write_session), active: Optional[bool] = None):
     update_data = {}
     if active is not None:
         update_data['active'] = active
     
-    result = await db.workers.update_one({"id": worker_id}, {"$set": update_data})
+    result = await db.workers.update_one({"id": worker_id}, {"$set": update_data}, session=session)
     if result.matched_count == 0:
         raise HTTPException(status_code=404, detail="Worker not found")
+    await bump_collection_version("workers", session)
+    await record_event("worker.updated", worker_id, update_data, session)
+    set_read_after(response, session)
     return {"message": "Worker updated successfully"}
 
 @api_router.delete("/workers/{worker_id}")
-async def delete_worker(worker_id: str):
-    result = await db.workers.delete_one({"id": worker_id})
+async def delete_worker(worker_id: str, response: Response, session=Depends(causal_write_session)):
+    result = await db.workers.delete_one({"id": worker_id}, session=session)
     if result.deleted_count == 0:
         raise HTTPException(status_code=404, detail="Worker not found")
+    await bump_collection_version("workers", session)
+    await record_event("worker.deleted", worker_id, {}, session)
+    set_read_after(response, session)
     return {"message": "Worker deleted successfully"}
 
 
+# ==================== CAPACITY ROUTES ====================
+@api_router.get("/capacity/workers")
+async def get_worker_capacity(department: Optional[str] = None):
+    """Current load of every active worker, least loaded first"""
+    await capacity_model.refresh()
+    return capacity_model.candidates(department, [], len(capacity_model.workers))
+
+@api_router.get("/capacity/suggest")
+async def suggest_assignees(
+    department: Optional[str] = None,
+    stage: Optional[ProductionStage] = None,
+    skills: Optional[List[str]] = Query(None),
+    limit: int = Query(5, ge=1, le=50)
+):
+    """Qualified workers for a new task (by department) or production stage, least loaded first"""
+    if stage:
+        department = STAGE_DEPARTMENTS[stage.value]
+    if not department:
+        raise HTTPException(status_code=400, detail="Pass department or stage")
+    await capacity_model.refresh()
+    return capacity_model.candidates(department, skills or [], limit)
+
+
 # ==================== QUALITY CHECK ROUTES ====================
 @api_router.post("/quality-checks", response_model=QualityCheck)
-async def create_quality_check(qc_input: QualityCheckCreate):
+async def create_quality_check(qc_input: QualityCheckCreate, response: Response, session=Depends(causal_write_session)):
     qc = QualityCheck(**qc_input.model_dump())
     if len(qc.defects_found) == 0:
         qc.status = QCStatus.PASSED
@@ -809,37 +3578,66 @@ async def create_quality_check(qc_input: QualityCheckCreate):
     
     doc = qc.model_dump()
     doc = serialize_doc(doc)
-    await db.quality_checks.insert_one(doc)
+    # Stored with the check so defect reports can group by style without joining orders
+    order = await critical_db.orders.find_one({"id": qc.order_id}, {"_id": 0, "style_number": 1}, session=session)
+    doc['style_number'] = order.get('style_number') if order else None
+    await critical_db.quality_checks.insert_one(doc, session=session)
+    await record_rollups(*quality_check_rollup(doc))
+    await record_event("qc.recorded", qc.id, {
+        "order_id": qc.order_id, "stage": qc.stage.value, "status": qc.status.value,
+        "defects_found": qc.defects_found
+    }, session)
+    set_read_after(response, session)
     return qc
 
 @api_router.get("/quality-checks", response_model=List[QualityCheck])
-async def get_quality_checks(order_id: Optional[str] = None):
+async def get_quality_checks(order_id: Optional[str] = None,
+                             reader: ReadContext = Depends(read_context(ReadClass.LIST))):
     query = {}
     if order_id:
         query['order_id'] = order_id
-    qcs = await db.quality_checks.find(query, {"_id": 0}).to_list(1000)
+    qcs = await reader.db.quality_checks.find(query, {"_id": 0}, session=reader.session).to_list(1000)
     qcs = [deserialize_doc(qc) for qc in qcs]
     return qcs
 
 
 # ==================== TASK ROUTES ====================
-@api_router.post("/tasks", response_model=Task)
-async def create_task(task_input: TaskCreate):
+@api_router.post("/tasks", response_model=Task, dependencies=[Depends(concurrency_limit("task_fan_out"))])
+async def create_task(task_input: TaskCreate, idempotency: IdempotencyKey = Depends(idempotency_key("create_task"))):
     task_data = task_input.model_dump()
     initial_attachments = task_data.pop('initial_attachments', [])
     notify_users = task_data.pop('notify_users', [])
     notify_groups = task_data.pop('notify_groups', [])
     send_notifications = task_data.pop('send_notifications', True)
+    required_skills = task_data.pop('required_skills', [])
+    auto_assign = task_data.pop('auto_assign', False)
     
     # Validate attachment sizes (increased to 8MB for Base64 encoded data - 6MB file becomes ~8MB Base64)
     for att in initial_attachments:
         if att.get('file_url', '').startswith('data:') and len(att.get('file_url', '')) > 8000000:  # 8MB limit for data URLs
             raise HTTPException(status_code=413, detail=f"Attachment '{att.get('file_name', 'unknown')}' is too large. Maximum size is 6MB.")
     
-    task = Task(**{**task_data, 'notify_users': notify_users, 'notify_groups': notify_groups, 'send_notifications': send_notifications})
+    existing = await idempotency.created(db.tasks)
+    if existing:
+        return await idempotency.save(Task(**deserialize_doc(existing)))
+    
+    if not task_data['assigned_to']:
+        if not auto_assign:
+            raise HTTPException(status_code=422, detail="assigned_to is required unless auto_assign is set")
+        task_data['assigned_to'] = (await capacity_model.pick(task_data['department'], required_skills))['worker_id']
+    task = Task(**{**task_data, 'notify_users': notify_users, 'notify_groups': notify_groups,
+                   'send_notifications': send_notifications, 'id': idempotency.new_id()})
     doc = task.model_dump()
     doc = serialize_doc(doc)
-    await db.tasks.insert_one(doc)
+    doc['priority_rank'] = PRIORITY_RANK[task.priority]
+    doc['updated_at'] = doc['created_at']
+    with capacity_model.reserve_task(doc):
+        await db.tasks.insert_one(doc)
+    await inbox_add_task(doc)
+    await record_event("task.created", task.id, {
+        "title": task.title, "assigned_to": task.assigned_to, "department": task.department,
+        "priority": task.priority.value, "due_date": task.due_date
+    })
     
     # Add initial attachments if provided
     task_attachments = []
@@ -892,7 +3690,7 @@ async def create_task(task_input: TaskCreate):
         # Notify groups if specified (send as group messages)
         if notify_groups:
             for group_id in notify_groups:
-                group = await db.group_chats.find_one({"id": group_id}, {"_id": 0})
+                group = await db.group_chats.find_one({"id": group_id}, {"_id": 0, "members": 0})
                 if group:
                     try:
                         # Create task notification message in group chat
@@ -911,52 +3709,166 @@ async def create_task(task_input: TaskCreate):
                         
                         msg_doc = group_message.model_dump()
                         msg_doc = serialize_doc(msg_doc)
-                        await db.group_messages.insert_one(msg_doc)
-                        
-                        # Update group last message
-                        await db.group_chats.update_one(
-                            {"id": group_id},
-                            {"$set": {
-                                "last_message": f"🆕 New Task: {task.title}",
-                                "last_message_at": group_message.sent_at.isoformat()
-                            }}
-                        )
+                        await post_group_message(group, msg_doc, f"🆕 New Task: {task.title}")
                         
                     except Exception as e:
                         logging.error(f"Failed to send group message for task {task.id}: {str(e)}")
     
     
-    return task
+    return await idempotency.save(task)
 
 @api_router.get("/tasks", response_model=List[Task])
-async def get_tasks(status: Optional[str] = None, department: Optional[str] = None):
+async def get_tasks(status: Optional[str] = None, department: Optional[str] = None, fields: Optional[str] = None):
     query = {}
     if status:
         query['status'] = status
     if department:
         query['department'] = department
-    tasks = await db.tasks.find(query, {"_id": 0}).to_list(1000)
+    projection = field_projection(fields, Task)
+    tasks = await db.tasks.find(query, projection or {"_id": 0}).to_list(1000)
+    if projection:
+        return JSONResponse(tasks)
     tasks = [deserialize_doc(task) for task in tasks]
     return tasks
 
+TASK_SORT_FIELDS = {
+    "priority": "priority_rank",
+    "due_date": "due_date",
+    "created_at": "created_at",
+}
+
+# /tasks/query is served by compound indexes of [lead,] status, sort key. A query without a status
+# filter asks for every status, so the status prefix is always a set of points: the planner runs one
+# index scan per point and merges them in sort order (SORT_MERGE) instead of sorting in memory. Any
+# other filter (a second lead, a due-date range on another sort key) is checked on the fetched rows.
+TASK_QUERY_LEADS = ["assigned_to", "department", "tags", "priority_rank"]
+# mongod only splits an index walk into this many scans (internalQueryMaxScansToExplode)
+TASK_QUERY_MAX_SCANS = 200
+
+def task_query_index(lead: Optional[str], sort_field: str) -> List[Tuple[str, int]]:
+    keys = ([lead] if lead else []) + ["status"]
+    if sort_field not in keys:
+        keys.append(sort_field)
+    return [(key, 1) for key in keys]
+
+TASK_QUERY_INDEXES = [
+    task_query_index(lead, sort_field)
+    for lead in [None] + TASK_QUERY_LEADS
+    for sort_field in TASK_SORT_FIELDS.values()
+    if lead != sort_field
+]
+
+def point_count(condition) -> int:
+    if isinstance(condition, dict):
+        return len(condition['$in']) if '$in' in condition else 1
+    return 1
+
+def plan_task_query(query: dict, sort_field: str) -> List[Tuple[str, int]]:
+    """Pick the index for a /tasks/query filter; fills in the status points the index needs"""
+    query.setdefault('status', {"$in": [status.value for status in TaskStatus]})
+    lead = next((field for field in TASK_QUERY_LEADS if field in query and field != sort_field), None)
+    index = task_query_index(lead, sort_field)
+    scans = 1
+    for key, _ in index:
+        if key in query:
+            scans *= point_count(query[key])
+    if scans > TASK_QUERY_MAX_SCANS:
+        raise HTTPException(status_code=400, detail="Too many filter values to answer from an index, narrow the filter")
+    return index
+
+def task_query_filter(assigned_to: Optional[List[str]], status: Optional[List[TaskStatus]],
+                      priority: Optional[List[TaskPriority]], department: Optional[List[str]],
+                      due_from: Optional[str], due_to: Optional[str], tags: Optional[List[str]],
+                      tag_match: str) -> dict:
+    query = {}
+    status = [value.value for value in status] if status else None
+    for field, values in (("assigned_to", assigned_to), ("status", status), ("department", department)):
+        if values:
+            query[field] = values[0] if len(values) == 1 else {"$in": values}
+    if priority:
+        ranks = [PRIORITY_RANK[p] for p in priority]
+        query['priority_rank'] = ranks[0] if len(ranks) == 1 else {"$in": ranks}
+    if due_from or due_to:
+        query['due_date'] = {}
+        if due_from:
+            query['due_date']['$gte'] = due_from
+        if due_to:
+            query['due_date']['$lte'] = due_to
+    if tags:
+        query['tags'] = {"$all" if tag_match == "all" else "$in": tags}
+    return query
+
+@api_router.get("/tasks/query")
+async def query_tasks(
+    assigned_to: Optional[List[str]] = Query(None),
+    status: Optional[List[TaskStatus]] = Query(None),
+    priority: Optional[List[TaskPriority]] = Query(None),
+    department: Optional[List[str]] = Query(None),
+    due_from: Optional[str] = None,
+    due_to: Optional[str] = None,
+    tags: Optional[List[str]] = Query(None),
+    tag_match: str = Query("any", pattern="^(any|all)$"),
+    sort_by: str = Query("created_at", pattern="^(priority|due_date|created_at)$"),
+    order: str = Query("desc", pattern="^(asc|desc)$"),
+    skip: int = Query(0, ge=0),
+    limit: int = Query(100, ge=1, le=1000),
+    fields: Optional[str] = None,
+    explain: bool = False
+):
+    query = task_query_filter(assigned_to, status, priority, department, due_from, due_to, tags, tag_match)
+    
+    projection = field_projection(fields, Task)
+    sort_field = TASK_SORT_FIELDS[sort_by]
+    index = plan_task_query(query, sort_field)
+    cursor = db.tasks.find(query, projection or {"_id": 0}).sort(
+        sort_field, 1 if order == "asc" else -1
+    ).hint(index).skip(skip).limit(limit)
+    
+    if explain:
+        plan = await cursor.explain()
+        return {"query": query, "winning_plan": plan['queryPlanner']['winningPlan']}
+    
+    tasks = await cursor.to_list(limit)
+    if projection:
+        return JSONResponse(tasks)
+    tasks = [Task(**deserialize_doc(task)) for task in tasks]
+    return tasks
+
 @api_router.put("/tasks/{task_id}")
-async def update_task(task_id: str, status: Optional[str] = None):
-    update_data = {}
+async def update_task(task_id: str, response: Response, status: Optional[TaskStatus] = None,
+                      expected_version: Optional[int] = Depends(if_match_version)):
+    update_data = {"updated_at": datetime.now(timezone.utc).isoformat()}
+    status = status.value if status else None
     if status:
         update_data['status'] = status
         if status == "completed":
             update_data['completed_at'] = datetime.now(timezone.utc).isoformat()
     
-    result = await db.tasks.update_one({"id": task_id}, {"$set": update_data})
-    if result.matched_count == 0:
-        raise HTTPException(status_code=404, detail="Task not found")
+    previous = await versioned_update(db.tasks, task_id, update_data, expected_version, "Task not found")
+    if status and status != previous.get('status'):
+        await record_task_status_event(previous, status)
+        if status == TaskStatus.COMPLETED.value:
+            await record_rollups(*task_completion_rollup(previous, update_data['completed_at']))
+    response.headers['ETag'] = f'"{previous["version"]}"'
+    if status:
+        await inbox_update_task_status(previous, status)
     return {"message": "Task updated successfully"}
 
 @api_router.delete("/tasks/{task_id}")
 async def delete_task(task_id: str):
-    result = await db.tasks.delete_one({"id": task_id})
-    if result.deleted_count == 0:
+    async def delete_with_children(session):
+        task = await db.tasks.find_one_and_delete({"id": task_id}, {"_id": 0, "assigned_to": 1}, session=session)
+        if task is None:
+            return False
+        for collection in TASK_CHILD_COLLECTIONS:
+            await db[collection].delete_many({"task_id": task_id}, session=session)
+        await inbox_remove_task(task_id, session=session)
+        await record_event("task.deleted", task_id, {"assigned_to": task.get('assigned_to')}, session)
+        return True
+    
+    if not await run_in_transaction(delete_with_children):
         raise HTTPException(status_code=404, detail="Task not found")
+    activity_writer.discard_task(task_id)
     return {"message": "Task deleted successfully"}
 
 
@@ -989,6 +3901,7 @@ async def delete_task_comment(task_id: str, comment_id: str):
     result = await db.task_comments.delete_one({"id": comment_id, "task_id": task_id})
     if result.deleted_count == 0:
         raise HTTPException(status_code=404, detail="Comment not found")
+    await record_event("task_comment.deleted", comment_id, {"task_id": task_id})
     return {"message": "Comment deleted successfully"}
 
 
@@ -1003,6 +3916,7 @@ async def create_subtask(task_id: str, subtask_input: SubtaskCreate):
     subtask = Subtask(**subtask_input.model_dump())
     doc = subtask.model_dump()
     doc = serialize_doc(doc)
+    doc['updated_at'] = doc['created_at']
     await db.subtasks.insert_one(doc)
     
     return subtask
@@ -1015,9 +3929,11 @@ async def get_subtasks(task_id: str):
 
 @api_router.put("/tasks/{task_id}/subtasks/{subtask_id}")
 async def update_subtask(task_id: str, subtask_id: str, completed: bool):
+    now = datetime.now(timezone.utc).isoformat()
     update_data = {
         "completed": completed,
-        "completed_at": datetime.now(timezone.utc).isoformat() if completed else None
+        "completed_at": now if completed else None,
+        "updated_at": now
     }
     
     result = await db.subtasks.update_one({"id": subtask_id, "task_id": task_id}, {"$set": update_data})
@@ -1030,6 +3946,7 @@ async def delete_subtask(task_id: str, subtask_id: str):
     result = await db.subtasks.delete_one({"id": subtask_id, "task_id": task_id})
     if result.deleted_count == 0:
         raise HTTPException(status_code=404, detail="Subtask not found")
+    await record_event("subtask.deleted", subtask_id, {"task_id": task_id})
     return {"message": "Subtask deleted successfully"}
 
 
@@ -1066,7 +3983,7 @@ async def delete_attachment(task_id: str, attachment_id: str):
 
 
 # ==================== TIME LOGS ROUTES ====================
-@api_router.post("/tasks/{task_id}/time-logs", response_model=TimeLog)
+@api_router.post("/tasks/{task_id}/time-logs", response_model=TimeLog, dependencies=[Depends(rate_limit("time_logs"))])
 async def create_time_log(task_id: str, timelog_input: TimeLogCreate):
     # Verify task exists
     task = await db.tasks.find_one({"id": task_id})
@@ -1077,6 +3994,8 @@ async def create_time_log(task_id: str, timelog_input: TimeLogCreate):
     doc = timelog.model_dump()
     doc = serialize_doc(doc)
     await db.time_logs.insert_one(doc)
+    await record_rollups(*time_log_rollup(doc, task))
+    await record_event("task.time_logged", task_id, {"user_id": timelog.user_id, "hours": timelog.hours})
     
     # Log activity
     await log_activity(task_id, timelog_input.user_id, timelog_input.user_name, "logged_time", f"Logged {timelog_input.hours} hours")
@@ -1098,27 +4017,32 @@ async def get_total_hours(task_id: str):
 
 # ==================== ACTIVITY LOG ROUTES ====================
 @api_router.get("/tasks/{task_id}/activities", response_model=List[ActivityLog])
-async def get_task_activities(task_id: str):
-    activities = await db.activity_logs.find({"task_id": task_id}, {"_id": 0}).sort("created_at", -1).to_list(1000)
+async def get_task_activities(task_id: str, include_archive: bool = ARCHIVE_READ_THROUGH):
+    activities = await find_with_archive("activity_logs", {"task_id": task_id}, "created_at", 1000, include_archive)
+    activities = sorted(
+        activity_writer.pending_for_task(task_id) + activities, key=lambda a: a['created_at'], reverse=True
+    )[:1000]
     activities = [deserialize_doc(activity) for activity in activities]
     return activities
 
 
 # ==================== TASK TAGS ROUTES ====================
 @api_router.put("/tasks/{task_id}/tags")
-async def update_task_tags(task_id: str, tags: List[str]):
-    result = await db.tasks.update_one({"id": task_id}, {"$set": {"tags": tags}})
-    if result.matched_count == 0:
-        raise HTTPException(status_code=404, detail="Task not found")
+async def update_task_tags(task_id: str, tags: List[str], response: Response,
+                           expected_version: Optional[int] = Depends(if_match_version)):
+    # updated_at moves so offline tablets pick the new tags up in their sync delta
+    update_data = {"tags": tags, "updated_at": datetime.now(timezone.utc).isoformat()}
+    previous = await versioned_update(db.tasks, task_id, update_data, expected_version, "Task not found")
+    response.headers['ETag'] = f'"{previous["version"]}"'
     return {"message": "Tags updated successfully"}
 
 
 # ==================== CONVERSATIONS ROUTES (1-on-1 Chat) ====================
 @api_router.get("/conversations", response_model=List[Conversation])
 async def get_user_conversations(user_id: str):
-    conversations = await db.conversations.find({
-        "$or": [{"participant1_id": user_id}, {"participant2_id": user_id}]
-    }, {"_id": 0}).sort("last_message_at", -1).to_list(1000)
+    conversations = await db.conversations.find(
+        {"participants": user_id}, {"_id": 0}
+    ).sort("last_message_at", -1).to_list(1000)
     conversations = [deserialize_doc(conv) for conv in conversations]
     return conversations
 
@@ -1132,39 +4056,43 @@ async def create_conversation(conv_input: ConversationCreate):
     return existing
 
 @api_router.get("/conversations/{conversation_id}/messages", response_model=List[Message])
-async def get_conversation_messages(conversation_id: str, limit: Optional[int] = 50):
-    messages = await db.messages.find(
-        {"conversation_id": conversation_id}, 
-        {"_id": 0}
-    ).sort("sent_at", -1).limit(limit).to_list(limit or 50)
+async def get_conversation_messages(conversation_id: str, limit: Optional[int] = 50,
+                                    include_archive: bool = ARCHIVE_READ_THROUGH):
+    messages = await find_with_archive(
+        "messages", {"conversation_id": conversation_id}, "sent_at", limit or 50, include_archive
+    )
     
     messages = [deserialize_doc(msg) for msg in messages]
     return list(reversed(messages))  # Return in chronological order
 
-@api_router.post("/conversations/{conversation_id}/messages", response_model=Message)
-async def send_message(conversation_id: str, message_input: MessageCreate):
+@api_router.post("/conversations/{conversation_id}/messages", response_model=Message,
+                 dependencies=[Depends(rate_limit("messages"))])
+async def send_message(conversation_id: str, message_input: MessageCreate,
+                       idempotency: IdempotencyKey = Depends(idempotency_key("send_message"))):
     # Verify conversation exists
     conversation = await db.conversations.find_one({"id": conversation_id})
     if not conversation:
         raise HTTPException(status_code=404, detail="Conversation not found")
+    existing = await idempotency.created(db.messages)
+    if existing:
+        return await idempotency.save(Message(**deserialize_doc(existing)))
     
-    message = Message(**message_input.model_dump())
+    message = Message(**message_input.model_dump(), id=idempotency.new_id())
     doc = message.model_dump()
     doc = serialize_doc(doc)
     await db.messages.insert_one(doc)
     
     # Update conversation last message
-    await db.conversations.update_one(
-        {"id": conversation_id},
-        {"$set": {
-            "last_message": message.content[:100],
-            "last_message_at": message.sent_at.isoformat()
-        }}
-    )
+    last_message = {
+        "last_message": message.content[:100],
+        "last_message_at": message.sent_at.isoformat()
+    }
+    await db.conversations.update_one({"id": conversation_id}, {"$set": last_message})
+    await inbox_upsert_conversation({**conversation, **last_message})
     
-    return message
+    return await idempotency.save(message)
 
-@api_router.put("/conversations/{conversation_id}/messages/{message_id}/read")
+@api_router.put("/conversations/{conversation_id}/messages/{message_id}/read", dependencies=[Depends(rate_limit("mark_read"))])
 async def mark_message_read(conversation_id: str, message_id: str):
     result = await db.messages.update_one(
         {"id": message_id, "conversation_id": conversation_id},
@@ -1176,99 +4104,189 @@ async def mark_message_read(conversation_id: str, message_id: str):
 
 
 # ==================== GROUP CHAT ROUTES ====================
-@api_router.get("/groups", response_model=List[GroupChat])
-async def get_user_groups(user_id: Optional[str] = None):
+@api_router.get("/groups", response_model=List[GroupChat],
+                dependencies=[Depends(conditional_get("group_chats", ReadClass.PRIMARY, group_message_activity))])
+async def get_user_groups(user_id: Optional[str] = None, fields: Optional[str] = None):
     query = {}
     if user_id:
-        query = {"members": {"$elemMatch": {"user_id": user_id}}}
+        query = {"id": {"$in": await user_group_ids(user_id)}}
     
-    groups = await db.group_chats.find(query, {"_id": 0}).sort("last_message_at", -1).to_list(1000)
+    projection = field_projection(fields, GroupChat)
+    groups = await db.group_chats.find(query, projection or {"_id": 0}).sort("last_message_at", -1).to_list(1000)
+    if projection:
+        return JSONResponse(groups)
     groups = [deserialize_doc(group) for group in groups]
     return groups
 
+@api_router.get("/groups/unread")
+async def get_group_unread_counts(user_id: str):
+    """Unread messages per group for a user, counted from their read cursor (capped at 100)"""
+    return await group_unread_counts(user_id)
+
 @api_router.post("/groups", response_model=GroupChat)
 async def create_group_chat(group_input: GroupChatCreate):
-    group = GroupChat(**group_input.model_dump())
+    members = unique_group_members(group_input.members)
+    group = GroupChat(**{**group_input.model_dump(), "members": members}, member_count=len(members))
     doc = group.model_dump()
     doc = serialize_doc(doc)
-    await db.group_chats.insert_one(doc)
+    
+    async def insert(session):
+        # Memberships first: without a transaction a failure leaves unreachable rows, not a group nobody is in
+        if doc['members']:
+            await db.group_members.insert_many(group_member_rows(doc), ordered=False, session=session)
+        await db.group_chats.insert_one(doc, session=session)
+    
+    await run_in_transaction(insert)
+    await inbox_add_group(doc)
+    await bump_collection_version("group_chats")
     return group
 
 @api_router.get("/groups/{group_id}/messages", response_model=List[GroupMessage])
-async def get_group_messages(group_id: str, limit: Optional[int] = 50):
-    messages = await db.group_messages.find(
-        {"group_id": group_id}, 
-        {"_id": 0}
-    ).sort("sent_at", -1).limit(limit).to_list(limit or 50)
+async def get_group_messages(group_id: str, limit: Optional[int] = 50, fields: Optional[str] = None,
+                             include_archive: bool = ARCHIVE_READ_THROUGH):
+    projection = field_projection(fields, GroupMessage)
+    messages = await find_with_archive(
+        "group_messages", {"group_id": group_id}, "sent_at", limit or 50, include_archive, projection
+    )
+    if projection:
+        return JSONResponse(list(reversed(messages)))
     
     messages = [deserialize_doc(msg) for msg in messages]
     return list(reversed(messages))
 
-@api_router.post("/groups/{group_id}/messages", response_model=GroupMessage)
+@api_router.post("/groups/{group_id}/messages", response_model=GroupMessage,
+                 dependencies=[Depends(rate_limit("messages"))])
 async def send_group_message(group_id: str, message_input: GroupMessageCreate):
     # Verify group exists and user is member
-    group = await db.group_chats.find_one({"id": group_id})
+    group, is_member = await asyncio.gather(
+        db.group_chats.find_one({"id": group_id}, {"_id": 0, "id": 1, "member_count": 1}),
+        is_group_member(group_id, message_input.sender_id)
+    )
     if not group:
         raise HTTPException(status_code=404, detail="Group not found")
-    
-    # Check if sender is group member
-    is_member = any(member['user_id'] == message_input.sender_id for member in group['members'])
     if not is_member:
         raise HTTPException(status_code=403, detail="Not a member of this group")
     
     message = GroupMessage(**message_input.model_dump())
     doc = message.model_dump()
     doc = serialize_doc(doc)
-    await db.group_messages.insert_one(doc)
-    
-    # Update group last message
-    await db.group_chats.update_one(
-        {"id": group_id},
-        {"$set": {
-            "last_message": message.content[:100],
-            "last_message_at": message.sent_at.isoformat()
-        }}
-    )
+    await post_group_message(group, doc, message.content[:100])
     
     return message
 
-@api_router.put("/groups/{group_id}/messages/{message_id}/read")
+@api_router.put("/groups/{group_id}/messages/{message_id}/read", dependencies=[Depends(rate_limit("mark_read"))])
 async def mark_group_message_read(group_id: str, message_id: str, user_id: str):
-    # Add user to read_by list if not already there
-    result = await db.group_messages.update_one(
-        {"id": message_id, "group_id": group_id},
-        {"$addToSet": {"read_by": user_id}}
-    )
-    if result.matched_count == 0:
+    group = await db.group_chats.find_one({"id": group_id}, {"_id": 0, "member_count": 1})
+    if not group or not await advance_group_read_cursor(group_id, user_id, message_id):
         raise HTTPException(status_code=404, detail="Message not found")
+    if not fans_out_on_read(group):
+        # Add user to read_by list if not already there
+        await db.group_messages.update_one(
+            {"id": message_id, "group_id": group_id},
+            {"$addToSet": {"read_by": user_id}}
+        )
     return {"message": "Message marked as read"}
 
 
+# ==================== PRESENCE ROUTES ====================
+@api_router.post("/presence/heartbeat")
+async def presence_heartbeat(heartbeat: PresenceHeartbeat):
+    """Mark a user online or away for PRESENCE_TTL_SECONDS; clients repeat it well within that"""
+    entry = {**heartbeat.model_dump(mode="json"), "seen_at": datetime.now(timezone.utc).isoformat()}
+    namespaces = ["presence:users"]
+    if heartbeat.department:
+        namespaces.append(f"presence:department:{heartbeat.department}")
+    for namespace in namespaces:
+        if heartbeat.status == PresenceStatus.OFFLINE:
+            await presence_store.remove(namespace, heartbeat.user_id)
+        else:
+            await presence_store.put(namespace, heartbeat.user_id, entry, PRESENCE_TTL_SECONDS)
+    return {"status": heartbeat.status.value, "ttl_seconds": PRESENCE_TTL_SECONDS}
+
+@api_router.post("/presence/typing")
+async def presence_typing(update: TypingUpdate):
+    namespace = f"typing:{parse_channel(update.channel, TYPING_CHANNEL_KINDS)}"
+    if update.typing:
+        await presence_store.put(namespace, update.user_id,
+                                 {"user_id": update.user_id, "user_name": update.user_name}, TYPING_TTL_SECONDS)
+    else:
+        await presence_store.remove(namespace, update.user_id)
+    return {"typing": update.typing}
+
+@api_router.get("/presence")
+async def get_presence(user_ids: List[str] = Query(...)):
+    """Status of each requested user; users without a live heartbeat are offline"""
+    entries = await presence_store.read("presence:users", user_ids)
+    return {
+        user_id: entries[user_id] if user_id in entries else {"user_id": user_id, "status": PresenceStatus.OFFLINE.value}
+        for user_id in user_ids
+    }
+
+@api_router.get("/presence/department/{department}")
+async def get_department_presence(department: str):
+    """Who is online or away in a department, served from memory"""
+    return await online_in_department(department)
+
+@api_router.get("/presence/stream")
+async def stream_presence(request: Request, channels: List[str] = Query(...)):
+    """Server-sent presence snapshots for conversation:, group: and department: channels, the current
+    state first and then at most one update per channel per broadcast interval"""
+    channels = [parse_channel(channel, PRESENCE_CHANNEL_KINDS) for channel in channels]
+    
+    async def stream():
+        subscription = presence_hub.subscribe(channels)
+        try:
+            for channel in channels:
+                yield f"event: presence\ndata: {json.dumps(await channel_snapshot(channel))}\n\n"
+            last_sent = time.monotonic()
+            while not shutting_down and not await request.is_disconnected():
+                try:
+                    snapshots = await subscription.take(EVENT_POLL_INTERVAL_SECONDS)
+                except asyncio.TimeoutError:
+                    if time.monotonic() - last_sent >= EVENT_HEARTBEAT_SECONDS:
+                        yield ": keep-alive\n\n"
+                        last_sent = time.monotonic()
+                    continue
+                for snapshot in snapshots:
+                    yield f"event: presence\ndata: {json.dumps(snapshot)}\n\n"
+                last_sent = time.monotonic()
+        finally:
+            presence_hub.unsubscribe(subscription)
+    
+    return StreamingResponse(stream(), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+
 # ==================== TASK NOTIFICATIONS ROUTES ====================
 @api_router.get("/notifications", response_model=List[TaskNotification])
-async def get_user_notifications(user_id: str, unread_only: Optional[bool] = False):
+async def get_user_notifications(user_id: str, unread_only: Optional[bool] = False,
+                                 include_archive: bool = ARCHIVE_READ_THROUGH):
     query = {"recipient_id": user_id}
     if unread_only:
         query["read"] = False
     
-    notifications = await db.task_notifications.find(
-        query, {"_id": 0}
-    ).sort("created_at", -1).to_list(1000)
+    notifications = await find_with_archive("task_notifications", query, "created_at", 1000, include_archive)
     
     notifications = [deserialize_doc(notif) for notif in notifications]
     return notifications
 
-@api_router.put("/notifications/{notification_id}/read")
+@api_router.put("/notifications/{notification_id}/read", dependencies=[Depends(rate_limit("mark_read"))])
 async def mark_notification_read(notification_id: str):
-    result = await db.task_notifications.update_one(
-        {"id": notification_id},
-        {"$set": {
-            "read": True,
-            "read_at": datetime.now(timezone.utc).isoformat()
-        }}
-    )
-    if result.matched_count == 0:
+    mark_read = {"$set": {
+        "read": True,
+        "read_at": datetime.now(timezone.utc).isoformat()
+    }}
+    projection = {"_id": 0, "recipient_id": 1, "read": 1}
+    previous = await db.task_notifications.find_one_and_update({"id": notification_id}, mark_read, projection=projection)
+    if not previous:
+        # Unread notifications can be archived; the inbox keeps counting them until they are read
+        previous = await db.task_notifications_archive.find_one_and_update(
+            {"id": notification_id}, mark_read, projection=projection
+        )
+    if not previous:
         raise HTTPException(status_code=404, detail="Notification not found")
+    if not previous.get('read'):
+        await inbox_mark_notification_read(previous['recipient_id'], notification_id)
     return {"message": "Notification marked as read"}
 
 @api_router.put("/notifications/{notification_id}/action")
@@ -1290,39 +4308,49 @@ async def complete_task_interactive(task_id: str, completion_input: TaskCompleti
     if not task:
         raise HTTPException(status_code=404, detail="Task not found")
     
-    # Create completion record
     completion = TaskCompletion(**completion_input.model_dump())
     doc = completion.model_dump()
     doc = serialize_doc(doc)
-    await db.task_completions.insert_one(doc)
-    
-    # Update task status
-    await db.tasks.update_one(
-        {"id": task_id},
-        {"$set": {
-            "status": completion_input.completion_status,
-            "completed_at": completion.completed_at.isoformat()
-        }}
-    )
     
-    # Log activity
-    await log_activity(task_id, completion_input.completed_by, completion_input.completed_by_name, "completed_interactive", f"Completed task with notes: {completion_input.completion_notes[:50]}...")
+    # Resolve who to notify before the transaction so it only contains writes
+    creator = None
+    if task.get('send_notifications', True) and task.get('created_by') and task['created_by'] != completion_input.completed_by:
+        creator = await db.workers.find_one({"id": task['created_by']}, {"_id": 0})
     
-    # Send completion notification to relevant parties
-    if task.get('send_notifications', True):
-        task_dict = deserialize_doc(task)
-        completion_dict = completion.model_dump()
+    async def record_completion(session):
+        # Create completion record
+        await db.task_completions.insert_one(dict(doc), session=session)
+        
+        # Update task status
+        await db.tasks.update_one(
+            {"id": task_id},
+            {"$set": {
+                "status": completion_input.completion_status,
+                "completed_at": completion.completed_at.isoformat(),
+                "updated_at": completion.completed_at.isoformat()
+            }, "$inc": {"version": 1}},
+            session=session
+        )
+        await inbox_update_task_status(task, completion_input.completion_status, session=session)
+        await record_task_status_event(task, completion_input.completion_status, session=session)
+        
+        # Log activity
+        await log_activity(task_id, completion_input.completed_by, completion_input.completed_by_name, "completed_interactive", f"Completed task with notes: {completion_input.completion_notes[:50]}...", session=session)
         
         # Notify task creator
-        if task.get('created_by') and task['created_by'] != completion_input.completed_by:
-            creator = await db.workers.find_one({"id": task['created_by']}, {"_id": 0})
-            if creator:
-                await send_task_notification(
-                    {**task_dict, 'completion_details': completion_dict},
-                    "task_completed",
-                    [{"user_id": task['created_by'], "user_name": creator['name']}]
-                )
+        if creator:
+            task_dict = deserialize_doc(dict(task))
+            completion_dict = completion.model_dump()
+            await send_task_notification(
+                {**task_dict, 'completion_details': completion_dict},
+                "task_completed",
+                [{"user_id": task['created_by'], "user_name": creator['name']}],
+                session=session
+            )
     
+    await run_in_transaction(record_completion)
+    if completion_input.completion_status == TaskStatus.COMPLETED.value and task.get('status') != TaskStatus.COMPLETED.value:
+        await record_rollups(*task_completion_rollup(task, completion.completed_at, completion.actual_hours))
     return completion
 
 @api_router.get("/tasks/{task_id}/completions", response_model=List[TaskCompletion])
@@ -1335,21 +4363,464 @@ async def get_task_completions(task_id: str):
     return completions
 
 
+# ==================== SYNC ROUTES (offline tablets) ====================
+# A tablet coming back online replays its queued writes in one POST /api/sync. Every operation is
+# written so that applying it twice changes nothing (creates upsert on the op_id, updates use $set or
+# $addToSet), so sync_operations only has to remember outcomes: a replayed op_id gets its original
+# result back and never reaches the target collection again.
+# The response also carries rows changed since the client's sync token. Tokens overlap by
+# SYNC_TOKEN_OVERLAP_SECONDS so writes in flight when the token was cut are not lost; clients apply
+# delta rows by id, so the repeats are harmless.
+# Deletions have no row left to send: `removed` lists the ids deleted since the token, read from the
+# *.deleted events of the change feed. A token older than the feed's retention cannot be answered that
+# way, so the client gets `reset: true` and every row in scope, and drops whatever it held before.
+SYNC_MAX_OPERATIONS = int(os.environ.get('SYNC_MAX_OPERATIONS', 500))
+SYNC_DELTA_LIMIT = int(os.environ.get('SYNC_DELTA_LIMIT', 1000))
+SYNC_TOKEN_OVERLAP_SECONDS = int(os.environ.get('SYNC_TOKEN_OVERLAP_SECONDS', 5))
+SYNC_OPERATION_TTL_HOURS = int(os.environ.get('SYNC_OPERATION_TTL_HOURS', 72))
+
+# collection -> (change timestamp field, how rows are scoped to the syncing user)
+SYNC_DELTA_SOURCES = {
+    "tasks": ("updated_at", "assignee"),
+    "subtasks": ("updated_at", "own_tasks"),
+    "task_comments": ("created_at", "own_tasks"),
+    "time_logs": ("logged_at", "own_tasks"),
+    "task_notifications": ("created_at", "recipient"),
+}
+
+# collection -> (change feed event of a deletion, how it is scoped to the syncing user). A deleted
+# task's subtasks, comments and time logs go with it: clients drop a removed task's children.
+SYNC_REMOVAL_EVENTS = {
+    "tasks": ("task.deleted", "assignee"),
+    "subtasks": ("subtask.deleted", "own_tasks"),
+    "task_comments": ("task_comment.deleted", "own_tasks"),
+}
+
+TASK_SCOPED_SYNC_OPERATIONS = {
+    SyncOperationType.UPDATE_TASK, SyncOperationType.UPDATE_SUBTASK,
+    SyncOperationType.CREATE_TIME_LOG, SyncOperationType.CREATE_TASK_COMMENT,
+}
+
+class SyncBatch:
+    """New operations of one sync request, grouped into one bulk_write per collection"""
+    
+    def __init__(self):
+        self.writes: Dict[str, List[Tuple[str, dict, UpdateOne]]] = {}  # collection -> (op_id, filter, write)
+        self.follow_ups: Dict[str, List] = {}  # op_id -> callables run once its write succeeded
+        self.results: Dict[str, dict] = {}
+    
+    def add(self, op_id: str, collection: str, query: dict, update: dict, *follow_ups, upsert: bool = False):
+        self.writes.setdefault(collection, []).append((op_id, None if upsert else query,
+                                                       UpdateOne(query, update, upsert=upsert)))
+        self.follow_ups[op_id] = list(follow_ups)
+    
+    async def apply(self):
+        for collection, entries in self.writes.items():
+            failed = {}
+            try:
+                outcome = (await db[collection].bulk_write([write for _, _, write in entries], ordered=False)).bulk_api_result
+            except BulkWriteError as e:
+                outcome = e.details
+                failed = {error['index']: error['errmsg'] for error in e.details['writeErrors']}
+            # An upsert that found its row already there (the same op applied before its outcome was
+            # recorded) changed nothing, so its follow-ups already ran too
+            upserted = {entry['index'] for entry in outcome.get('upserted', [])}
+            missing = set()
+            if outcome['nMatched'] + outcome['nUpserted'] < len(entries) - len(failed):
+                # The counts are per batch, so find the updates that matched nothing. Sync never deletes
+                # and filters only use immutable ids, so a row that matched the write still matches now.
+                for index, (_, query, _) in enumerate(entries):
+                    if index not in failed and query is not None and not await db[collection].find_one(query, {"_id": 1}):
+                        missing.add(index)
+            for index, (op_id, query, _) in enumerate(entries):
+                if index in failed:
+                    self.results[op_id] = {"status": "rejected", "error": failed[index]}
+                    continue
+                if index in missing:
+                    self.results[op_id] = {"status": "not_found"}
+                    continue
+                self.results[op_id] = {"status": "applied"}
+                if query is None and index not in upserted:
+                    continue
+                for follow_up in self.follow_ups[op_id]:
+                    await follow_up()
+
+def plan_sync_operation(batch: SyncBatch, operation: SyncOperation, user_id: str,
+                        known_tasks: Dict[str, dict], unread_notifications: Dict[str, str]):
+    """Turn one operation into its write; raises ValueError/KeyError when the operation is invalid"""
+    data = operation.data
+    now = datetime.now(timezone.utc).isoformat()
+    if operation.type in TASK_SCOPED_SYNC_OPERATIONS and data.get('task_id') not in known_tasks:
+        raise ValueError("Task not found")
+    
+    if operation.type == SyncOperationType.UPDATE_TASK:
+        status = TaskStatus(data['status']).value
+        update_data = {"status": status, "updated_at": now}
+        if status == TaskStatus.COMPLETED.value:
+            update_data['completed_at'] = now
+        task = known_tasks[data['task_id']]
+        follow_ups = [lambda: inbox_update_task_status(task, status)]
+        if status != task.get('status'):
+            follow_ups.append(lambda: record_task_status_event(task, status))
+        if status == TaskStatus.COMPLETED.value and task.get('status') != status:
+            follow_ups.append(lambda: record_rollups(*task_completion_rollup(task, now)))
+        batch.add(operation.op_id, "tasks", {"id": task['id']},
+                  {"$set": update_data, "$inc": {"version": 1}}, *follow_ups)
+    elif operation.type == SyncOperationType.UPDATE_SUBTASK:
+        completed = bool(data['completed'])
+        batch.add(operation.op_id, "subtasks", {"id": data['subtask_id'], "task_id": data['task_id']},
+                  {"$set": {"completed": completed, "completed_at": now if completed else None, "updated_at": now}})
+    elif operation.type == SyncOperationType.CREATE_TIME_LOG:
+        timelog = TimeLog(**{**data, "id": operation.op_id})
+        timelog_doc = serialize_doc(timelog.model_dump())
+        batch.add(operation.op_id, "time_logs", {"id": timelog.id}, {"$setOnInsert": timelog_doc},
+                  lambda: log_activity(timelog.task_id, timelog.user_id, timelog.user_name, "logged_time", f"Logged {timelog.hours} hours"),
+                  lambda: record_rollups(*time_log_rollup(timelog_doc, known_tasks[timelog.task_id])),
+                  lambda: record_event("task.time_logged", timelog.task_id, {"user_id": timelog.user_id, "hours": timelog.hours}),
+                  upsert=True)
+    elif operation.type == SyncOperationType.CREATE_TASK_COMMENT:
+        comment = TaskComment(**{**data, "id": operation.op_id})
+        batch.add(operation.op_id, "task_comments", {"id": comment.id}, {"$setOnInsert": serialize_doc(comment.model_dump())},
+                  lambda: log_activity(comment.task_id, comment.user_id, comment.user_name, "commented", "Added a comment"),
+                  upsert=True)
+    elif operation.type == SyncOperationType.MARK_MESSAGE_READ:
+        batch.add(operation.op_id, "messages", {"id": data['message_id'], "conversation_id": data['conversation_id']},
+                  {"$set": {"read_by_recipient": True}})
+    elif operation.type == SyncOperationType.MARK_GROUP_MESSAGE_READ:
+        reader_id = data.get('user_id', user_id)
+        batch.add(operation.op_id, "group_messages", {"id": data['message_id'], "group_id": data['group_id']},
+                  {"$addToSet": {"read_by": reader_id}},
+                  lambda: advance_group_read_cursor(data['group_id'], reader_id, data['message_id']))
+    elif operation.type == SyncOperationType.MARK_NOTIFICATION_READ:
+        notification_id = data['notification_id']
+        follow_ups = []
+        if notification_id in unread_notifications:
+            recipient_id = unread_notifications.pop(notification_id)
+            follow_ups.append(lambda: inbox_mark_notification_read(recipient_id, notification_id))
+        batch.add(operation.op_id, "task_notifications", {"id": notification_id},
+                  {"$set": {"read": True, "read_at": now}}, *follow_ups)
+
+async def sync_removals(user_id: str, since: str, own_task_ids: List[str]) -> Dict[str, List[str]]:
+    """Ids deleted since the token, per collection, from the change feed"""
+    scopes = {
+        "assignee": {"data.assigned_to": user_id},
+        "own_tasks": {"data.task_id": {"$in": own_task_ids}},
+    }
+    events = await db.events.find({
+        "recorded_at": {"$gte": as_utc(since)},
+        "$or": [{"type": event_type, **scopes[scope]} for event_type, scope in SYNC_REMOVAL_EVENTS.values()],
+    }, {"_id": 0, "type": 1, "entity_id": 1}).to_list(None)
+    return {
+        collection: [event['entity_id'] for event in events if event['type'] == event_type]
+        for collection, (event_type, _) in SYNC_REMOVAL_EVENTS.items()
+    }
+
+async def sync_delta(user_id: str, since: Optional[str]) -> Tuple[dict, dict, str, bool, bool]:
+    now = datetime.now(timezone.utc)
+    next_token = (now - timedelta(seconds=SYNC_TOKEN_OVERLAP_SECONDS)).isoformat()
+    reset = since is not None and as_utc(since) < now - timedelta(days=EVENT_RETENTION_DAYS)
+    if reset:
+        since = None
+    own_task_ids = await db.tasks.distinct("id", {"assigned_to": user_id})
+    scopes = {
+        "assignee": {"assigned_to": user_id},
+        "own_tasks": {"task_id": {"$in": own_task_ids}},
+        "recipient": {"recipient_id": user_id},
+    }
+    
+    async def changed_rows(collection: str, field: str, scope: str) -> List[dict]:
+        query = dict(scopes[scope])
+        if since:
+            query[field] = {"$gte": since}
+        return await db[collection].find(query, {"_id": 0}).sort(field, 1).to_list(SYNC_DELTA_LIMIT)
+    
+    rows = await asyncio.gather(*(
+        changed_rows(collection, field, scope) for collection, (field, scope) in SYNC_DELTA_SOURCES.items()
+    ))
+    changes = dict(zip(SYNC_DELTA_SOURCES, rows))
+    removed = (await sync_removals(user_id, since, own_task_ids) if since
+               else {collection: [] for collection in SYNC_REMOVAL_EVENTS})
+    has_more = False
+    for collection, (field, _) in SYNC_DELTA_SOURCES.items():
+        if len(changes[collection]) == SYNC_DELTA_LIMIT:
+            # Resume from the last row returned; the client pages by syncing again straight away
+            has_more = True
+            next_token = min(next_token, changes[collection][-1][field])
+    return changes, removed, next_token, has_more, reset
+
+@api_router.post("/sync")
+async def sync(request: SyncRequest):
+    if len(request.operations) > SYNC_MAX_OPERATIONS:
+        raise HTTPException(status_code=413, detail=f"At most {SYNC_MAX_OPERATIONS} operations per sync")
+    # Normalized to the stored +00:00 form, so a client token ending in Z compares correctly
+    since = iso_bound(request.since) if request.since else None
+    
+    # Replays: operations already recorded for this client get their stored result back
+    keys = {op.op_id: f"{request.client_id}:{op.op_id}" for op in request.operations}
+    recorded = {
+        doc['op_id']: doc['result']
+        for doc in await db.sync_operations.find({"_id": {"$in": list(keys.values())}}).to_list(None)
+    }
+    new_operations = list({op.op_id: op for op in request.operations if op.op_id not in recorded}.values())
+    
+    # One lookup each for the task and notification state the operations depend on
+    task_ids = {op.data.get('task_id') for op in new_operations if op.type in TASK_SCOPED_SYNC_OPERATIONS}
+    known_tasks = {
+        task['id']: task
+        for task in await db.tasks.find(
+            {"id": {"$in": list(task_ids)}}, {"_id": 0, "id": 1, "title": 1, "assigned_to": 1, "status": 1, "department": 1, "estimated_hours": 1}
+        ).to_list(None)
+    } if task_ids else {}
+    notification_ids = [op.data.get('notification_id') for op in new_operations
+                        if op.type == SyncOperationType.MARK_NOTIFICATION_READ]
+    unread_notifications = {
+        doc['id']: doc['recipient_id']
+        for doc in await db.task_notifications.find(
+            {"id": {"$in": notification_ids}, "read": False}, {"_id": 0, "id": 1, "recipient_id": 1}
+        ).to_list(None)
+    } if notification_ids else {}
+    
+    batch = SyncBatch()
+    for op in new_operations:
+        try:
+            plan_sync_operation(batch, op, request.user_id, known_tasks, unread_notifications)
+        except (ValueError, KeyError) as e:
+            batch.results[op.op_id] = {"status": "rejected", "error": str(e)}
+    await batch.apply()
+    
+    if batch.results:
+        now = datetime.now(timezone.utc)
+        try:
+            await db.sync_operations.insert_many([
+                {"_id": keys[op_id], "op_id": op_id, "result": result, "created_at": now}
+                for op_id, result in batch.results.items()
+            ], ordered=False)
+        except BulkWriteError:
+            # A concurrent replay of the same batch recorded these first; both applied the same writes
+            pass
+    
+    changes, removed, sync_token, has_more, reset = await sync_delta(request.user_id, since)
+    results = [
+        {"op_id": op.op_id, **recorded[op.op_id], "replayed": True} if op.op_id in recorded
+        else {"op_id": op.op_id, **batch.results[op.op_id]}
+        for op in request.operations
+    ]
+    return {"results": results, "changes": changes, "removed": removed, "reset": reset,
+            "sync_token": sync_token, "has_more": has_more}
+
+
+# ==================== EVENT FEED ROUTES ====================
+def parse_event_types(types: Optional[str]) -> Optional[List[str]]:
+    return [name.strip() for name in types.split(",") if name.strip()] if types else None
+
+async def resume_cursor(after: Optional[int]) -> int:
+    """Where a consumer starts reading; 410 when its position has aged out of the retained events"""
+    oldest = await oldest_event_seq()
+    if after is None:
+        return oldest - 1 if oldest else 0
+    if oldest is not None and after < oldest - 1:
+        raise HTTPException(status_code=410, detail="Resume token is older than the retained events; resync from the list endpoints")
+    return after
+
+@api_router.get("/events")
+async def get_events(after: Optional[int] = Query(None, ge=0), types: Optional[str] = None,
+                     limit: int = Query(100, ge=1, le=1000), wait: float = Query(0, ge=0, le=30)):
+    """Long-poll: returns as soon as there are events after `after`, or empty once `wait` seconds pass"""
+    cursor = await resume_cursor(after)
+    type_list = parse_event_types(types)
+    deadline = time.monotonic() + wait
+    while True:
+        events, next_after = await read_events(cursor, type_list, limit)
+        remaining = deadline - time.monotonic()
+        if events or remaining <= 0 or shutting_down:
+            return {"events": events, "next_after": next_after}
+        await event_notifier.wait(min(remaining, EVENT_POLL_INTERVAL_SECONDS))
+
+@api_router.get("/events/stream")
+async def stream_events(request: Request, after: Optional[int] = Query(None, ge=0), types: Optional[str] = None):
+    """Server-sent events; EventSource reconnects resume from the Last-Event-ID it sends"""
+    last_event_id = request.headers.get('last-event-id')
+    if last_event_id and last_event_id.isdigit():
+        after = int(last_event_id)
+    cursor = await resume_cursor(after)
+    type_list = parse_event_types(types)
+    
+    async def stream():
+        nonlocal cursor
+        last_sent = time.monotonic()
+        while not shutting_down and not await request.is_disconnected():
+            events, cursor = await read_events(cursor, type_list, 500)
+            for event in events:
+                yield f"id: {event['seq']}\nevent: {event['type']}\ndata: {json.dumps(event)}\n\n"
+            if events:
+                last_sent = time.monotonic()
+                continue
+            if time.monotonic() - last_sent >= EVENT_HEARTBEAT_SECONDS:
+                yield ": keep-alive\n\n"
+                last_sent = time.monotonic()
+            await event_notifier.wait(EVENT_POLL_INTERVAL_SECONDS)
+    
+    return StreamingResponse(stream(), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+
+# ==================== INBOX ROUTES ====================
+@api_router.get("/inbox")
+async def get_user_inbox(user_id: str, refresh: bool = False):
+    """Everything a worker's home screen needs, served from the user's materialized inbox"""
+    inbox = None if refresh else await db.user_inboxes.find_one({"user_id": user_id}, {"_id": 0})
+    if not inbox or 'updated_at' not in inbox:  # missing, or a placeholder from an unfinished build
+        inbox = await build_user_inbox(user_id)
+        inbox.pop('_id', None)
+    await inbox_read_large_groups(inbox)
+    return inbox
+
+
+# ==================== ADMIN ROUTES ====================
+@api_router.post("/admin/archive")
+async def run_archival():
+    """Run the archival pass now instead of waiting for the background job"""
+    archived = await archive_old_rows()
+    return {"archived": archived}
+
+
+@api_router.post("/admin/rebuild-rollups")
+async def run_rollup_rebuild():
+    """Recompute the time-series rollups from raw time logs, QC results and completed tasks"""
+    buckets = await rebuild_rollups()
+    return {"buckets": buckets}
+
+
+@api_router.post("/admin/reconcile-pipeline")
+async def run_pipeline_reconciliation():
+    """Rebuild the order and production-stage pipeline counters from the records"""
+    return await reconcile_pipeline_counters()
+
+
+@api_router.post("/admin/sweep-orphans")
+async def run_orphan_sweep():
+    """Remove comments, subtasks, attachments, time logs, activities and notifications of deleted tasks"""
+    removed = await sweep_orphans()
+    return {"removed": removed}
+
+
+# ==================== DEBUG ROUTES ====================
+def require_profile_debug():
+    if not PROFILE_DEBUG:
+        raise HTTPException(status_code=404, detail="Not Found")
+
+@api_router.get("/debug/profiles", dependencies=[Depends(require_profile_debug)])
+async def get_recent_profiles():
+    return [profile.summary() for profile in reversed(recent_profiles)]
+
+@api_router.get("/debug/profiles/{profile_id}", dependencies=[Depends(require_profile_debug)])
+async def get_profile(profile_id: str, format: str = Query("json", pattern="^(json|folded)$")):
+    profile = next((p for p in recent_profiles if p.id == profile_id), None)
+    if not profile:
+        raise HTTPException(status_code=404, detail="Profile not found")
+    if format == "folded":
+        return PlainTextResponse(profile.folded())
+    return profile.to_dict()
+
+
+# ==================== SEARCH ROUTES ====================
+# scope -> (collection, date field, fields dropped from the result payload, score weight)
+# Hits are merged on textScore x weight. The weight undoes the field weights of the scope's text index
+# (a task title match scores 10x a description match), so one matched word in any scope lands near
+# 1 per occurrence and a strong match outranks a weak one whichever scope it comes from.
+SEARCH_SCOPES = {
+    "tasks": ("tasks", "created_at", [], 0.1),
+    "comments": ("task_comments", "created_at", [], 1.0),
+    "messages": ("messages", "sent_at", ["attachments"], 1.0),
+    "group_messages": ("group_messages", "sent_at", ["attachments", "read_by"], 1.0),
+}
+# Deep pages make every scope fetch skip + limit rows; past this, narrow the query instead
+SEARCH_MAX_SKIP = int(os.environ.get('SEARCH_MAX_SKIP', 500))
+
+def scope_hits(scope: str, docs: List[dict]) -> List[dict]:
+    """One scope's documents, best first, as hits carrying their weighted score"""
+    weight = SEARCH_SCOPES[scope][3]
+    return [
+        {"type": scope, "score": round(doc['score'] * weight, 4), "text_score": doc.pop('score'),
+         "rank": rank, "document": deserialize_doc(doc)}
+        for rank, doc in enumerate(docs)
+    ]
+
+def merge_search_hits(scope_results: List[List[dict]], skip: int, limit: int) -> Tuple[List[dict], bool]:
+    hits = sorted((hit for hits in scope_results for hit in hits), key=lambda hit: (-hit['score'], hit['rank']))
+    return hits[skip:skip + limit], len(hits) > skip + limit
+
+@api_router.get("/search")
+async def search(
+    q: str = Query(..., min_length=1),
+    scopes: Optional[List[str]] = Query(None),
+    department: Optional[str] = None,
+    status: Optional[str] = None,
+    date_from: Optional[str] = None,
+    date_to: Optional[str] = None,
+    skip: int = Query(0, ge=0, le=SEARCH_MAX_SKIP),
+    limit: int = Query(20, ge=1, le=100)
+):
+    scopes = scopes or list(SEARCH_SCOPES)
+    unknown = [scope for scope in scopes if scope not in SEARCH_SCOPES]
+    if unknown:
+        raise HTTPException(status_code=400, detail=f"Unknown search scope(s): {', '.join(unknown)}")
+    
+    # Department and status only exist on tasks, so filtering by them narrows the search to tasks
+    if department or status:
+        scopes = [scope for scope in scopes if scope == "tasks"]
+    
+    async def search_scope(scope: str):
+        collection, date_field, dropped_fields, _ = SEARCH_SCOPES[scope]
+        query = {"$text": {"$search": q}}
+        if date_from or date_to:
+            query[date_field] = {}
+            if date_from:
+                query[date_field]["$gte"] = date_from
+            if date_to:
+                query[date_field]["$lte"] = date_to
+        if scope == "tasks":
+            if department:
+                query['department'] = department
+            if status:
+                query['status'] = status
+        
+        projection = {"_id": 0, "score": {"$meta": "textScore"}}
+        projection.update({field: 0 for field in dropped_fields})
+        # Each scope only needs enough hits to fill the requested page after merging
+        docs = await db[collection].find(query, projection).sort(
+            [("score", {"$meta": "textScore"})]
+        ).limit(skip + limit).to_list(skip + limit)
+        return scope_hits(scope, docs)
+    
+    scope_results = await asyncio.gather(*(search_scope(scope) for scope in scopes))
+    results, has_more = merge_search_hits(scope_results, skip, limit)
+    
+    return {
+        "query": q,
+        "skip": skip,
+        "limit": limit,
+        "results": results,
+        "has_more": has_more
+    }
+
+
 # ==================== ANALYTICS ROUTES ====================
-@api_router.get("/analytics/dashboard")
-async def get_dashboard_analytics():
+@api_router.get("/analytics/dashboard", dependencies=[Depends(concurrency_limit("analytics"))])
+async def get_dashboard_analytics(reader: ReadContext = Depends(read_context(ReadClass.ANALYTICS))):
     # Get counts
-    total_orders = await db.orders.count_documents({})
-    active_orders = await db.orders.count_documents({"status": {"$in": ["pending", "in_production", "quality_check"]}})
-    completed_orders = await db.orders.count_documents({"status": "completed"})
+    order_counts = (await pipeline_counts(reader))['orders']
+    total_orders = sum(order_counts.values())
+    active_orders = sum(order_counts[status] for status in OPEN_ORDER_STATUSES)
+    completed_orders = order_counts[OrderStatus.COMPLETED.value]
     
-    total_workers = await db.workers.count_documents({"active": True})
-    total_materials = await db.materials.count_documents({})
-    low_stock_materials = await db.materials.count_documents({"$expr": {"$lte": ["$quantity", "$reorder_level"]}})
+    total_workers = await reader.db.workers.count_documents({"active": True}, session=reader.session)
+    total_materials = await reader.db.materials.count_documents({}, session=reader.session)
+    low_stock_materials = await reader.db.materials.count_documents({"$expr": {"$lte": ["$quantity", "$reorder_level"]}}, session=reader.session)
     
-    pending_tasks = await db.tasks.count_documents({"status": "pending"})
-    total_qc_checks = await db.quality_checks.count_documents({})
-    failed_qc = await db.quality_checks.count_documents({"status": "failed"})
+    pending_tasks = await reader.db.tasks.count_documents({"status": "pending"}, session=reader.session)
+    total_qc_checks = await reader.db.quality_checks.count_documents({}, session=reader.session)
+    failed_qc = await reader.db.quality_checks.count_documents({"status": "failed"}, session=reader.session)
     
     return {
         "orders": {
@@ -1374,22 +4845,207 @@ async def get_dashboard_analytics():
         }
     }
 
-@api_router.get("/analytics/production-efficiency")
-async def get_production_efficiency():
-    # Get production stages data
-    stages = await db.production_stages.find({"status": "completed"}, {"_id": 0}).to_list(1000)
-    
-    stage_counts = {}
-    for stage in stages:
-        stage_name = stage.get('stage', 'unknown')
-        stage_counts[stage_name] = stage_counts.get(stage_name, 0) + 1
+@api_router.get("/analytics/pipeline")
+async def get_pipeline(reader: ReadContext = Depends(read_context(ReadClass.ANALYTICS))):
+    """Orders per status and production stages per (stage, status), from the pipeline counters"""
+    return await pipeline_counts(reader)
+
+@api_router.get("/analytics/production-efficiency", dependencies=[Depends(concurrency_limit("analytics"))])
+async def get_production_efficiency(reader: ReadContext = Depends(read_context(ReadClass.ANALYTICS))):
+    stage_counts = {
+        stage: counts.get(StageStatus.COMPLETED.value, 0)
+        for stage, counts in (await pipeline_counts(reader))['production_stages'].items()
+        if counts.get(StageStatus.COMPLETED.value)
+    }
     
     return {
         "stage_completion": stage_counts,
-        "total_completed_stages": len(stages)
+        "total_completed_stages": sum(stage_counts.values())
     }
 
 
+@api_router.get("/analytics/delivery-risk", dependencies=[Depends(concurrency_limit("analytics"))])
+async def get_delivery_risk(risk: Optional[str] = Query(None, pattern="^(late|at_risk|on_track)$"),
+                            limit: int = Query(100, ge=1, le=5000)):
+    """Forecast completion of every open order against its delivery date, least slack first"""
+    ranked = await delivery_forecast.forecast()
+    orders = [row for row in ranked if row['risk'] == risk] if risk else ranked
+    return {
+        "stage_hours": delivery_forecast.stage_hours,
+        "open_orders": len(ranked),
+        "late": sum(1 for row in ranked if row['risk'] == "late"),
+        "at_risk": sum(1 for row in ranked if row['risk'] == "at_risk"),
+        "orders": orders[:limit],
+    }
+
+QC_PARETO_DIMENSIONS = {"stage": "$stage", "style": "$style_number", "inspector": "$inspector_id"}
+# Range used when /api/analytics/quality is called without `start`, so it never scans the whole history
+QC_ANALYTICS_DEFAULT_DAYS = int(os.environ.get('QC_ANALYTICS_DEFAULT_DAYS', 90))
+
+def defect_pareto_facet(group_field: str) -> List[dict]:
+    return [
+        {"$unwind": "$defects_found"},
+        {"$group": {
+            "_id": {"group": group_field, "defect": {"$toLower": {"$trim": {"input": "$defects_found"}}}},
+            "count": {"$sum": 1}
+        }},
+        {"$group": {"_id": "$_id.group", "defects": {"$push": {"defect": "$_id.defect", "count": "$count"}}}},
+    ]
+
+def first_check_group() -> dict:
+    # Input is sorted by checked_at, so $first is the first inspection of that order at that stage
+    return {"$group": {
+        "_id": {"order_id": "$order_id", "stage": "$stage"},
+        "style_number": {"$first": "$style_number"},
+        "first_pass": {"$first": {"$cond": [{"$eq": ["$status", QCStatus.PASSED.value]}, 1, 0]}},
+        "checks": {"$sum": 1},
+        "failed": {"$sum": {"$cond": [{"$eq": ["$status", QCStatus.FAILED.value]}, 1, 0]}},
+        "passed": {"$max": {"$eq": ["$status", QCStatus.PASSED.value]}},
+    }}
+
+def pareto_rows(groups: List[dict], label: str, top: int) -> List[dict]:
+    rows = []
+    for group in groups:
+        defects = sorted(group['defects'], key=lambda d: d['count'], reverse=True)
+        total = sum(d['count'] for d in defects)
+        cumulative = 0
+        for defect in defects:
+            cumulative += defect['count']
+            defect['share'] = round(defect['count'] / total, 4)
+            defect['cumulative_share'] = round(cumulative / total, 4)
+        rows.append({label: group['_id'], "total_defects": total, "defects": defects[:top]})
+    return sorted(rows, key=lambda row: row['total_defects'], reverse=True)
+
+@api_router.get("/analytics/quality", dependencies=[Depends(concurrency_limit("analytics"))])
+async def get_quality_analytics(
+    start: Optional[str] = None,
+    end: Optional[str] = None,
+    stage: Optional[ProductionStage] = None,
+    top: int = Query(10, ge=1, le=100),
+    limit: int = Query(50, ge=1, le=1000),
+    reader: ReadContext = Depends(read_context(ReadClass.ANALYTICS))
+):
+    """Defect Pareto by stage, style and inspector, first-pass yield per stage and order, and rework
+    loops between `start` (default QC_ANALYTICS_DEFAULT_DAYS before `end`) and `end` (default now), from
+    two aggregations over the (stage, checked_at) / checked_at indexes: one over the checks, one over
+    each order's checks at a stage"""
+    end_bound = iso_bound(end) if end else datetime.now(timezone.utc).isoformat()
+    start_bound = iso_bound(start) if start else (as_utc(end_bound) - timedelta(days=QC_ANALYTICS_DEFAULT_DAYS)).isoformat()
+    match = {"checked_at": {"$gte": start_bound, "$lte": end_bound}}
+    if stage:
+        match['stage'] = stage.value
+    
+    checks_pipeline = [
+        {"$match": match},
+        {"$facet": {
+            "totals": [{"$group": {
+                "_id": None,
+                "checks": {"$sum": 1},
+                "failed": {"$sum": {"$cond": [{"$eq": ["$status", QCStatus.FAILED.value]}, 1, 0]}},
+            }}],
+            **{f"pareto_{name}": defect_pareto_facet(field) for name, field in QC_PARETO_DIMENSIONS.items()},
+        }},
+    ]
+    first_checks_pipeline = [
+        {"$match": match},
+        {"$sort": {"checked_at": 1}},
+        first_check_group(),
+        {"$facet": {
+            "fpy_by_stage": [
+                {"$group": {"_id": "$_id.stage", "orders": {"$sum": 1}, "first_pass": {"$sum": "$first_pass"}}},
+                {"$sort": {"_id": 1}},
+            ],
+            "fpy_by_order": [
+                {"$group": {
+                    "_id": "$_id.order_id",
+                    "style_number": {"$first": "$style_number"},
+                    "stages": {"$sum": 1},
+                    "first_pass": {"$sum": "$first_pass"},
+                }},
+                {"$set": {"fpy": {"$divide": ["$first_pass", "$stages"]}}},
+                {"$sort": {"fpy": 1, "stages": -1}},
+                {"$limit": limit},
+            ],
+            "rework": [
+                {"$match": {"checks": {"$gt": 1}}},
+                {"$sort": {"checks": -1}},
+                {"$limit": limit},
+            ],
+        }},
+    ]
+    # One after the other: a session must not run two operations at once. $facet always returns one row.
+    result = {}
+    for pipeline in (checks_pipeline, first_checks_pipeline):
+        result.update((await reader.db.quality_checks.aggregate(
+            pipeline, allowDiskUse=True, session=reader.session
+        ).to_list(1))[0])
+    
+    totals = result['totals'][0] if result['totals'] else {"checks": 0, "failed": 0}
+    return {
+        "start": start_bound,
+        "end": end_bound,
+        "checks": totals['checks'],
+        "failed": totals['failed'],
+        "pass_rate": round(1 - totals['failed'] / totals['checks'], 4) if totals['checks'] else None,
+        "pareto": {name: pareto_rows(result[f"pareto_{name}"], name, top) for name in QC_PARETO_DIMENSIONS},
+        "first_pass_yield": {
+            "stages": [
+                {"stage": row['_id'], "orders": row['orders'], "first_pass": row['first_pass'],
+                 "fpy": round(row['first_pass'] / row['orders'], 4)}
+                for row in result['fpy_by_stage']
+            ],
+            "orders": [
+                {"order_id": row['_id'], "style_number": row.get('style_number'), "stages": row['stages'],
+                 "first_pass": row['first_pass'], "fpy": round(row['fpy'], 4)}
+                for row in result['fpy_by_order']
+            ],
+        },
+        "rework": [
+            {"order_id": row['_id']['order_id'], "stage": row['_id']['stage'], "style_number": row.get('style_number'),
+             "checks": row['checks'], "failed": row['failed'], "passed": row['passed']}
+            for row in result['rework']
+        ],
+    }
+
+@api_router.get("/analytics/timeseries")
+async def get_timeseries(
+    dimension: str = Query("factory", pattern=f"^({'|'.join(ROLLUP_DIMENSIONS)})$"),
+    key: Optional[str] = None,
+    granularity: str = Query("day", pattern="^(hour|day)$"),
+    start: Optional[str] = None,
+    end: Optional[str] = None,
+    metrics: Optional[str] = None,
+    limit: int = Query(1000, ge=1, le=10000),
+    reader: ReadContext = Depends(read_context(ReadClass.ANALYTICS))
+):
+    """Buckets of one dimension (all keys unless `key` is given) between `start` and `end`, oldest first.
+    At most `limit` buckets; `has_more` says the range holds more, narrow it or page by `start`."""
+    query = {"granularity": granularity, "dimension": dimension}
+    if key:
+        query['key'] = key
+    if start or end:
+        query['bucket'] = {}
+        if start:
+            query['bucket']['$gte'] = rollup_bucket(iso_bound(start), granularity)
+        if end:
+            query['bucket']['$lte'] = rollup_bucket(iso_bound(end), granularity)
+    projection = {"_id": 0, "key": 1, "bucket": 1}
+    if metrics:
+        names = [name.strip() for name in metrics.split(",") if name.strip()]
+        unknown = set(names) - set(ROLLUP_METRICS)
+        if unknown:
+            raise HTTPException(status_code=400, detail=f"Unknown metrics: {', '.join(sorted(unknown))}")
+        projection.update({f"metrics.{name}": 1 for name in names})
+    else:
+        projection['metrics'] = 1
+    
+    buckets = await reader.db.metric_rollups.find(query, projection, session=reader.session).sort(
+        [("key", 1), ("bucket", 1)]
+    ).limit(limit + 1).to_list(limit + 1)
+    return {"dimension": dimension, "granularity": granularity, "buckets": buckets[:limit],
+            "has_more": len(buckets) > limit}
+
+
 # Include the router in the main app
 app.include_router(api_router)
 
@@ -1399,8 +5055,156 @@ app.add_middleware(
     allow_origins=os.environ.get('CORS_ORIGINS', '*').split(','),
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Read-After", "X-Profile-Id", "ETag", "Idempotent-Replayed"],
 )
 
+@app.exception_handler(IdempotentReplay)
+async def replay_idempotent_response(request: Request, exc: IdempotentReplay):
+    return JSONResponse(exc.record['body'], status_code=exc.record['status_code'],
+                        headers={"Idempotent-Replayed": "true"})
+
+# Responses under the threshold are sent as-is: compressing them costs more CPU than it saves on the wire
+COMPRESSION_MIN_SIZE = int(os.environ.get('COMPRESSION_MIN_SIZE', 1024))
+UNCOMPRESSED_PATHS = ("/api/events/stream", "/api/presence/stream")
+
+class CompressionMiddleware:
+    """Compresses everything except server-sent event streams, whose events the compressor would hold
+    back until its buffer filled"""
+    
+    def __init__(self, app, minimum_size: int):
+        self.app = app
+        if BrotliMiddleware is not None:
+            self.compressed_app = BrotliMiddleware(app, minimum_size=minimum_size, gzip_fallback=True)
+        else:
+            self.compressed_app = GZipMiddleware(app, minimum_size=minimum_size)
+    
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == "http" and scope['path'] in UNCOMPRESSED_PATHS:
+            await self.app(scope, receive, send)
+        else:
+            await self.compressed_app(scope, receive, send)
+
+app.add_middleware(CompressionMiddleware, minimum_size=COMPRESSION_MIN_SIZE)
+
+def route_template(scope) -> str:
+    """The path template a request will be routed to, so ids do not explode metric cardinality"""
+    for route in app.router.routes:
+        match, _ = route.matches(scope)
+        if match == Match.FULL:
+            return route.path
+    return "unmatched"
+
+class RequestMetricsMiddleware:
+    """Counts, times and sizes requests per route template. Timing runs until the last body chunk is
+    sent, so streamed and server-sent event responses are measured in full, and the size is the sum of
+    the body chunks, which also covers chunked responses without a Content-Length."""
+    
+    def __init__(self, app):
+        self.app = app
+    
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != "http":
+            await self.app(scope, receive, send)
+            return
+        labels = (scope['method'], route_template(scope))
+        http_requests_in_flight.inc(labels)
+        start = time.perf_counter()
+        status_code = 500
+        size = None
+        end = None
+        
+        async def send_measured(message):
+            nonlocal status_code, size, end
+            if message['type'] == "http.response.start":
+                status_code = message['status']
+                size = 0
+            elif message['type'] == "http.response.body":
+                size += len(message.get('body', b""))
+            await send(message)
+            if message['type'] == "http.response.body" and not message.get('more_body', False):
+                end = time.perf_counter()
+        
+        try:
+            await self.app(scope, receive, send_measured)
+        finally:
+            http_requests_in_flight.dec(labels)
+            http_request_duration_seconds.observe(labels, (end or time.perf_counter()) - start)
+            http_requests_total.inc(labels + (str(status_code),))
+            if size is not None:
+                http_response_size_bytes.observe(labels, size)
+
+app.add_middleware(RequestMetricsMiddleware)
+
+class ProfilingMiddleware:
+    """Profiles sampled requests, and requests sending `X-Profile: 1` when PROFILE_DEBUG is on. Any
+    other request passes straight through."""
+    
+    def __init__(self, app):
+        self.app = app
+    
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != "http" or not self.wants_profile(scope):
+            await self.app(scope, receive, send)
+            return
+        
+        profile = RequestProfile(scope['method'], scope['path'])
+        
+        async def send_with_profile_id(message):
+            if message['type'] == "http.response.start":
+                message['headers'] = list(message.get('headers', [])) + [(b"x-profile-id", profile.id.encode())]
+            await send(message)
+        
+        token = current_profile.set(profile)
+        try:
+            await self.app(scope, receive, send_with_profile_id)
+        finally:
+            current_profile.reset(token)
+            profile.finish()
+            recent_profiles.append(profile)
+        
+        if PROFILE_DUMP_DIR:
+            try:
+                (Path(PROFILE_DUMP_DIR) / f"{profile.id}.folded").write_text(profile.folded())
+            except OSError as e:
+                logging.warning(f"Failed to write profile {profile.id}: {str(e)}")
+    
+    @staticmethod
+    def wants_profile(scope) -> bool:
+        if PROFILE_SAMPLE_RATE > 0 and random.random() < PROFILE_SAMPLE_RATE:
+            return True
+        return PROFILE_DEBUG and (b"x-profile", b"1") in scope['headers']
+
+app.add_middleware(ProfilingMiddleware)
+
+@app.get("/health/live", include_in_schema=False)
+async def health_live():
+    return {"status": "alive", "worker": WORKER_ID}
+
+@app.get("/health/ready", include_in_schema=False)
+async def health_ready():
+    """Ready when the connection pool can reach the primary within the health check timeout"""
+    if shutting_down:
+        return JSONResponse(status_code=503, content={"status": "draining", "worker": WORKER_ID})
+    start = time.perf_counter()
+    try:
+        await asyncio.wait_for(client.admin.command("ping"), timeout=HEALTH_CHECK_TIMEOUT_SECONDS)
+    except Exception as e:
+        return JSONResponse(status_code=503, content={"status": "unavailable", "worker": WORKER_ID, "error": str(e)})
+    return {
+        "status": "ready",
+        "worker": WORKER_ID,
+        "mongo_ping_ms": round((time.perf_counter() - start) * 1000, 3),
+        "pool": {"max_pool_size": client.options.pool_options.max_pool_size,
+                 "min_pool_size": client.options.pool_options.min_pool_size},
+    }
+
+@app.get("/metrics", include_in_schema=False)
+async def metrics():
+    lines = []
+    for metric in METRICS:
+        lines.extend(metric.render())
+    return PlainTextResponse("\n".join(lines) + "\n", media_type="text/plain; version=0.0.4")
+
 # Configure logging
 logging.basicConfig(
     level=logging.INFO,
@@ -1408,6 +5212,139 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+@app.on_event("startup")
+async def detect_deployment():
+    await detect_transaction_support()
+    check_presence_store()
+
+@app.on_event("startup")
+async def create_indexes():
+    # Text indexes backing /api/search (one text index is allowed per collection)
+    await db.tasks.create_index(
+        [("title", "text"), ("description", "text"), ("tags", "text")],
+        weights={"title": 10, "tags": 5, "description": 1},
+        name="tasks_text"
+    )
+    await db.task_comments.create_index([("comment", "text")], name="task_comments_text")
+    await db.messages.create_index([("content", "text")], name="messages_text")
+    await db.group_messages.create_index([("content", "text")], name="group_messages_text")
+    
+    await db.tasks.create_index("id", unique=True)
+    # Idempotent creates derive the id from the key; a unique id turns away a retry racing the first insert
+    await db.orders.create_index("id", unique=True)
+    await db.messages.create_index("id", unique=True)
+    for keys in TASK_QUERY_INDEXES:
+        await db.tasks.create_index(keys)
+    try:
+        # Superseded by tags_1_status_1_due_date_1
+        await db.tasks.drop_index("tags_1_due_date_1")
+    except OperationFailure:
+        pass
+    await db.conversations.create_index([("participants", 1), ("last_message_at", -1)])
+    
+    await db.group_members.create_index([("group_id", 1), ("user_id", 1)], unique=True)
+    await db.group_members.create_index([("user_id", 1), ("group_id", 1)])
+    await db.group_chats.create_index("id")
+    
+    await db.user_inboxes.create_index("user_id", unique=True)
+    await db.user_inboxes.create_index("tasks.id")
+    await db.user_inboxes.create_index("groups.id")
+    
+    await db.tasks.create_index([("assigned_to", 1), ("updated_at", 1)])
+    await db.subtasks.create_index([("task_id", 1), ("updated_at", 1)])
+    await db.sync_operations.create_index("created_at", expireAfterSeconds=SYNC_OPERATION_TTL_HOURS * 3600)
+    await db.idempotency_keys.create_index("created_at", expireAfterSeconds=IDEMPOTENCY_KEY_TTL_HOURS * 3600)
+    
+    # QC analytics: date ranges, optionally within one stage
+    await db.quality_checks.create_index([("stage", 1), ("checked_at", 1)])
+    await db.quality_checks.create_index("checked_at")
+    
+    # Time-series rollups, read by dimension and key over a bucket range
+    await db.metric_rollups.create_index([("granularity", 1), ("dimension", 1), ("key", 1), ("bucket", 1)])
+    
+    # Change feed: resumable reads by seq (optionally by type) and retention
+    await db.events.create_index("seq", unique=True)
+    await db.events.create_index([("type", 1), ("seq", 1)])
+    await db.events.create_index("recorded_at", expireAfterSeconds=EVENT_RETENTION_DAYS * 86400)
+    
+    # Capacity model loads and re-reads by id
+    await db.production_stages.create_index("id")
+    await db.production_stages.create_index([("status", 1), ("assigned_worker_id", 1)])
+    await db.workers.create_index("id")
+    
+    # Delivery forecast: open orders, their stages, and recent completed stages for cycle times
+    await db.orders.create_index("status")
+    await db.production_stages.create_index("order_id")
+    await db.production_stages.create_index([("status", 1), ("completed_at", 1)])
+    
+    # Per-task child rows: task detail reads and cascade deletes
+    for collection, sort_field in (
+        ("task_comments", "created_at"),
+        ("subtasks", "created_at"),
+        ("task_attachments", "uploaded_at"),
+        ("time_logs", "logged_at"),
+        ("task_completions", "completed_at"),
+    ):
+        await db[collection].create_index([("task_id", 1), (sort_field, -1)])
+    await db.task_notifications.create_index("task_id")
+    
+    # History reads, for both live and archived rows
+    for collection, keys in (
+        ("messages", [("conversation_id", 1), ("sent_at", -1)]),
+        ("group_messages", [("group_id", 1), ("sent_at", -1)]),
+        ("task_notifications", [("recipient_id", 1), ("created_at", -1)]),
+        ("activity_logs", [("task_id", 1), ("created_at", -1)]),
+    ):
+        await db[collection].create_index(keys)
+        await db[f"{collection}_archive"].create_index(keys)
+    
+    # Shared rate-limit windows expire on their own
+    await db.rate_limits.create_index("expires_at", expireAfterSeconds=0)
+    
+    await run_migrations()
+
+def install_drain_signal_handlers():
+    """Mark the worker as draining as soon as SIGTERM or SIGINT arrives, before uvicorn stops accepting
+    connections and waits for in-flight requests: /health/ready fails and streaming responses end during
+    the drain instead of being cut off at --timeout-graceful-shutdown. uvicorn registers its handlers with
+    loop.add_signal_handler, which runs off the loop's wakeup fd rather than the Python-level handler, so
+    replacing that handler leaves uvicorn's shutdown as it was; a previous Python-level handler still runs."""
+    if threading.current_thread() is not threading.main_thread():
+        return
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        previous = signal.getsignal(sig)
+        
+        def drain(signum, frame, previous=previous):
+            global shutting_down
+            shutting_down = True
+            if callable(previous):
+                previous(signum, frame)
+        signal.signal(sig, drain)
+
+@app.on_event("startup")
+async def start_background_jobs():
+    install_drain_signal_handlers()
+    await ensure_archive_collections()
+    if activity_writer.mode == "buffered":
+        background_jobs.append(asyncio.create_task(activity_writer.run()))
+    background_jobs.append(asyncio.create_task(presence_hub.run()))
+    background_jobs.append(asyncio.create_task(
+        run_periodically("archive_old_rows", ARCHIVE_INTERVAL_SECONDS, archive_old_rows)
+    ))
+    background_jobs.append(asyncio.create_task(
+        run_periodically("sweep_orphans", ORPHAN_SWEEP_INTERVAL_SECONDS, sweep_orphans)
+    ))
+    background_jobs.append(asyncio.create_task(
+        run_periodically("reconcile_pipeline", PIPELINE_RECONCILE_INTERVAL_SECONDS, reconcile_pipeline_counters)
+    ))
+
 @app.on_event("shutdown")
 async def shutdown_db_client():
+    # uvicorn has already stopped accepting connections and drained in-flight requests by now; the
+    # signal handler marked the worker as draining when the drain started
+    global shutting_down
+    shutting_down = True
+    for job in background_jobs:
+        job.cancel()
+    await activity_writer.flush()
     client.close()
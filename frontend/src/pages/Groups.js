@@ -66,7 +66,7 @@ const Groups = () => {
     }
 
     try {
-      const members = groupForm.selectedMembers.map(workerId => {
+      const members = groupForm.selectedMembers.filter(workerId => workerId !== currentUser.id).map(workerId => {
         const worker = workers.find(w => w.id === workerId);
         return {
           user_id: workerId,
@@ -75,7 +75,7 @@ const Groups = () => {
         };
       });
       
-      // Add creator as admin
+      // Add creator as admin (filtered out above if they also selected themselves)
       members.unshift({
         user_id: currentUser.id,
         user_name: currentUser.name,
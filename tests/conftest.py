@@ -0,0 +1,102 @@
+"""Fixtures running backend/server.py against an in-memory mongomock database.
+
+Tests that need a real mongod (query plans, transactions) use the `mongo_db` fixture, which connects
+to MONGO_TEST_URL and is skipped when that is unset or unreachable.
+"""
+import asyncio
+import os
+import sys
+from pathlib import Path
+
+import httpx
+import pytest
+
+os.environ.setdefault("MONGO_URL", "mongodb://localhost:27017/?serverSelectionTimeoutMS=500")
+os.environ.setdefault("DB_NAME", "test_database")
+os.environ.setdefault("MONGO_TRANSACTIONS", "false")
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "backend"))
+
+import mongomock.collection  # noqa: E402
+from mongomock_motor import AsyncMongoMockClient  # noqa: E402
+from motor.motor_asyncio import AsyncIOMotorClient, AsyncIOMotorDatabase  # noqa: E402
+
+import server  # noqa: E402
+
+# mongomock rejects the session= argument; the app only passes it for causal reads and transactions
+_raise_not_implemented = mongomock.collection.raise_not_implemented
+mongomock.collection.raise_not_implemented = (
+    lambda feature, reason: None if feature == "session" else _raise_not_implemented(feature, reason)
+)
+
+
+class FakeSession:
+    operation_time = None
+
+    def advance_operation_time(self, operation_time):
+        self.operation_time = operation_time
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        return False
+
+
+class FakeClient:
+    async def start_session(self, **kwargs):
+        return FakeSession()
+
+
+@pytest.fixture(scope="session")
+def loop():
+    # One loop for the whole run: the app keeps asyncio primitives at module level
+    loop = asyncio.new_event_loop()
+    yield loop
+    loop.close()
+
+
+@pytest.fixture
+def run(loop):
+    return loop.run_until_complete
+
+
+def use_database(monkeypatch, database):
+    for name, value in list(vars(server).items()):
+        if isinstance(value, AsyncIOMotorDatabase):
+            monkeypatch.setattr(server, name, database)
+    for read_class in list(server.READ_DATABASES):
+        monkeypatch.setitem(server.READ_DATABASES, read_class, database)
+
+
+@pytest.fixture
+def db(monkeypatch):
+    database = AsyncMongoMockClient()["test_database"]
+    use_database(monkeypatch, database)
+    monkeypatch.setattr(server, "client", FakeClient())
+    return database
+
+
+@pytest.fixture
+def mongo_db(db, monkeypatch, run):
+    url = os.environ.get("MONGO_TEST_URL")
+    if not url:
+        pytest.skip("MONGO_TEST_URL is not set")
+    mongo_client = AsyncIOMotorClient(url, serverSelectionTimeoutMS=2000)
+    try:
+        run(mongo_client.admin.command("ping"))
+    except Exception as e:
+        pytest.skip(f"MongoDB at MONGO_TEST_URL is unreachable: {e}")
+    database = mongo_client["test_factory_management"]
+    run(mongo_client.drop_database(database.name))
+    use_database(monkeypatch, database)
+    monkeypatch.setattr(server, "client", mongo_client)
+    yield database
+    run(mongo_client.drop_database(database.name))
+    mongo_client.close()
+
+
+@pytest.fixture
+def api(db, run):
+    api_client = httpx.AsyncClient(transport=httpx.ASGITransport(app=server.app), base_url="http://test")
+    yield api_client
+    run(api_client.aclose())
@@ -0,0 +1,106 @@
+"""The buffered activity-log writer must drain after partial failures and stay bounded in an outage"""
+from types import SimpleNamespace
+
+import pytest
+from bson import ObjectId
+from pymongo.errors import AutoReconnect, BulkWriteError
+
+import server
+
+
+class FlakyActivityLogs:
+    """activity_logs stand-in: stores rows by _id and fails the rows `fail` picks with its error code"""
+
+    def __init__(self, fail=None):
+        self.rows = {}
+        self.attempts = []
+        self.fail = fail or (lambda doc: None)
+
+    async def insert_many(self, docs, ordered=True):
+        self.attempts.append([doc["seq"] for doc in docs])
+        errors = []
+        for index, doc in enumerate(docs):
+            doc.setdefault("_id", ObjectId())
+            code = self.fail(doc)
+            if code is None and doc["_id"] in self.rows:
+                code = server.DUPLICATE_KEY
+            if code is None:
+                self.rows[doc["_id"]] = doc
+            else:
+                errors.append({"index": index, "code": code, "errmsg": f"error {code}"})
+        if errors:
+            raise BulkWriteError({"writeErrors": errors, "writeConcernErrors": [], "nInserted": len(docs) - len(errors)})
+
+
+@pytest.fixture
+def writer():
+    return server.ActivityLogWriter("buffered", flush_size=5, flush_interval=1, max_buffer=10)
+
+
+def use_collection(monkeypatch, collection):
+    monkeypatch.setattr(server, "bulk_db", SimpleNamespace(activity_logs=collection))
+
+
+def events(count, start=0):
+    return [{"seq": seq, "task_id": "t1"} for seq in range(start, start + count)]
+
+
+def test_partial_failure_requeues_only_the_rows_that_failed(writer, run, monkeypatch):
+    failing = {2}
+    collection = FlakyActivityLogs(lambda doc: 91 if doc["seq"] in failing else None)
+    use_collection(monkeypatch, collection)
+    writer.buffer = events(5)
+
+    run(writer.flush())
+    assert [doc["seq"] for doc in writer.buffer] == [2]
+    assert not writer.healthy
+
+    failing.clear()
+    run(writer.flush())
+    assert writer.buffer == []
+    assert writer.healthy
+    assert sorted(doc["seq"] for doc in collection.rows.values()) == [0, 1, 2, 3, 4]
+    assert collection.attempts == [[0, 1, 2, 3, 4], [2]]
+
+
+def test_rows_written_before_a_connection_error_count_as_written_on_retry(writer, run, monkeypatch):
+    collection = FlakyActivityLogs()
+    use_collection(monkeypatch, collection)
+    insert_many = collection.insert_many
+
+    async def drop_connection_after_insert(docs, ordered=True):
+        await insert_many(docs, ordered)
+        raise AutoReconnect("connection reset")
+    collection.insert_many = drop_connection_after_insert
+    writer.buffer = events(5)
+    run(writer.flush())
+    assert len(writer.buffer) == 5
+
+    # Every retried row comes back as a duplicate key: already written, so the buffer drains
+    collection.insert_many = insert_many
+    run(writer.flush())
+    assert writer.buffer == []
+    assert len(collection.rows) == 5
+
+
+def test_sustained_outage_keeps_the_buffer_bounded(writer, run, monkeypatch):
+    class Down:
+        calls = 0
+
+        async def insert_many(self, docs, ordered=True):
+            Down.calls += 1
+            raise AutoReconnect("no primary")
+    use_collection(monkeypatch, Down())
+    dropped_before = writer.dropped
+
+    async def write_all():
+        for doc in events(50):
+            await writer.write(doc)
+        await writer.flush()
+    run(write_all())
+
+    assert len(writer.buffer) <= writer.max_buffer
+    assert writer.dropped - dropped_before == 50 - len(writer.buffer)
+    assert writer.dropped > 0
+    # Once a flush has failed, full-buffer writes drop instead of waiting on the database each time
+    assert Down.calls < 10
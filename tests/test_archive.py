@@ -0,0 +1,38 @@
+"""Archived rows stay reachable, and several workers can prepare the archive at once"""
+from pymongo.errors import CollectionInvalid, OperationFailure
+
+import server
+
+
+def test_concurrent_workers_creating_archive_collections_do_not_fail_startup(db, run, monkeypatch):
+    async def lost_race(name, **kwargs):
+        raise CollectionInvalid(f"collection {name} already exists")
+    monkeypatch.setattr(db, "create_collection", lost_race)
+    run(server.ensure_archive_collections())
+
+    async def namespace_exists(name, **kwargs):
+        raise OperationFailure("Collection already exists", code=server.NAMESPACE_EXISTS)
+    monkeypatch.setattr(db, "create_collection", namespace_exists)
+    run(server.ensure_archive_collections())
+
+
+def test_history_reads_through_to_the_archive_by_default(api, db, run):
+    run(db.messages_archive.insert_one({"id": "m-old", "conversation_id": "c1", "sender_id": "a",
+                                        "sender_name": "A", "receiver_id": "b", "content": "old",
+                                        "sent_at": "2020-01-01T00:00:00+00:00"}))
+    response = run(api.get("/api/conversations/c1/messages"))
+    assert [message["id"] for message in response.json()] == ["m-old"]
+
+
+def test_marking_an_archived_notification_read_updates_the_inbox(api, db, run):
+    run(db.task_notifications_archive.insert_one({
+        "id": "n1", "recipient_id": "u1", "read": False, "created_at": "2020-01-01T00:00:00+00:00",
+    }))
+    run(db.user_inboxes.insert_one({"user_id": "u1", "unread_notifications": 1, "notifications": []}))
+
+    response = run(api.put("/api/notifications/n1/read"))
+    assert response.status_code == 200
+    assert run(db.task_notifications_archive.find_one({"id": "n1"}))["read"] is True
+    assert run(db.user_inboxes.find_one({"user_id": "u1"}))["unread_notifications"] == 0
+
+    assert run(api.put("/api/notifications/missing/read")).status_code == 404
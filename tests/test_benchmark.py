@@ -0,0 +1,49 @@
+"""Smoke test for the benchmark driver, without a seeded database"""
+import argparse
+
+import httpx
+
+import benchmark
+
+
+def test_run_scenario_reports_latency_errors_and_wire_bytes(run):
+    def respond(request):
+        # Streamed bodies, so the client counts the bytes it downloads as it would over a socket
+        if request.url.path == "/missing":
+            return httpx.Response(404, stream=httpx.ByteStream(b"not found"))
+        return httpx.Response(200, stream=httpx.ByteStream(b"x" * 100))
+
+    async def scenario():
+        async with httpx.AsyncClient(transport=httpx.MockTransport(respond), base_url="http://benchmark") as http:
+            return await benchmark.run_scenario(
+                "stub", lambda i: http.get("/missing" if i % 5 == 0 else "/items"), total=10, concurrency=3
+            )
+    result = run(scenario())
+
+    assert result["requests"] == 10
+    assert result["errors"] == 2
+    assert result["avg_bytes"] == round((8 * 100 + 2 * len("not found")) / 10)
+    assert 0 <= result["p50_ms"] <= result["p95_ms"] <= result["p99_ms"]
+    assert result["throughput_rps"] > 0
+
+
+def result(errors=0, p95_ms=10.0, throughput_rps=100.0):
+    return {"requests": 10, "errors": errors, "throughput_rps": throughput_rps, "p50_ms": 5.0,
+            "p95_ms": p95_ms, "p99_ms": 20.0, "avg_bytes": 100}
+
+
+def test_error_responses_fail_the_run_and_keep_the_baseline(tmp_path):
+    args = argparse.Namespace(baseline=tmp_path / "baseline.json", update_baseline=True, threshold=0.2)
+    assert benchmark.check_results({"ok": result(), "broken": result(errors=3)}, args) == 1
+    assert not args.baseline.exists()
+
+
+def test_missing_baseline_fails_unless_recording_one(tmp_path):
+    args = argparse.Namespace(baseline=tmp_path / "baseline.json", update_baseline=False, threshold=0.2)
+    assert benchmark.check_results({"ok": result()}, args) == 1
+
+    args.update_baseline = True
+    assert benchmark.check_results({"ok": result()}, args) == 0
+    args.update_baseline = False
+    assert benchmark.check_results({"ok": result()}, args) == 0
+    assert benchmark.check_results({"ok": result(p95_ms=20.0)}, args) == 1
@@ -0,0 +1,72 @@
+"""The assignment load model counts only stored work and never reloads on the request path"""
+import asyncio
+
+import pytest
+
+import server
+
+
+@pytest.fixture
+def model(db, run):
+    run(db.workers.insert_many([
+        {"id": "w1", "name": "A", "department": "cutting", "skills": [], "active": True},
+        {"id": "w2", "name": "B", "department": "cutting", "skills": [], "active": True},
+    ]))
+    capacity = server.CapacityModel()
+    run(capacity.refresh())
+    return capacity
+
+
+def test_failed_insert_releases_the_reserved_load(model):
+    task = {"id": "t1", "assigned_to": "w1", "status": "pending", "estimated_hours": 4}
+    with pytest.raises(RuntimeError):
+        with model.reserve_task(task):
+            assert model.loads["w1"].hours == 4
+            raise RuntimeError("insert failed")
+    assert model.loads["w1"].hours == 0
+    assert "t1" not in model.tasks
+
+    with model.reserve_task(task):
+        pass
+    assert model.loads["w1"].hours == 4
+
+
+def test_reload_runs_in_the_background(model, db, run, monkeypatch):
+    model.loaded_at -= model.reload_seconds + 1
+    model.refreshed_at = 0
+    loading = asyncio.Event()
+    load_snapshot = model.load_snapshot
+
+    async def slow_snapshot():
+        await loading.wait()
+        await load_snapshot()
+    monkeypatch.setattr(model, "load_snapshot", slow_snapshot)
+    run(db.tasks.insert_one({"id": "t1", "assigned_to": "w2", "status": "pending", "estimated_hours": 3}))
+
+    # The request is answered from the current state while the reload waits
+    run(asyncio.wait_for(model.refresh(), 1))
+    assert model.reloading
+    assert "t1" not in model.tasks
+
+    loading.set()
+    run(asyncio.wait_for(model._reload_task, 1))
+    assert model.loads["w2"].hours == 3
+
+
+def test_auto_assign_picks_the_least_loaded_qualified_worker(api, db, run, monkeypatch):
+    monkeypatch.setattr(server, "capacity_model", server.CapacityModel())
+    run(db.workers.insert_many([
+        {"id": "busy", "name": "Busy", "department": "stitching", "skills": ["overlock"], "active": True},
+        {"id": "free", "name": "Free", "department": "stitching", "skills": ["overlock", "flatlock"], "active": True},
+        {"id": "unskilled", "name": "Unskilled", "department": "stitching", "skills": [], "active": True},
+        {"id": "other", "name": "Other", "department": "cutting", "skills": ["overlock"], "active": True},
+    ]))
+    run(db.tasks.insert_one({"id": "t0", "assigned_to": "busy", "status": "pending", "estimated_hours": 6}))
+    task = {"title": "Hem sleeves", "description": "d", "department": "stitching", "required_skills": ["overlock"],
+            "send_notifications": False}
+
+    # An empty assignee is not an opt-in
+    assert run(api.post("/api/tasks", json={**task, "assigned_to": ""})).status_code == 422
+    created = run(api.post("/api/tasks", json={**task, "assigned_to": "", "auto_assign": True}))
+    assert created.status_code == 200
+    assert created.json()["assigned_to"] == "free"
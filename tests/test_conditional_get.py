@@ -0,0 +1,62 @@
+"""A reference list is never older than the version in its ETag"""
+import time
+
+from bson import Timestamp
+
+import server
+
+
+class RecordingClient:
+    def __init__(self, client):
+        self.client = client
+        self.sessions = []
+
+    async def start_session(self, **kwargs):
+        session = await self.client.start_session(**kwargs)
+        self.sessions.append(session)
+        return session
+
+
+def test_cached_version_holds_the_list_read_to_the_version_s_operation_time(api, db, run, monkeypatch):
+    recording = RecordingClient(server.client)
+    monkeypatch.setattr(server, "client", recording)
+    monkeypatch.setitem(server.collection_version_cache, "materials", (3, time.monotonic(), Timestamp(5, 1)))
+
+    response = run(api.get("/api/materials"))
+    assert response.status_code == 200
+    assert '"materials-3-' in response.headers["ETag"]
+    # The version and the list share one causal session, moved up to where the version was read
+    assert len(recording.sessions) == 1
+    assert recording.sessions[0].operation_time == Timestamp(5, 1)
+
+
+def test_read_after_token_skips_the_cached_version(api, db, run, monkeypatch):
+    run(db.collection_versions.insert_one({"_id": "materials", "version": 4}))
+    monkeypatch.setitem(server.collection_version_cache, "materials", (3, time.monotonic(), None))
+
+    response = run(api.get("/api/materials", headers={"X-Read-After": "7.1"}))
+    assert '"materials-4-' in response.headers["ETag"]
+
+
+def test_group_message_changes_only_its_members_group_etags(api, db, run):
+    def create(name, members):
+        return run(api.post("/api/groups", json={
+            "name": name, "description": "d", "created_by": members[0],
+            "members": [{"user_id": member, "user_name": member} for member in members],
+        })).json()
+
+    cutting = create("cutting", ["u1", "u2"])
+    create("finishing", ["u3"])
+    etags = {user: run(api.get("/api/groups", params={"user_id": user})).headers["ETag"] for user in ("u1", "u3")}
+    versions_before = run(db.collection_versions.find_one({"_id": "group_chats"}))
+
+    run(api.post(f"/api/groups/{cutting['id']}/messages", json={
+        "group_id": cutting["id"], "sender_id": "u2", "sender_name": "u2", "content": "bundle 12 ready",
+    }))
+    assert run(db.collection_versions.find_one({"_id": "group_chats"})) == versions_before
+
+    stale = run(api.get("/api/groups", params={"user_id": "u1"}, headers={"If-None-Match": etags["u1"]}))
+    assert stale.status_code == 200
+    assert stale.json()[0]["last_message"] == "bundle 12 ready"
+    unchanged = run(api.get("/api/groups", params={"user_id": "u3"}, headers={"If-None-Match": etags["u3"]}))
+    assert unchanged.status_code == 304
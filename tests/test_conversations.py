@@ -0,0 +1,30 @@
+"""Duplicate conversations from before the participant_key index are merged before it is built"""
+import server
+
+
+def conversation(conversation_id, created_at, last_message_at):
+    return {
+        "id": conversation_id, "participant1_id": "a", "participant1_name": "A", "participant2_id": "b",
+        "participant2_name": "B", "participants": ["a", "b"], "participant_key": "a:b",
+        "created_at": created_at, "last_message": f"from {conversation_id}", "last_message_at": last_message_at,
+    }
+
+
+def test_duplicates_fold_into_the_oldest_conversation(db, run):
+    run(db.conversations.insert_many([
+        conversation("c-new", "2024-03-01T00:00:00+00:00", "2024-03-05T00:00:00+00:00"),
+        conversation("c-old", "2024-01-01T00:00:00+00:00", "2024-02-01T00:00:00+00:00"),
+        {**conversation("c-other", "2024-01-01T00:00:00+00:00", None), "participant_key": "a:c"},
+    ]))
+    run(db.messages.insert_many([
+        {"id": "m1", "conversation_id": "c-old", "sent_at": "2024-02-01T00:00:00+00:00"},
+        {"id": "m2", "conversation_id": "c-new", "sent_at": "2024-03-05T00:00:00+00:00"},
+    ]))
+
+    assert run(server.merge_duplicate_conversations()) == 1
+    assert run(server.merge_duplicate_conversations()) == 0
+
+    remaining = run(db.conversations.find({}, {"_id": 0}).sort("id", 1).to_list(None))
+    assert [conv["id"] for conv in remaining] == ["c-old", "c-other"]
+    assert remaining[0]["last_message"] == "from c-new"
+    assert run(db.messages.distinct("conversation_id")) == ["c-old"]
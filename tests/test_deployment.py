@@ -0,0 +1,123 @@
+"""Multi-worker profile: one-off migrations run once, and SIGTERM starts the drain straight away"""
+import os
+import signal
+import socket
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+import httpx
+import pytest
+
+import server
+
+BACKEND_DIR = Path(__file__).resolve().parent.parent / "backend"
+
+
+@pytest.fixture
+def migrations(monkeypatch):
+    calls = []
+
+    def migration(name):
+        async def run():
+            calls.append(name)
+        return run
+    monkeypatch.setattr(server, "MIGRATIONS", [(name, migration(name)) for name in ("first", "second")])
+    return calls
+
+
+def test_migrations_run_once_per_database(db, run, migrations, monkeypatch):
+    assert run(server.run_migrations()) == ["first", "second"]
+
+    # A second worker starting later finds them recorded
+    monkeypatch.setattr(server, "WORKER_ID", "other-worker")
+    assert run(server.run_migrations()) == []
+    assert migrations == ["first", "second"]
+
+
+def test_migration_leased_by_another_worker_is_skipped(db, run, migrations):
+    run(db.job_leases.insert_one({"_id": "migration:first", "owner": "other-worker",
+                                  "expires_at": server.datetime.now(server.timezone.utc) + server.timedelta(hours=1)}))
+    assert run(server.run_migrations()) == ["second"]
+    assert run(db.migrations.distinct("_id")) == ["second"]
+
+
+def test_failed_migration_releases_its_lease_and_fails_startup(db, run, monkeypatch):
+    async def broken():
+        raise RuntimeError("backfill failed")
+    monkeypatch.setattr(server, "MIGRATIONS", [("broken", broken)])
+    with pytest.raises(RuntimeError):
+        run(server.run_migrations())
+    assert run(db.job_leases.count_documents({"_id": "migration:broken"})) == 0
+    assert run(db.migrations.count_documents({})) == 0
+
+
+@pytest.fixture
+def drain_handlers(monkeypatch):
+    monkeypatch.setattr(server, "shutting_down", False)
+    previous = {sig: signal.getsignal(sig) for sig in (signal.SIGTERM, signal.SIGINT)}
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    server.install_drain_signal_handlers()
+    yield
+    for sig, handler in previous.items():
+        signal.signal(sig, handler)
+
+
+def test_sigterm_marks_the_worker_draining_before_shutdown(api, run, drain_handlers):
+    assert run(api.get("/health/ready")).json().get("status") != "draining"
+
+    os.kill(os.getpid(), signal.SIGTERM)
+    deadline = time.monotonic() + 2
+    while not server.shutting_down and time.monotonic() < deadline:
+        time.sleep(0.01)
+
+    assert server.shutting_down
+    response = run(api.get("/health/ready"))
+    assert response.status_code == 503
+    assert response.json()["status"] == "draining"
+    # Long polls return straight away instead of holding the drain open
+    start = time.monotonic()
+    assert run(api.get("/api/events", params={"after": 0, "wait": 20})).status_code == 200
+    assert time.monotonic() - start < 5
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def test_multi_worker_profile_starts_migrates_once_and_drains(mongo_db, run):
+    pytest.importorskip("uvicorn")
+    port = free_port()
+    env = {**os.environ, "MONGO_URL": os.environ["MONGO_TEST_URL"], "DB_NAME": mongo_db.name,
+           "MONGO_TRANSACTIONS": "auto"}
+    process = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "server:app", "--host", "127.0.0.1", "--port", str(port),
+         "--workers", "2", "--timeout-graceful-shutdown", "5"],
+        cwd=BACKEND_DIR, env=env, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+    )
+    try:
+        # Each worker answers ready only after its own startup, which includes the migrations it ran
+        expected = sorted(name for name, _ in server.MIGRATIONS)
+        recorded = []
+        deadline = time.monotonic() + 60
+        while recorded != expected and time.monotonic() < deadline and process.poll() is None:
+            try:
+                httpx.get(f"http://127.0.0.1:{port}/health/ready", timeout=2).raise_for_status()
+                recorded = sorted(run(mongo_db.migrations.distinct("_id")))
+            except httpx.HTTPError:
+                pass
+            time.sleep(0.2)
+        assert process.poll() is None, process.stdout.read().decode(errors="replace")
+        assert recorded == expected
+        # Recorded once each, by whichever worker took the lease
+        assert run(mongo_db.migrations.count_documents({})) == len(expected)
+
+        process.send_signal(signal.SIGTERM)
+        assert process.wait(timeout=30) == 0
+    finally:
+        if process.poll() is None:
+            process.kill()
+            process.wait()
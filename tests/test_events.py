@@ -0,0 +1,51 @@
+"""Change feed cursors move past events of other types and stop at gaps that may still fill"""
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+import server
+
+
+def add_events(db, run, *events, age_seconds=0):
+    recorded_at = datetime.now(timezone.utc) - timedelta(seconds=age_seconds)
+    run(db.events.insert_many([
+        {"seq": seq, "type": event_type, "entity_id": f"e{seq}", "data": {},
+         "occurred_at": recorded_at.isoformat(), "recorded_at": recorded_at}
+        for seq, event_type in events
+    ]))
+
+
+def test_filtered_page_advances_the_cursor_to_the_horizon(db, run):
+    add_events(db, run, (1, "order.created"), (2, "task.created"), (3, "task.created"), age_seconds=60)
+    events, cursor = run(server.read_events(0, ["order.created"], 100))
+    assert [event["seq"] for event in events] == [1]
+    assert cursor == 3
+
+    # A full page resumes from its last event instead
+    events, cursor = run(server.read_events(0, ["order.created", "task.created"], 2))
+    assert [event["seq"] for event in events] == [1, 2]
+    assert cursor == 2
+
+
+def test_cursor_stops_before_a_recent_gap_and_skips_it_once_settled(db, run):
+    add_events(db, run, (1, "task.created"), age_seconds=60)
+    add_events(db, run, (3, "task.created"), (4, "order.created"))
+    events, cursor = run(server.read_events(0, ["order.created"], 100))
+    assert events == []
+    assert cursor == 1
+
+    # The gap outlives EVENT_GAP_TIMEOUT_SECONDS: its writer is taken to have failed
+    run(db.events.update_many({}, {"$set": {"recorded_at": datetime.now(timezone.utc) - timedelta(seconds=60)}}))
+    events, cursor = run(server.read_events(cursor, ["order.created"], 100))
+    assert [event["seq"] for event in events] == [4]
+    assert cursor == 4
+
+
+
+def test_feed_projection_requires_both_hooks():
+    class SnapshotOnly(server.FeedProjection):
+        async def load_snapshot(self):
+            pass
+
+    with pytest.raises(TypeError):
+        SnapshotOnly(1, 60, 100)
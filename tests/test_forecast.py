@@ -0,0 +1,68 @@
+"""Delivery forecast: slack ranking, risk bands, time left on running stages and incremental refresh"""
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+import server
+
+NOW = datetime.now(timezone.utc)
+
+
+def ago(hours):
+    return (NOW - timedelta(hours=hours)).isoformat()
+
+
+def order(order_id, delivery_in_hours):
+    return {"id": order_id, "style_number": f"ST-{order_id}", "customer_name": "C", "status": "in_production",
+            "delivery_date": (NOW + timedelta(hours=delivery_in_hours)).isoformat()}
+
+
+@pytest.fixture
+def forecast(db, run):
+    # Five completed runs of every stage: p50 10h, p80 22h, so an untouched order needs 50h (p50) / 110h (p80)
+    run(db.production_stages.insert_many([
+        {"id": f"h-{stage}-{i}", "order_id": "done", "stage": stage, "status": "completed",
+         "started_at": ago(100 + hours), "completed_at": ago(100)}
+        for stage in server.STAGE_SEQUENCE for i, hours in enumerate([10, 10, 10, 20, 30])
+    ]))
+    return server.DeliveryForecast()
+
+
+def test_orders_are_ranked_by_slack_with_risk_bands(forecast, db, run):
+    run(db.orders.insert_many([order("ok", 240), order("late", 24), order("risk", 72)]))
+    ranked = run(forecast.forecast())
+    assert [(row["order_id"], row["risk"]) for row in ranked] == [
+        ("late", "late"), ("risk", "at_risk"), ("ok", "on_track"),
+    ]
+    assert forecast.stage_hours["cutting"] == {"p50": 10.0, "p80": 22.0, "samples": 5}
+    assert ranked[0]["remaining_hours"] == 50.0
+    assert ranked[0]["slack_hours"] == pytest.approx(-26.0, abs=0.2)
+
+
+def test_running_stage_counts_only_its_remaining_time(forecast, db, run):
+    run(db.orders.insert_one(order("o1", 240)))
+    run(db.production_stages.insert_many([
+        {"id": "s1", "order_id": "o1", "stage": "cutting", "status": "completed", "started_at": ago(20)},
+        {"id": "s2", "order_id": "o1", "stage": "stitching", "status": "in_progress", "started_at": ago(4)},
+        # Stage names outside the known sequence are skipped rather than failing the load
+        {"id": "s3", "order_id": "o1", "stage": "embroidery", "status": "in_progress", "started_at": ago(1)},
+    ]))
+    [row] = run(forecast.forecast())
+    assert row["current_stage"] == "stitching"
+    assert row["remaining_hours"] == pytest.approx(6 + 3 * 10, abs=0.1)
+
+
+def test_new_orders_are_picked_up_from_the_feed_without_a_reload(forecast, db, run, monkeypatch):
+    run(db.orders.insert_one(order("o1", 240)))
+    assert [row["order_id"] for row in run(forecast.forecast())] == ["o1"]
+
+    async def no_reload():
+        raise AssertionError("refresh reloaded everything")
+    monkeypatch.setattr(forecast, "load_snapshot", no_reload)
+    run(db.orders.insert_one(order("o2", 24)))
+    run(server.record_event("order.created", "o2", {}))
+    run(db.orders.update_one({"id": "o1"}, {"$set": {"status": "completed"}}))
+    run(server.record_event("order.status_changed", "o1", {}))
+
+    forecast.refreshed_at = 0
+    assert [row["order_id"] for row in run(forecast.forecast())] == ["o2"]
@@ -0,0 +1,25 @@
+"""Group creation tolerates members listed twice"""
+
+
+def test_duplicate_members_are_merged_keeping_the_admin_role(api, db, run):
+    response = run(api.post("/api/groups", json={
+        "name": "Line 1", "description": "", "created_by": "u1",
+        "members": [
+            {"user_id": "u1", "user_name": "Creator", "role": "member"},
+            {"user_id": "u2", "user_name": "Worker", "role": "member"},
+            {"user_id": "u1", "user_name": "Creator", "role": "admin"},
+        ],
+    }))
+    assert response.status_code == 200, response.text
+    group = response.json()
+    assert group["member_count"] == 2
+    assert [(member["user_id"], member["role"]) for member in group["members"]] == [("u1", "admin"), ("u2", "member")]
+    assert run(db.group_members.count_documents({"group_id": group["id"]})) == 2
+
+
+def test_member_without_user_id_is_rejected_before_anything_is_written(api, db, run):
+    response = run(api.post("/api/groups", json={
+        "name": "Line 2", "description": "", "created_by": "u1", "members": [{"user_name": "Nobody"}],
+    }))
+    assert response.status_code == 400
+    assert run(db.group_chats.count_documents({})) == 0
@@ -0,0 +1,87 @@
+"""Idempotency-Key replays the first response, and If-Match turns away updates of a stale version"""
+import hashlib
+import json
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+import server
+
+TASK = {"title": "Hem sleeves", "description": "d", "assigned_to": "u1", "department": "stitching",
+        "send_notifications": False}
+
+
+def create_task(api, run, key, body=TASK):
+    return run(api.post("/api/tasks", content=json.dumps(body),
+                        headers={"Idempotency-Key": key, "Content-Type": "application/json"}))
+
+
+def claim(db, run, key, age_seconds, body=TASK):
+    fingerprint = hashlib.sha256(b"/api/tasks" + json.dumps(body).encode()).hexdigest()
+    run(db.idempotency_keys.insert_one({
+        "_id": f"create_task:{key}", "fingerprint": fingerprint, "status": "pending",
+        "created_at": datetime.now(timezone.utc) - timedelta(seconds=age_seconds),
+    }))
+
+
+def test_retry_gets_the_stored_response_back(api, db, run):
+    first = create_task(api, run, "k1")
+    assert first.status_code == 200
+    retry = create_task(api, run, "k1")
+    assert retry.status_code == 200
+    assert retry.headers["Idempotent-Replayed"] == "true"
+    assert retry.json() == first.json()
+    assert run(db.tasks.count_documents({})) == 1
+    assert run(db.idempotency_keys.find_one({"_id": "create_task:k1"}))["status_code"] == 200
+
+
+def test_key_reused_for_a_different_body_is_rejected(api, db, run):
+    assert create_task(api, run, "k1").status_code == 200
+    assert create_task(api, run, "k1", {**TASK, "title": "Press collars"}).status_code == 422
+
+
+def test_key_still_in_progress_is_409(api, db, run):
+    claim(db, run, "k1", age_seconds=0)
+    response = create_task(api, run, "k1")
+    assert response.status_code == 409
+    assert response.headers["Retry-After"] == "1"
+    assert run(db.tasks.count_documents({})) == 0
+
+
+def test_failed_request_releases_its_claim(api, db, run):
+    response = run(api.post("/api/conversations/missing/messages", headers={"Idempotency-Key": "k1"}, json={
+        "conversation_id": "missing", "sender_id": "a", "sender_name": "A", "receiver_id": "b",
+        "receiver_name": "B", "content": "hi",
+    }))
+    assert response.status_code == 404
+    assert run(db.idempotency_keys.count_documents({})) == 0
+
+
+def test_taking_over_an_abandoned_claim_returns_the_record_it_created(api, db, run):
+    # The first request inserted the task, then died before storing its response
+    first = create_task(api, run, "k1").json()
+    run(db.idempotency_keys.delete_many({}))
+    claim(db, run, "k1", age_seconds=server.IDEMPOTENCY_PENDING_TIMEOUT_SECONDS + 1)
+
+    retry = create_task(api, run, "k1")
+    assert retry.status_code == 200
+    assert retry.json()["id"] == first["id"]
+    assert run(db.tasks.count_documents({})) == 1
+    assert run(db.idempotency_keys.find_one({"_id": "create_task:k1"}))["status"] == "completed"
+
+
+@pytest.mark.parametrize("collection,path,params", [
+    ("tasks", "/api/tasks/r1", {"status": "in_progress"}),
+    ("orders", "/api/orders/r1", {"notes": "rush"}),
+    ("materials", "/api/materials/r1", {"quantity": 5}),
+    ("production_stages", "/api/production/r1", {"completed_at": "2026-01-01T00:00:00+00:00"}),
+])
+def test_stale_if_match_is_412(api, db, run, collection, path, params):
+    run(db[collection].insert_one({"id": "r1", "name": "r", "unit": "m", "quantity": 1, "status": "pending",
+                                   "version": 3}))
+    assert run(api.put(path, params=params, headers={"If-Match": '"2"'})).status_code == 412
+    assert run(db[collection].find_one({"id": "r1"}))["version"] == 3
+
+    current = run(api.put(path, params=params, headers={"If-Match": '"3"'}))
+    assert current.status_code == 200
+    assert current.headers["ETag"] == '"4"'
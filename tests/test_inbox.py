@@ -0,0 +1,75 @@
+"""The materialized inbox must follow task reopenings and group activity"""
+import server
+
+
+def inbox(api, run, user_id="u1"):
+    response = run(api.get("/api/inbox", params={"user_id": user_id}))
+    assert response.status_code == 200
+    return response.json()
+
+
+def test_reopened_task_returns_to_the_assignee_inbox(api, run):
+    inbox(api, run)
+    task = run(api.post("/api/tasks", json={"title": "Hem sleeves", "description": "d", "assigned_to": "u1",
+                                            "department": "stitching", "send_notifications": False})).json()
+    assert [t["id"] for t in inbox(api, run)["tasks"]] == [task["id"]]
+
+    run(api.put(f"/api/tasks/{task['id']}", params={"status": "completed"}))
+    assert inbox(api, run)["tasks"] == []
+
+    run(api.put(f"/api/tasks/{task['id']}", params={"status": "in_progress"}))
+    tasks = inbox(api, run)["tasks"]
+    assert [(t["id"], t["status"]) for t in tasks] == [(task["id"], "in_progress")]
+
+    # A second status change while open updates the entry instead of adding another
+    run(api.put(f"/api/tasks/{task['id']}", params={"status": "pending"}))
+    assert [(t["id"], t["status"]) for t in inbox(api, run)["tasks"]] == [(task["id"], "pending")]
+
+
+def test_group_with_the_newest_message_moves_to_the_top(api, run, monkeypatch):
+    monkeypatch.setattr(server, "GROUP_FAN_OUT_ON_READ_MEMBERS", 1000)
+    groups = []
+    for name in ("cutting", "finishing"):
+        groups.append(run(api.post("/api/groups", json={
+            "name": name, "description": "d", "created_by": "u1",
+            "members": [{"user_id": "u1", "user_name": "One"}, {"user_id": "u2", "user_name": "Two"}],
+        })).json())
+    for group in groups:
+        run(api.post(f"/api/groups/{group['id']}/messages", json={
+            "group_id": group["id"], "sender_id": "u2", "sender_name": "Two", "content": f"hi {group['name']}",
+        }))
+    assert [g["name"] for g in inbox(api, run)["groups"]] == ["finishing", "cutting"]
+
+    run(api.post(f"/api/groups/{groups[0]['id']}/messages", json={
+        "group_id": groups[0]["id"], "sender_id": "u2", "sender_name": "Two", "content": "again",
+    }))
+    assert [g["name"] for g in inbox(api, run)["groups"]] == ["cutting", "finishing"]
+
+
+def test_rebuild_keeps_a_write_that_lands_during_its_reads(api, run, monkeypatch):
+    inbox(api, run)
+    read_user_inbox = server.read_user_inbox
+    builds = []
+
+    async def read_then_race(user_id):
+        built = await read_user_inbox(user_id)
+        if not builds:
+            # A notification arrives after the rebuild has read the source collections
+            notification = {"id": "n1", "recipient_id": user_id, "task_id": "t1", "notification_type": "assigned",
+                            "title": "New task", "read": False, "created_at": "2026-01-01T00:00:00+00:00"}
+            await server.db.task_notifications.insert_one(dict(notification))
+            await server.inbox_add_notification(notification)
+        builds.append(built)
+        return built
+
+    monkeypatch.setattr(server, "read_user_inbox", read_then_race)
+    refreshed = run(api.get("/api/inbox", params={"user_id": "u1", "refresh": True})).json()
+    assert len(builds) == 2
+    assert refreshed["unread_notifications"] == 1
+    assert inbox(api, run)["unread_notifications"] == 1
+
+
+def test_first_build_leaves_no_placeholder_behind(api, run):
+    built = inbox(api, run, user_id="u9")
+    stored = run(server.db.user_inboxes.find_one({"user_id": "u9"}, {"_id": 0}))
+    assert stored == built
@@ -0,0 +1,45 @@
+"""Request metrics cover the whole response, including streamed bodies"""
+import asyncio
+
+import server
+
+
+def series(histogram, labels):
+    return histogram._series.get(labels, [0] * len(histogram.buckets) + [0.0, 0])
+
+
+def test_streamed_response_is_timed_and_sized_to_the_last_chunk(run):
+    async def streaming_app(scope, receive, send):
+        await send({"type": "http.response.start", "status": 200, "headers": [(b"transfer-encoding", b"chunked")]})
+        for chunk in (b"data: one\n\n", b"data: two\n\n"):
+            await send({"type": "http.response.body", "body": chunk, "more_body": True})
+            await asyncio.sleep(0.05)
+        await send({"type": "http.response.body", "body": b"", "more_body": False})
+
+    async def receive():
+        return {"type": "http.request", "body": b"", "more_body": False}
+
+    async def send(message):
+        pass
+
+    labels = ("GET", "unmatched")
+    sizes_before = series(server.http_response_size_bytes, labels)[-2:]
+    durations_before = series(server.http_request_duration_seconds, labels)[-2:]
+    middleware = server.RequestMetricsMiddleware(streaming_app)
+    run(middleware({"type": "http", "method": "GET", "path": "/not-a-route", "root_path": "",
+                    "query_string": b"", "headers": []}, receive, send))
+
+    size_sum, size_count = series(server.http_response_size_bytes, labels)[-2:]
+    assert (size_sum - sizes_before[0], size_count - sizes_before[1]) == (22, 1)
+    duration_sum, duration_count = series(server.http_request_duration_seconds, labels)[-2:]
+    assert duration_count - durations_before[1] == 1
+    assert duration_sum - durations_before[0] >= 0.1
+    assert server.http_requests_in_flight._values[labels] == 0
+
+
+def test_requests_are_counted_by_route_template_and_status(api, run):
+    labels = ("GET", "/api/orders/{order_id}", "404")
+    before = server.http_requests_total._values.get(labels, 0)
+    assert run(api.get("/api/orders/missing")).status_code == 404
+    assert server.http_requests_total._values[labels] == before + 1
+    assert "http_requests_total" in run(api.get("/metrics")).text
@@ -0,0 +1,89 @@
+"""Order and production-stage transitions, the pipeline counters they keep and their reconciliation"""
+import pytest
+
+import server
+
+
+@pytest.fixture
+def pipeline(db, run):
+    run(db.orders.insert_one({"id": "o1", "style_number": "ST-1", "status": "pending", "version": 1}))
+    run(db.production_stages.insert_one(
+        {"id": "s1", "order_id": "o1", "stage": "cutting", "status": "pending", "version": 1}
+    ))
+    run(server.reconcile_pipeline_counters())
+    return db
+
+
+def counts(run):
+    return run(server.pipeline_counts(server.ReadContext(server.db)))
+
+
+def move_order(api, run, status):
+    return run(api.put("/api/orders/o1", params={"status": status}))
+
+
+def move_stage(api, run, status):
+    return run(api.put("/api/production/s1", params={"status": status}))
+
+
+def test_order_moves_along_allowed_edges_and_keeps_the_counters(pipeline, api, run):
+    assert move_order(api, run, "in_production").status_code == 200
+    assert move_order(api, run, "quality_check").status_code == 200
+    assert move_order(api, run, "in_production").status_code == 200  # back for rework
+
+    response = move_order(api, run, "shipped")
+    assert response.status_code == 409
+    order = run(pipeline.orders.find_one({"id": "o1"}))
+    assert order["status"] == "in_production"
+    assert [(t["from"], t["to"]) for t in order["transitions"]] == [
+        ("pending", "in_production"), ("in_production", "quality_check"), ("quality_check", "in_production"),
+    ]
+    orders = counts(run)["orders"]
+    assert orders["in_production"] == 1
+    assert orders["pending"] == orders["quality_check"] == orders["shipped"] == 0
+
+
+def test_reopened_stage_keeps_its_first_start(pipeline, api, run):
+    assert move_stage(api, run, "completed").status_code == 409
+    assert move_stage(api, run, "in_progress").status_code == 200
+    started_at = run(pipeline.production_stages.find_one({"id": "s1"}))["started_at"]
+    assert move_stage(api, run, "completed").status_code == 200
+    assert move_stage(api, run, "in_progress").status_code == 200
+
+    stage = run(pipeline.production_stages.find_one({"id": "s1"}))
+    assert stage["started_at"] == started_at
+    assert stage["completed_at"] is None
+    assert counts(run)["production_stages"]["cutting"] == {"pending": 0, "in_progress": 1, "completed": 0}
+
+
+def test_reconcile_corrects_drift_with_increments(pipeline, run):
+    assert run(server.reconcile_pipeline_counters())["corrected"] == []
+
+    run(pipeline.orders.insert_one({"id": "o2", "status": "pending", "version": 1}))  # written without a bump
+    run(server.bump_pipeline_counts("production_stages", {"cutting.completed": 2}))  # a stray bump
+    result = run(server.reconcile_pipeline_counters())
+    assert sorted(result["corrected"]) == ["orders", "production_stages"]
+    assert counts(run)["orders"]["pending"] == 2
+    assert counts(run)["production_stages"]["cutting"] == {"pending": 1, "in_progress": 0, "completed": 0}
+
+
+def test_reconcile_recounts_when_counters_move_meanwhile(pipeline, run, monkeypatch):
+    run(pipeline.orders.insert_one({"id": "o2", "status": "pending", "version": 1}))
+    count_pipeline = server.count_pipeline
+    calls = []
+
+    async def racing_count(kind):
+        result = await count_pipeline(kind)
+        if kind == "orders" and not calls:
+            # A transition commits after the count: its record change and its bump land together
+            await pipeline.orders.update_one({"id": "o1"}, {"$set": {"status": "in_production"}})
+            await server.bump_pipeline_counts("orders", {"pending": -1, "in_production": 1})
+        calls.append(kind)
+        return result
+    monkeypatch.setattr(server, "count_pipeline", racing_count)
+
+    run(server.reconcile_pipeline_counters())
+    assert calls.count("orders") == 2
+    orders = counts(run)["orders"]
+    assert orders["pending"] == 1
+    assert orders["in_production"] == 1
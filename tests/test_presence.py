@@ -0,0 +1,128 @@
+"""Presence and typing TTLs, department lookups, per-channel coalescing of broadcasts, and per-process
+presence being flagged when several workers serve the app"""
+import asyncio
+import logging
+
+import pytest
+
+import server
+
+
+@pytest.mark.parametrize("argv,env,workers", [
+    (["uvicorn", "server:app", "--workers", "4"], None, 4),
+    (["uvicorn", "server:app", "--workers=3"], None, 3),
+    (["gunicorn", "-w", "2", "server:app"], None, 2),
+    (["uvicorn", "server:app"], "6", 6),
+    (["uvicorn", "server:app"], None, 1),
+])
+def test_worker_count_comes_from_the_command_line_or_web_concurrency(monkeypatch, argv, env, workers):
+    monkeypatch.setattr(server.sys, "argv", argv)
+    if env is None:
+        monkeypatch.delenv("WEB_CONCURRENCY", raising=False)
+    else:
+        monkeypatch.setenv("WEB_CONCURRENCY", env)
+    assert server.server_worker_count() == workers
+
+
+def test_local_presence_with_several_workers_is_reported(monkeypatch, caplog):
+    monkeypatch.setattr(server.sys, "argv", ["uvicorn", "server:app", "--workers", "4"])
+    monkeypatch.setattr(server, "presence_store", server.LocalPresenceStore())
+    with caplog.at_level(logging.ERROR):
+        server.check_presence_store()
+    assert "PRESENCE_STORE=redis" in caplog.text
+
+    caplog.clear()
+    monkeypatch.setattr(server.sys, "argv", ["uvicorn", "server:app"])
+    monkeypatch.delenv("WEB_CONCURRENCY", raising=False)
+    server.check_presence_store()
+    assert caplog.text == ""
+
+
+@pytest.fixture
+def store(monkeypatch):
+    store = server.LocalPresenceStore()
+    monkeypatch.setattr(server, "presence_store", store)
+    return store
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(server.time, "time", lambda: now[0])
+    return now
+
+
+def heartbeat(api, run, user_id, department="cutting", status="online"):
+    return run(api.post("/api/presence/heartbeat", json={
+        "user_id": user_id, "user_name": user_id.upper(), "department": department, "status": status
+    }))
+
+
+def test_entries_expire_after_their_ttl(store, clock, run):
+    run(store.put("presence:users", "u1", {"user_id": "u1"}, 10))
+    run(store.put("presence:users", "u2", {"user_id": "u2"}, 30))
+    clock[0] += 20
+    assert run(store.read("presence:users")) == {"u2": {"user_id": "u2"}}
+    assert run(store.read("presence:users", ["u1", "u2"])) == {"u2": {"user_id": "u2"}}
+
+    store.sweep()
+    assert list(store.hashes["presence:users"]) == ["u2"]
+    clock[0] += 20
+    store.sweep()
+    assert store.hashes == {}
+
+
+def test_department_lists_online_users_until_they_leave_or_expire(store, clock, api, run):
+    assert heartbeat(api, run, "u2").status_code == 200
+    heartbeat(api, run, "u1", status="away")
+    heartbeat(api, run, "u3", department="stitching")
+    response = run(api.get("/api/presence/department/cutting"))
+    assert response.json() == [
+        {"user_id": "u1", "user_name": "U1", "status": "away"},
+        {"user_id": "u2", "user_name": "U2", "status": "online"},
+    ]
+
+    heartbeat(api, run, "u1", status="offline")
+    assert [entry["user_id"] for entry in run(api.get("/api/presence/department/cutting")).json()] == ["u2"]
+    users = run(api.get("/api/presence", params={"user_ids": ["u1", "u2"]})).json()
+    assert users["u1"] == {"user_id": "u1", "status": "offline"}
+    assert users["u2"]["status"] == "online"
+
+    clock[0] += server.PRESENCE_TTL_SECONDS + 1
+    assert run(api.get("/api/presence/department/cutting")).json() == []
+
+
+def test_typing_shows_until_stopped_or_expired(store, clock, api, run):
+    typing = {"channel": "group:g1", "user_id": "u1", "user_name": "U1"}
+    assert run(api.post("/api/presence/typing", json=typing)).json() == {"typing": True}
+    assert run(server.channel_snapshot("group:g1")) == {
+        "channel": "group:g1", "typing": [{"user_id": "u1", "user_name": "U1"}]
+    }
+    run(api.post("/api/presence/typing", json={**typing, "typing": False}))
+    assert run(server.channel_snapshot("group:g1"))["typing"] == []
+
+    run(api.post("/api/presence/typing", json=typing))
+    clock[0] += server.TYPING_TTL_SECONDS + 1
+    assert run(server.channel_snapshot("group:g1"))["typing"] == []
+    assert run(api.post("/api/presence/typing", json={**typing, "channel": "department:cutting"})).status_code == 400
+
+
+def test_broadcast_keeps_the_latest_snapshot_of_every_channel(store, run):
+    hub = server.PresenceHub()
+    slow = hub.subscribe(["group:g1", "group:g2"])
+    run(store.put("typing:group:g2", "u9", {"user_id": "u9", "user_name": "U9"}, 60))
+    run(hub.broadcast())
+    for user_id in ("u1", "u2", "u3"):  # many changes to g1 while the client is not reading
+        run(store.put("typing:group:g1", user_id, {"user_id": user_id, "user_name": user_id}, 60))
+        run(hub.broadcast())
+    run(hub.broadcast())  # nothing changed: nothing new is offered
+
+    snapshots = run(slow.take(1))
+    assert [snapshot["channel"] for snapshot in snapshots] == ["group:g2", "group:g1"]
+    assert [entry["user_id"] for entry in snapshots[0]["typing"]] == ["u9"]
+    assert [entry["user_id"] for entry in snapshots[1]["typing"]] == ["u1", "u2", "u3"]
+    with pytest.raises(asyncio.TimeoutError):
+        run(slow.take(0.01))
+
+    hub.unsubscribe(slow)
+    assert hub.subscribers == {} and hub.last_sent == {}
@@ -0,0 +1,28 @@
+"""Profiled requests break the handler down into the spans of the functions it called"""
+import server
+
+
+def create_task(api, run, headers):
+    response = run(api.post("/api/tasks", headers=headers, json={
+        "title": "Hem sleeves", "description": "d", "assigned_to": "u1", "department": "stitching",
+    }))
+    assert response.status_code == 200
+    return response
+
+
+def test_profile_records_notification_and_serialization_spans(api, db, run, monkeypatch):
+    monkeypatch.setattr(server, "PROFILE_DEBUG", True)
+    run(db.workers.insert_one({"id": "u1", "name": "One", "department": "stitching", "active": True}))
+    response = create_task(api, run, {"X-Profile": "1"})
+
+    folded = run(api.get(f"/api/debug/profiles/{response.headers['X-Profile-Id']}", params={"format": "folded"})).text
+    frames = {frame for line in folded.splitlines() for frame in line.rsplit(" ", 1)[0].split(";")}
+    assert {"send_task_notification", "serialize_doc"} <= frames
+
+
+def test_profile_header_and_routes_are_off_without_profile_debug(api, db, run, monkeypatch):
+    monkeypatch.setattr(server, "PROFILE_DEBUG", False)
+    run(db.workers.insert_one({"id": "u1", "name": "One", "department": "stitching", "active": True}))
+    response = create_task(api, run, {"X-Profile": "1"})
+    assert "X-Profile-Id" not in response.headers
+    assert run(api.get("/api/debug/profiles")).status_code == 404
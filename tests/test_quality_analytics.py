@@ -0,0 +1,65 @@
+"""QC analytics: defect Pareto, first-pass yield and rework loops over a bounded range (needs a real
+mongod: mongomock has no $trim)"""
+from datetime import datetime, timedelta, timezone
+
+import server
+
+NOW = datetime.now(timezone.utc)
+
+
+def check(order_id, stage, status, minutes_ago, defects=(), inspector="i1", style="ST-1", days_ago=0):
+    checked_at = NOW - timedelta(days=days_ago, minutes=minutes_ago)
+    return {"id": f"{order_id}-{stage}-{minutes_ago}-{days_ago}", "order_id": order_id, "stage": stage,
+            "status": status, "defects_found": list(defects), "inspector_id": inspector, "style_number": style,
+            "checked_at": checked_at.isoformat()}
+
+
+def analytics(api, run, **params):
+    response = run(api.get("/api/analytics/quality", params=params))
+    assert response.status_code == 200, response.text
+    return response.json()
+
+
+def test_pareto_first_pass_yield_and_rework(mongo_db, api, run):
+    run(mongo_db.quality_checks.insert_many([
+        # o1 stitching fails twice before passing; o1 finishing passes first time
+        check("o1", "stitching", "failed", 30, [" Skipped stitch", "loose thread"]),
+        check("o1", "stitching", "failed", 20, ["skipped stitch"], inspector="i2"),
+        check("o1", "stitching", "passed", 10),
+        check("o1", "finishing", "passed", 5),
+        # o2 stitching passes first time, with a defect noted
+        check("o2", "stitching", "passed", 15, ["Loose thread "], style="ST-2"),
+    ]))
+    result = analytics(api, run)
+    assert (result["checks"], result["failed"], result["pass_rate"]) == (5, 2, 0.6)
+
+    stages = {row["stage"]: row for row in result["pareto"]["stage"]}
+    assert stages["stitching"]["total_defects"] == 4
+    defects = stages["stitching"]["defects"]
+    assert {d["defect"]: (d["count"], d["share"]) for d in defects} == {
+        "skipped stitch": (2, 0.5), "loose thread": (2, 0.5),
+    }
+    assert [d["cumulative_share"] for d in defects] == [0.5, 1.0]
+    assert {row["inspector"]: row["total_defects"] for row in result["pareto"]["inspector"]} == {"i1": 3, "i2": 1}
+
+    fpy = {row["stage"]: (row["orders"], row["first_pass"], row["fpy"])
+           for row in result["first_pass_yield"]["stages"]}
+    assert fpy == {"finishing": (1, 1, 1.0), "stitching": (2, 1, 0.5)}
+    orders = [(row["order_id"], row["stages"], row["fpy"]) for row in result["first_pass_yield"]["orders"]]
+    assert orders == [("o1", 2, 0.5), ("o2", 1, 1.0)]
+
+    assert result["rework"] == [{"order_id": "o1", "stage": "stitching", "style_number": "ST-1",
+                                 "checks": 3, "failed": 2, "passed": True}]
+
+
+def test_range_defaults_to_the_recent_window(mongo_db, api, run):
+    run(mongo_db.quality_checks.insert_many([
+        check("o1", "stitching", "failed", 0, ["stain"], days_ago=server.QC_ANALYTICS_DEFAULT_DAYS + 5),
+        check("o2", "stitching", "passed", 0, days_ago=1),
+    ]))
+    result = analytics(api, run)
+    assert result["checks"] == 1
+    assert result["rework"] == [] and result["pareto"]["stage"] == []
+
+    start = (NOW - timedelta(days=server.QC_ANALYTICS_DEFAULT_DAYS + 10)).isoformat()
+    assert analytics(api, run, start=start)["checks"] == 2
@@ -0,0 +1,48 @@
+"""Rate limits count per client, on the address the trusted proxy saw rather than anything the client sets"""
+import pytest
+
+import server
+
+
+@pytest.fixture
+def limits(monkeypatch):
+    monkeypatch.setattr(server, "rate_limit_store", server.LocalRateLimitStore())
+    monkeypatch.setattr(server, "RATE_LIMIT_TRUSTED_PROXIES", 1)
+
+
+def message(sender_id):
+    return {"conversation_id": "c1", "sender_id": sender_id, "sender_name": sender_id, "receiver_id": "x",
+            "receiver_name": "x", "content": "hi"}
+
+
+def test_forged_senders_and_hops_share_the_client_bucket(api, db, run, limits):
+    run(db.conversations.insert_one({"id": "c1", "participant1_id": "a", "participant1_name": "A",
+                                     "participant2_id": "b", "participant2_name": "B"}))
+    _, burst = server.RATE_LIMITS["messages"]
+    statuses = [
+        run(api.post("/api/conversations/c1/messages", json=message(f"user-{i}"),
+                     headers={"X-Forwarded-For": f"198.51.100.{i}, 203.0.113.7"})).status_code
+        for i in range(burst + 1)
+    ]
+    assert statuses == [200] * burst + [429]
+    # Another client behind the same proxy has its own bucket
+    assert run(api.post("/api/conversations/c1/messages", json=message("a"),
+                        headers={"X-Forwarded-For": "203.0.113.8"})).status_code == 200
+
+
+def test_client_is_the_hop_appended_by_the_outermost_trusted_proxy(monkeypatch):
+    class Stub:
+        def __init__(self, headers, host="10.0.0.1"):
+            self.headers = headers
+            self.client = type("Client", (), {"host": host})()
+
+    forwarded = {"x-forwarded-for": "1.2.3.4, 203.0.113.7, 10.0.0.2"}
+    monkeypatch.setattr(server, "RATE_LIMIT_TRUSTED_PROXIES", 2)
+    assert server.request_client(Stub(forwarded)) == "ip:203.0.113.7"
+    monkeypatch.setattr(server, "RATE_LIMIT_TRUSTED_PROXIES", 1)
+    assert server.request_client(Stub(forwarded)) == "ip:10.0.0.2"
+    # Fewer hops than proxies: the header did not come through them all, so it is ignored
+    monkeypatch.setattr(server, "RATE_LIMIT_TRUSTED_PROXIES", 4)
+    assert server.request_client(Stub(forwarded)) == "ip:10.0.0.1"
+    monkeypatch.setattr(server, "RATE_LIMIT_TRUSTED_PROXIES", 0)
+    assert server.request_client(Stub(forwarded)) == "ip:10.0.0.1"
@@ -0,0 +1,39 @@
+"""Time-series rollups: validated ranges, bounded responses and rebuilds that never empty the buckets"""
+from datetime import datetime, timedelta, timezone
+
+import server
+
+
+def test_invalid_dates_are_rejected_with_400(api, run):
+    response = run(api.get("/api/analytics/timeseries", params={"start": "last tuesday"}))
+    assert response.status_code == 400
+    assert run(api.get("/api/analytics/timeseries", params={"start": "2024-05-01T10:30:00Z"})).status_code == 200
+
+
+def test_results_are_capped(api, run):
+    for day in range(1, 4):
+        run(server.record_rollups(f"2024-05-0{day}T10:00:00+00:00", {}, {"hours_logged": 1}))
+    body = run(api.get("/api/analytics/timeseries", params={"limit": 2})).json()
+    assert [bucket["bucket"] for bucket in body["buckets"]] == ["2024-05-01T00:00:00+00:00", "2024-05-02T00:00:00+00:00"]
+    assert body["has_more"] is True
+    assert run(api.get("/api/analytics/timeseries", params={"limit": 3})).json()["has_more"] is False
+
+
+def test_rebuild_overwrites_in_place_and_drops_only_stale_buckets(db, run):
+    run(db.tasks.insert_one({"id": "t1", "department": "cutting", "assigned_to": "w1", "status": "pending"}))
+    run(db.time_logs.insert_one({"task_id": "t1", "user_id": "w1", "hours": 2, "logged_at": "2024-05-01T10:00:00+00:00"}))
+    run(server.record_rollups("2024-05-01T10:00:00+00:00", {"department": "cutting", "worker": "w1"},
+                              {"hours_logged": 5}))  # drifted from the raw rows
+    stale_id = "day|worker|gone|2024-01-01T00:00:00+00:00"
+    run(db.metric_rollups.insert_one({"_id": stale_id, "granularity": "day", "dimension": "worker", "key": "gone",
+                                      "bucket": "2024-01-01T00:00:00+00:00", "metrics": {"hours_logged": 1}}))
+    # Created by a live increment while the rebuild runs: not in the rebuild, but not stale either
+    live_id = "day|worker|new|2024-06-01T00:00:00+00:00"
+    run(db.metric_rollups.insert_one({"_id": live_id, "metrics": {"hours_logged": 1},
+                                      "created_at": datetime.now(timezone.utc) + timedelta(minutes=1)}))
+
+    assert run(server.rebuild_rollups()) == 6
+    factory_day = run(db.metric_rollups.find_one({"_id": "day|factory|all|2024-05-01T00:00:00+00:00"}))
+    assert factory_day["metrics"] == {"hours_logged": 2}
+    assert run(db.metric_rollups.count_documents({"_id": stale_id})) == 0
+    assert run(db.metric_rollups.count_documents({"_id": live_id})) == 1
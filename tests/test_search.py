@@ -0,0 +1,38 @@
+"""Search ranks hits from every scope on one comparable score"""
+import server
+
+
+def docs(*scores):
+    return [{"id": f"d{index}", "score": score} for index, score in enumerate(scores)]
+
+
+def test_a_weak_match_does_not_outrank_a_strong_one_from_another_scope():
+    # A one-word task title match (weight 10 in the index) against a message repeating the words
+    tasks = server.scope_hits("tasks", docs(10.5))
+    messages = server.scope_hits("messages", docs(3.2, 0.6))
+    results, has_more = server.merge_search_hits([tasks, messages], 0, 10)
+    assert [(hit["type"], hit["score"]) for hit in results] == [("messages", 3.2), ("tasks", 1.05), ("messages", 0.6)]
+    assert results[1]["text_score"] == 10.5
+    assert has_more is False
+
+
+def test_paging_over_the_merged_hits():
+    hits = server.scope_hits("comments", docs(3, 2, 1))
+    results, has_more = server.merge_search_hits([hits], 1, 1)
+    assert [hit["document"]["id"] for hit in results] == ["d1"]
+    assert has_more is True
+
+
+def test_skip_is_capped(api, run):
+    response = run(api.get("/api/search", params={"q": "bundle", "skip": server.SEARCH_MAX_SKIP + 1}))
+    assert response.status_code == 422
+
+
+def test_strong_message_match_ranks_above_a_one_word_task_match(mongo_db, api, run):
+    run(server.create_indexes())
+    run(mongo_db.tasks.insert_one({"id": "t1", "title": "zipper", "description": "", "tags": [],
+                                   "created_at": "2024-01-01T00:00:00+00:00"}))
+    run(mongo_db.messages.insert_one({"id": "m1", "content": "zipper zipper zipper broke on the zipper line",
+                                      "sent_at": "2024-01-01T00:00:00+00:00"}))
+    results = run(api.get("/api/search", params={"q": "zipper"})).json()["results"]
+    assert [hit["type"] for hit in results] == ["messages", "tasks"]
@@ -0,0 +1,94 @@
+"""Offline sync reports what each operation actually did and returns every change since the token"""
+from datetime import datetime, timedelta, timezone
+
+import server
+
+
+def sync(api, run, operations=(), since=None):
+    body = {"client_id": "tablet-1", "user_id": "u1", "operations": list(operations)}
+    if since:
+        body["since"] = since
+    response = run(api.post("/api/sync", json=body))
+    assert response.status_code == 200, response.text
+    return response.json()
+
+
+def test_operations_that_match_nothing_are_reported_not_found(api, db, run):
+    run(db.messages.insert_one({"id": "m1", "conversation_id": "c1", "read_by_recipient": False}))
+    results = sync(api, run, [
+        {"op_id": "op-1", "type": "mark_message_read", "data": {"message_id": "m1", "conversation_id": "c1"}},
+        {"op_id": "op-2", "type": "mark_message_read", "data": {"message_id": "gone", "conversation_id": "c1"}},
+    ])["results"]
+    assert [result["status"] for result in results] == ["applied", "not_found"]
+    # Replays get the recorded outcome back
+    replayed = sync(api, run, [
+        {"op_id": "op-2", "type": "mark_message_read", "data": {"message_id": "gone", "conversation_id": "c1"}},
+    ])["results"]
+    assert replayed == [{"op_id": "op-2", "status": "not_found", "replayed": True}]
+
+
+def test_z_suffixed_token_compares_with_stored_timestamps(api, db, run):
+    token = datetime.now(timezone.utc).replace(microsecond=0) - timedelta(hours=1)
+    run(db.tasks.insert_one({"id": "t0", "assigned_to": "u1", "updated_at": (token - timedelta(seconds=1)).isoformat()}))
+    run(db.tasks.insert_one({"id": "t1", "assigned_to": "u1",
+                             "updated_at": (token + timedelta(microseconds=500000)).isoformat()}))
+    changes = sync(api, run, since=token.strftime("%Y-%m-%dT%H:%M:%SZ"))["changes"]
+    assert [task["id"] for task in changes["tasks"]] == ["t1"]
+
+
+def test_tag_changes_bump_the_version_and_reach_the_delta(api, db, run):
+    run(db.tasks.insert_one({"id": "t1", "title": "t", "assigned_to": "u1", "status": "pending", "version": 1,
+                             "updated_at": (datetime.now(timezone.utc) - timedelta(days=2)).isoformat()}))
+    since = (datetime.now(timezone.utc) - timedelta(days=1)).isoformat()
+    assert sync(api, run, since=since)["changes"]["tasks"] == []
+
+    response = run(api.put("/api/tasks/t1/tags", json=["rework"]))
+    assert response.status_code == 200
+    assert response.headers["ETag"] == '"2"'
+
+    changes = sync(api, run, since=since)["changes"]
+    assert [(task["id"], task["tags"]) for task in changes["tasks"]] == [("t1", ["rework"])]
+
+
+def test_replayed_upsert_does_not_repeat_its_follow_ups(api, db, run):
+    run(db.tasks.insert_one({"id": "t1", "title": "t", "assigned_to": "u1", "status": "pending",
+                             "department": "stitching"}))
+    comment = {"op_id": "op-c", "type": "create_task_comment",
+               "data": {"task_id": "t1", "user_id": "u1", "user_name": "One", "comment": "needs thread"}}
+    time_log = {"op_id": "op-t", "type": "create_time_log",
+                "data": {"task_id": "t1", "user_id": "u1", "user_name": "One", "hours": 1.5}}
+    assert [r["status"] for r in sync(api, run, [comment, time_log])["results"]] == ["applied", "applied"]
+    # The writes landed but their outcomes were never recorded, as if the server died before that step
+    run(db.sync_operations.delete_many({}))
+
+    assert [r["status"] for r in sync(api, run, [comment, time_log])["results"]] == ["applied", "applied"]
+    assert run(db.task_comments.count_documents({})) == 1
+    assert run(db.events.count_documents({"type": "task.time_logged"})) == 1
+    run(server.activity_writer.flush())
+    assert run(db.activity_logs.count_documents({"action": "commented"})) == 1
+
+
+def test_deletions_since_the_token_are_listed_as_removed(api, db, run):
+    since = datetime.now(timezone.utc).isoformat()
+    for task_id, assignee in (("t1", "u1"), ("t2", "u1"), ("t3", "u2")):
+        run(db.tasks.insert_one({"id": task_id, "title": task_id, "assigned_to": assignee, "status": "pending"}))
+    run(db.subtasks.insert_one({"id": "s1", "task_id": "t1", "title": "s"}))
+    run(db.task_comments.insert_one({"id": "c1", "task_id": "t1", "comment": "c"}))
+
+    assert run(api.delete("/api/tasks/t1/subtasks/s1")).status_code == 200
+    assert run(api.delete("/api/tasks/t1/comments/c1")).status_code == 200
+    assert run(api.delete("/api/tasks/t2")).status_code == 200
+    assert run(api.delete("/api/tasks/t3")).status_code == 200
+
+    response = sync(api, run, since=since)
+    assert response["removed"] == {"tasks": ["t2"], "subtasks": ["s1"], "task_comments": ["c1"]}
+    assert response["reset"] is False
+
+
+def test_token_older_than_the_feed_resets_the_client(api, db, run):
+    run(db.tasks.insert_one({"id": "t1", "title": "t", "assigned_to": "u1", "status": "pending",
+                             "updated_at": "2020-01-01T00:00:00+00:00"}))
+    since = (datetime.now(timezone.utc) - timedelta(days=server.EVENT_RETENTION_DAYS + 1)).isoformat()
+    response = sync(api, run, since=since)
+    assert response["reset"] is True
+    assert [task["id"] for task in response["changes"]["tasks"]] == ["t1"]
@@ -0,0 +1,118 @@
+"""/api/tasks/query must walk an index in sort order for every filter and sort it accepts"""
+import itertools
+
+import pytest
+
+import server
+
+FILTERS = {
+    "none": {},
+    "status": {"status": "pending"},
+    "statuses": {"status": ["pending", "in_progress"]},
+    "assignee": {"assigned_to": "w1"},
+    "assignees": {"assigned_to": ["w1", "w2"]},
+    "assignee_status": {"assigned_to": "w1", "status": "pending"},
+    "department": {"department": "stitching"},
+    "department_status": {"department": "stitching", "status": ["pending", "in_progress"]},
+    "assignee_department": {"assigned_to": "w1", "department": "stitching"},
+    "priority": {"priority": "high"},
+    "priorities": {"priority": ["high", "urgent"]},
+    "priority_status": {"priority": "urgent", "status": "pending"},
+    "tags": {"tags": ["rush"]},
+    "tags_all": {"tags": ["rush", "export"], "tag_match": "all"},
+    "due_range": {"due_from": "2024-01-01", "due_to": "2024-02-01"},
+    "status_due_range": {"status": "pending", "due_from": "2024-01-01"},
+}
+SORTS = ["priority", "due_date", "created_at"]
+
+
+def task_filter(params: dict) -> dict:
+    """The Mongo filter query_tasks builds for these query parameters"""
+    def values(name, cast=str):
+        value = params.get(name)
+        if value is None:
+            return None
+        return [cast(v) for v in (value if isinstance(value, list) else [value])]
+    return server.task_query_filter(
+        values("assigned_to"), values("status", server.TaskStatus), values("priority", server.TaskPriority),
+        values("department"), params.get("due_from"), params.get("due_to"), values("tags"),
+        params.get("tag_match", "any"),
+    )
+
+
+def provides_sort(index, query: dict, sort_field: str) -> bool:
+    """Every key ahead of the sort key is pinned to points, so the index yields rows in sort order"""
+    for key, _ in index:
+        if key == sort_field:
+            return True
+        condition = query.get(key)
+        if condition is None:
+            return False
+        if isinstance(condition, dict) and not set(condition) <= {"$in", "$all"}:
+            return False
+    return False
+
+
+@pytest.mark.parametrize("shape,sort_by", list(itertools.product(FILTERS, SORTS)))
+def test_every_shape_is_planned_on_an_index_that_provides_the_sort(shape, sort_by):
+    query = task_filter(FILTERS[shape])
+    sort_field = server.TASK_SORT_FIELDS[sort_by]
+    index = server.plan_task_query(query, sort_field)
+
+    assert index in server.TASK_QUERY_INDEXES
+    assert provides_sort(index, query, sort_field)
+    assert query["status"] is not None
+
+
+def test_plan_rejects_filters_needing_more_scans_than_mongod_splits():
+    query = task_filter({"assigned_to": [f"w{i}" for i in range(100)]})
+    with pytest.raises(server.HTTPException) as raised:
+        server.plan_task_query(query, "created_at")
+    assert raised.value.status_code == 400
+
+
+def test_query_uses_the_planned_index(api, db, run):
+    run(db.tasks.insert_many([
+        {"id": "t1", "title": "a", "status": "pending", "assigned_to": "w1", "priority_rank": 3,
+         "created_at": "2024-01-02", "due_date": "2024-01-10", "tags": ["rush"]},
+        {"id": "t2", "title": "b", "status": "in_progress", "assigned_to": "w1", "priority_rank": 1,
+         "created_at": "2024-01-01", "due_date": "2024-01-05", "tags": []},
+        {"id": "t3", "title": "c", "status": "completed", "assigned_to": "w2", "priority_rank": 4,
+         "created_at": "2024-01-03", "due_date": "2024-01-01", "tags": ["rush"]},
+    ]))
+    response = run(api.get("/api/tasks/query", params={"assigned_to": "w1", "sort_by": "priority",
+                                                       "fields": "id"}))
+    assert response.status_code == 200
+    assert [task["id"] for task in response.json()] == ["t1", "t2"]
+
+    response = run(api.get("/api/tasks/query", params={"status": "archived"}))
+    assert response.status_code == 422
+
+
+def plan_stages(plan) -> list:
+    if isinstance(plan, dict):
+        stages = [plan["stage"]] if "stage" in plan else []
+        return stages + [stage for value in plan.values() for stage in plan_stages(value)]
+    if isinstance(plan, list):
+        return [stage for value in plan for stage in plan_stages(value)]
+    return []
+
+
+@pytest.mark.parametrize("shape,sort_by,order", list(itertools.product(FILTERS, SORTS, ["asc", "desc"])))
+def test_explain_shows_an_index_scan_without_an_in_memory_sort(mongo_db, api, run, shape, sort_by, order):
+    for keys in server.TASK_QUERY_INDEXES:
+        run(mongo_db.tasks.create_index(keys))
+    run(mongo_db.tasks.insert_many([
+        {"id": f"t{i}", "title": f"task {i}", "status": ["pending", "in_progress", "completed"][i % 3],
+         "assigned_to": f"w{i % 5}", "department": ["stitching", "cutting"][i % 2], "priority_rank": i % 4 + 1,
+         "created_at": f"2024-01-{i % 28 + 1:02d}", "due_date": f"2024-02-{i % 28 + 1:02d}",
+         "tags": ["rush", "export"][: i % 3]}
+        for i in range(200)
+    ]))
+    response = run(api.get("/api/tasks/query", params={**FILTERS[shape], "sort_by": sort_by, "order": order,
+                                                       "explain": "true"}))
+    assert response.status_code == 200
+    stages = plan_stages(response.json()["winning_plan"])
+    assert "IXSCAN" in stages
+    assert "COLLSCAN" not in stages
+    assert "SORT" not in stages
@@ -0,0 +1,55 @@
+"""Transactions are used only where the deployment supports them"""
+import pytest
+
+import server
+
+
+class HelloClient:
+    def __init__(self, hello):
+        self.admin = self
+        self.hello = hello
+
+    async def command(self, name):
+        assert name == "hello"
+        return self.hello
+
+
+@pytest.mark.parametrize("hello,supported", [
+    ({"isWritablePrimary": True}, False),
+    ({"isWritablePrimary": True, "setName": "rs0"}, True),
+    ({"isWritablePrimary": True, "msg": "isdbgrid"}, True),
+])
+def test_auto_mode_follows_the_deployment(run, monkeypatch, hello, supported):
+    monkeypatch.setattr(server, "MONGO_TRANSACTIONS_MODE", "auto")
+    monkeypatch.setattr(server, "MONGO_TRANSACTIONS", not supported)
+    monkeypatch.setattr(server, "client", HelloClient(hello))
+    run(server.detect_transaction_support())
+    assert server.MONGO_TRANSACTIONS is supported
+
+
+def test_forced_mode_is_not_overridden(run, monkeypatch):
+    monkeypatch.setattr(server, "MONGO_TRANSACTIONS_MODE", "false")
+    monkeypatch.setattr(server, "MONGO_TRANSACTIONS", False)
+    monkeypatch.setattr(server, "client", HelloClient({"setName": "rs0"}))
+    run(server.detect_transaction_support())
+    assert server.MONGO_TRANSACTIONS is False
+
+
+def test_task_delete_removes_children_in_one_transaction(mongo_db, api, run, monkeypatch):
+    monkeypatch.setattr(server, "MONGO_TRANSACTIONS_MODE", "auto")
+    monkeypatch.setattr(server, "MONGO_TRANSACTIONS", False)
+    run(server.detect_transaction_support())
+    if not server.MONGO_TRANSACTIONS:
+        pytest.skip("MONGO_TEST_URL is a standalone mongod")
+    run(mongo_db.tasks.insert_one({"id": "t1", "title": "t", "assigned_to": "u1", "status": "pending"}))
+    run(mongo_db.task_comments.insert_one({"id": "c1", "task_id": "t1"}))
+    assert run(api.delete("/api/tasks/t1")).status_code == 200
+    assert run(mongo_db.task_comments.count_documents({})) == 0
+
+
+def test_notification_failure_aborts_the_surrounding_transaction(db, run):
+    task = {"id": "t1", "title": "t", "priority": "high", "department": "cutting"}
+    broken = [{"user_id": "u1"}]  # no user_name
+    run(server.send_task_notification(task, "task_created", broken))  # logged and skipped
+    with pytest.raises(KeyError):
+        run(server.send_task_notification(task, "task_created", broken, session=object()))